@@ -9,11 +9,23 @@ from .imagecapture import capture_image_file
 # image processing
 from .imageprocessor import AllSkyDeviceConfiguration
 from .imageprocessor import AllSkyImageProcessor
+from .imageprocessor import DEMOSAIC_ALGORITHMS
 from .imageprocessor import is_supported_file_type
+from .imageprocessor import valid_gamma
 
 # import all files as sub-modules
 from . import abstract_camera
+from . import async_camera
+from . import buffered_reader
+from . import cadence
+from . import darklibrary
+from . import emulator
+from . import ephemeris
 from . import serial_camera
+from . import session
+from . import transfer_timing
 from . import imagecapture
 from . import imageprocessor
+from . import metrics
+from . import reprocess
 from . import util
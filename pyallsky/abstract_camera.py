@@ -1,14 +1,36 @@
-import array
+import contextlib
 import datetime
 import logging
 import struct
 import time
 from abc import ABC, abstractmethod
+from collections import namedtuple
+
+import numpy
+
+from pyallsky.buffered_reader import BufferedReader
+from pyallsky.transfer_timing import TransferTimingModel
+from pyallsky.util import RollingStatistics
 
 class AllSkyException(Exception):
     '''Exception class for errors from this code'''
     pass
 
+class ImageTransferError(AllSkyException):
+    '''
+    An image transfer failed part way through. The blocks received before
+    the failure are kept, for diagnostics or to resume the transfer.
+    '''
+    def __init__(self, message, data, blocks):
+        '''
+        message -- the error message
+        data -- the frame buffer, valid up to the first failed block
+        blocks -- the number of complete blocks at the start of data
+        '''
+        super().__init__(message)
+        self.data = data
+        self.blocks = blocks
+
 # Test Commands
 COM_TEST = 'E'
 
@@ -57,14 +79,583 @@ EXP_DARK_ONLY = chr(0x00)
 
 # Other Constants
 PIXEL_SIZE = 2
+BLOCK_PIXELS = 4096
+BLOCKS_PER_FRAME = 75 # (640 * 480) / 4096
+FRAME_WIDTH = 640
+FRAME_HEIGHT = 480
+FRAME_BYTES = FRAME_WIDTH * FRAME_HEIGHT * PIXEL_SIZE
+
+# Statistics about a single image download
+TransferStatistics = namedtuple('TransferStatistics', [
+    'blocks',           # number of blocks received
+    'retries',          # list with the number of retries needed for each block
+    'checksum_errors',  # total number of blocks rejected due to a bad checksum
+    'short_reads',      # total number of blocks which timed out before completion
+    'duration',         # total transfer time in seconds
+    'ack_rtt',          # mean time from block acknowledgement to the next block
+])
+
+# A verified image block, as yielded by AbstractCamera.iter_image_blocks()
+ImageBlock = namedtuple('ImageBlock', [
+    'index',            # block number, from 0 to BLOCKS_PER_FRAME - 1
+    'offset',           # byte offset of the block in the frame buffer
+    'data',             # memoryview of the block in the frame buffer
+    'rows',             # number of complete image rows received so far
+    'checksum_errors',  # number of times the block had a bad checksum
+    'short_reads',      # number of times the block timed out
+])
+
+# number of seconds without data after which a failed transfer has drained
+DRAIN_TIMEOUT = 0.25
+
+# exposure of the dark frame taken to test image transfers (in seconds)
+VERIFY_EXPOSURE = 0.001
+
+def block_checksum(data):
+    '''
+    Calculate the XOR checksum of an image block, as sent by the camera after
+    each block of pixel data.
+
+    The whole buffer is reduced at once by NumPy, so this works directly on
+    any object supporting the buffer protocol (bytes, bytearray, memoryview,
+    array.array) without copying it.
+
+    data -- the raw block data
+
+    return -- the checksum as an integer in the range [0, 255]
+    '''
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    if len(buf) == 0:
+        return 0
+
+    return int(numpy.bitwise_xor.reduce(buf))
+
+def command_checksum(command):
+    '''
+    Return the checksum of an arbitrary command
+
+    command -- command string (or bytes) to checksum
+
+    The checksum is simply calculated by complementing the byte, clearing the
+    most significant bit and XOR with the current checksum, going through each byte
+    in the command. For each individual command the checksum starts as 0
+    '''
+    cs = 0
+    for b in command:
+        if isinstance(command, str):
+            b = ord(b)
+        csb = ~b & 0x7F
+        cs = cs ^ csb
+    return chr(cs)
+
+def take_image_command(exposure=1.0, dark=False):
+    '''
+    Build the command to run a full frame exposure of the CCD.
+
+    exposure -- exposure time in seconds
+    dark -- take a dark current exposure
+
+    return -- the command as bytes (without checksum)
+    '''
+    # Camera exposure time works in 100us units, with a maximum value
+    exptime = min(exposure / 100e-6, MAX_EXPOSURE)
+
+    # choose between light/dark exposure type
+    exptype = EXP_DARK_ONLY if dark else EXP_LIGHT_ONLY
+
+    exp = struct.pack('I', int(exptime))[:3]
+    return (TAKE_IMAGE.encode() + exp[::-1] + BIN_1X1_FULL.encode() + exptype.encode())
+
+def parse_firmware_version(data):
+    '''
+    Convert the 2 byte firmware version response to the string format
+    described in the manual.
+
+    Example: R1.30 - "Release v1.30"
+    Example: T1.16 - "Test v1.16"
+    '''
+    if len(data) != 2:
+        raise AllSkyException('Invalid firmware version response: %r' % bytes(data))
+
+    version_type = (data[0] & 0x80) and 'T' or 'R'
+    version_major = (data[0] & 0x7f)
+    version_minor = (data[1])
+
+    return '%s%d.%d' % (version_type, version_major, version_minor)
+
+def allocate_frame_buffer():
+    '''
+    Allocate a buffer large enough to hold a full frame image download
+
+    The buffer can be passed to AbstractCamera.xfer_image() repeatedly, so
+    that consecutive frames are downloaded in place without reallocation.
+    '''
+    return bytearray(FRAME_BYTES)
+
+
+# I/O operations requested by the protocol generators of CameraProtocol. The
+# camera driver performs each operation and sends its result back into the
+# generator, so the protocol itself works with any kind of transport.
+IO_TX = 'tx'            # (IO_TX, data): send data, the result is None
+IO_RX_INTO = 'rx_into'  # (IO_RX_INTO, buf, deadline): fill buf before the
+                        # time.monotonic() deadline, the result is the
+                        # number of bytes received
+IO_BLOCK = 'block'      # (IO_BLOCK, ImageBlock): hand a verified image block
+                        # to the caller, the result is None
+
+def drive_protocol(protocol, perform):
+    '''
+    Run a protocol generator of CameraProtocol, performing each of its I/O
+    operations with perform(op) and sending the result back. An exception
+    raised by perform() is thrown into the protocol, at the point where it
+    requested the operation.
+
+    protocol -- the protocol generator
+    perform -- function which performs one IO_TX or IO_RX_INTO operation
+
+    Yields the ImageBlock of each IO_BLOCK operation, and returns the return
+    value of the protocol
+    '''
+    result = None
+    error = None
+    while True:
+        try:
+            op = protocol.throw(error) if error is not None else protocol.send(result)
+        except StopIteration as ex:
+            return ex.value
+
+        result = None
+        error = None
+        if op[0] == IO_BLOCK:
+            yield op[1]
+            continue
+
+        try:
+            result = perform(op)
+        except Exception as ex:
+            error = ex
+
+def run_protocol(protocol, perform):
+    '''
+    Run a protocol generator of CameraProtocol which hands out no image
+    blocks to completion, see drive_protocol()
+
+    return -- the return value of the protocol
+    '''
+    driver = drive_protocol(protocol, perform)
+    while True:
+        try:
+            next(driver)
+        except StopIteration as ex:
+            return ex.value
+
+
+class CameraProtocol(object):
+    '''
+    The parts of the camera protocol which do not depend on the transport:
+    command checksums, and the image block transfer with its checksum
+    verification, acknowledgements, retries and statistics
+
+    Each operation is a generator which yields the I/O operations it needs
+    (see IO_TX, IO_RX_INTO and IO_BLOCK), and returns its result. The same
+    generators are run by AbstractCamera with blocking I/O, and awaited by
+    AsyncAbstractCamera, so the protocol is only implemented once.
+    '''
+
+    # default number of seconds to wait for the reply to a command
+    default_timeout = 0.5
+
+    def __init__(self):
+        self.logger = logging.getLogger("all_sky_camera")
+
+        # statistics about the most recent image download
+        self.xfer_stats = None
+
+        # round trip latency measurements (in seconds): from sending a command
+        # to receiving its checksum echo, and from acknowledging an image block
+        # (or requesting it again) to receiving the first byte of the next one
+        self.command_rtt = RollingStatistics()
+        self.ack_rtt = RollingStatistics(size=BLOCKS_PER_FRAME * 4)
+        self.__ack_time = None
+
+        # image block deadlines, learned from the recent blocks (the link
+        # rate is set on first use, the link is not open yet)
+        self.transfer_timing = TransferTimingModel(byte_rate=None)
+
+    @abstractmethod
+    def link_rate(self):
+        '''
+        The nominal rate of the link to the camera, used for transfer
+        deadlines until the real rate has been measured
+
+        return -- the rate in bytes per second
+        '''
+        pass
+
+    def camera_timeout_calc(self, nbytes, retry=0):
+        '''
+        Calculate the required timeout to transmit a certain number of bytes,
+        from the latency and throughput of recent image blocks (see
+        TransferTimingModel). The measurements are discarded whenever the
+        link rate changes.
+
+        nbytes -- the number of bytes that will be transmitted
+        retry -- the number of times this transfer has already timed out
+
+        return -- the time required to transmit in seconds
+        '''
+        return self.__timing_model().timeout(nbytes, retry)
+
+    def transfer_estimate(self):
+        '''
+        The current estimate of the image block timing, for diagnostics
+
+        return -- an instance of TransferEstimate
+        '''
+        return self.__timing_model().estimate(BLOCK_PIXELS * PIXEL_SIZE + 1)
 
+    def __timing_model(self):
+        '''The transfer timing model, reset if the link rate has changed'''
+        rate = self.link_rate()
+        if rate != self.transfer_timing.byte_rate:
+            self.transfer_timing.reset(rate)
 
-class AbstractCamera(ABC):
+        return self.transfer_timing
+
+    def command_ops(self, command, timeout):
+        '''
+        Protocol: send a command to the camera and read back and check the
+        checksum
+
+        command -- the command to send
+        timeout -- the number of seconds to wait for the checksum
+
+        return -- True on success, False otherwise
+        '''
+        if isinstance(command, str):
+            command = command.encode()
+        csum = self.checksum(command).encode()
+
+        tstart = time.monotonic()
+        yield (IO_TX, command + csum)
+        buf = bytearray(1)
+        received = yield (IO_RX_INTO, buf, time.monotonic() + timeout)
+        rxsum = bytes(buf[:received])
+
+        # the checksum echo is the first response to any command
+        if rxsum:
+            self.command_rtt.add(time.monotonic() - tstart)
+
+        if rxsum != csum:
+            self.logger.error('command %s csum %s rxsum %s', self.bufdump(command), self.bufdump(csum), self.bufdump(rxsum))
+
+        return rxsum == csum
+
+    def drain_ops(self, timeout=DRAIN_TIMEOUT):
+        '''
+        Protocol: discard everything received from the camera until nothing
+        has arrived for timeout seconds, for example the rest of a stopped
+        transfer
+
+        return -- the number of bytes discarded
+        '''
+        scratch = bytearray(BLOCK_PIXELS * PIXEL_SIZE)
+        discarded = 0
+        while True:
+            received = yield (IO_RX_INTO, scratch, time.monotonic() + timeout)
+            discarded += received
+            if not received:
+                break
+
+        self.logger.debug('Drained %d bytes', discarded)
+        return discarded
+
+    def __block_reply_ops(self, reply):
+        '''
+        Protocol: send the reply to an image block (CSUM_OK, CSUM_ERROR or
+        STOP_XFER) and remember when it was sent, to measure the latency until
+        the next block
+        '''
+        yield (IO_TX, reply.encode())
+        self.__ack_time = time.monotonic() if reply != STOP_XFER else None
+
+    def __mean_ack_rtt(self, count):
+        '''Mean of the most recent count block acknowledgement latencies'''
+        samples = list(self.ack_rtt.samples)[-count:] if count else []
+        return sum(samples) / len(samples) if samples else None
+
+    def __image_block_ops(self, buf, ignore_csum=False, tries=10):
+        '''
+        Protocol: get one 'block' of image data. At full frame the camera
+        returns image data in chunks of 4096 pixels. For different imaging
+        modes this value will change, but the caller can simply pass a
+        differently sized buffer.
+
+        This routine will automatically retry if a communication error occurs,
+        up to the maximum number of retries specified.
+
+        buf -- writable memoryview to receive the block, sized to the number
+               of bytes expected from the camera
+        ignore_csum -- Always pass checksum without checking (for debug only)
+        tries -- The maximum number of tries before aborting transfer
+
+        return -- a tuple of the number of checksum errors and short reads
+        '''
+        checksum_errors = 0
+        short_reads = 0
+        drain_timeout = DRAIN_TIMEOUT
+        csum_byte = bytearray(1)
+
+        for i in range(tries):
+            self.logger.debug('Get Image Block: try %d', i)
+
+            # calculate number of bytes (and the checksum) and expected transfer time
+            nbytes = len(buf)
+            timeout = self.camera_timeout_calc(nbytes + 1, retry=short_reads)
+
+            # not the first try, transmit checksum error so the camera will try again.
+            # Whatever is left of the failed block is discarded first (the camera
+            # waits for the reply), otherwise it would be read as the start of the
+            # block sent again.
+            if i > 0:
+                yield from self.drain_ops(drain_timeout)
+                yield from self.__block_reply_ops(CSUM_ERROR)
+            deadline = time.monotonic() + timeout
+
+            # read the data and checksum, timing the arrival of the first byte
+            self.logger.debug('Get Image Block: attempt to read %d bytes in %s seconds', nbytes, timeout)
+            received = yield (IO_RX_INTO, buf[:1], deadline)
+            tfirst = time.monotonic()
+            latency = None
+            if received and self.__ack_time is not None:
+                latency = tfirst - self.__ack_time
+                self.ack_rtt.add(latency)
+
+            received += yield (IO_RX_INTO, buf[1:], deadline)
+            csum_received = yield (IO_RX_INTO, csum_byte, deadline)
+            self.logger.debug('Get Image Block: finished reading data')
+
+            # not enough bytes, therefore transfer failed
+            if received != nbytes or csum_received != 1:
+                self.logger.debug('Not enough data returned before timeout')
+                short_reads += 1
+
+                # the rest of a block which stalled may arrive up to a block
+                # time later
+                drain_timeout = self.camera_timeout_calc(nbytes + 1, retry=short_reads)
+                continue
+
+            self.transfer_timing.add(latency, nbytes, time.monotonic() - tfirst)
+
+            # checksum verification disabled, exit the loop
+            if ignore_csum:
+                self.logger.debug('Checksum ignored, successfully received block')
+                yield from self.__block_reply_ops(CSUM_OK)
+                return checksum_errors, short_reads
+
+            csum = block_checksum(buf)
+            self.logger.debug('Checksum from camera: %.2x', csum_byte[0])
+            self.logger.debug('Checksum calculated: %.2x', csum)
+
+            # enough bytes and csum valid, exit the loop
+            if csum == csum_byte[0]:
+                self.logger.debug('Checksum OK, successfully received block')
+                yield from self.__block_reply_ops(CSUM_OK)
+                return checksum_errors, short_reads
+
+            # enough bytes and csum invalid, try again
+            self.logger.debug('Checksum ERROR')
+            checksum_errors += 1
+            drain_timeout = DRAIN_TIMEOUT
+
+        # too many retries passed, abort
+        self.logger.debug('Get Image Block: retries exhausted, abort transfer')
+        yield from self.__block_reply_ops(STOP_XFER)
+        raise AllSkyException('Too many errors during image sub-block transfer')
+
+    def image_block_ops(self, out, verify=True, first_block=0):
+        '''
+        Protocol: transfer an image from the camera, handing out each block
+        (with IO_BLOCK) as soon as it has been received and verified into its
+        place in the frame buffer
+
+        The protocol has no way to request a particular block, every transfer
+        starts with the first one. To continue a failed transfer, the blocks
+        before first_block are received again, acknowledged and discarded.
+
+        If a block cannot be received, the transfer is stopped and an
+        ImageTransferError is raised, with the blocks received so far. When
+        the blocks are not wanted any more, the driver must stop the transfer
+        with stop_transfer_ops().
+
+        out -- the frame buffer, from allocate_frame_buffer()
+        verify -- Verify the checksum of each block (disable for debug only)
+        first_block -- the first block to hand out (and store in out)
+        '''
+        block_bytes = BLOCK_PIXELS * PIXEL_SIZE
+        row_bytes = FRAME_WIDTH * PIXEL_SIZE
+        view = memoryview(out)
+        scratch = None
+
+        self.__ack_time = None
+        yield from self.command_ops(XFER_IMAGE, self.default_timeout)
+
+        for block in range(BLOCKS_PER_FRAME):
+            offset = block * block_bytes
+            if block < first_block:
+                if scratch is None:
+                    scratch = memoryview(bytearray(block_bytes))
+                target = scratch
+            else:
+                target = view[offset:offset + block_bytes]
+
+            try:
+                csum_errs, short = yield from self.__image_block_ops(target, ignore_csum=not verify)
+            except AllSkyException as ex:
+                raise ImageTransferError(str(ex), out, max(block, first_block)) from ex
+
+            if block < first_block:
+                continue
+
+            self.logger.debug('Received block %d', block + 1)
+            yield (IO_BLOCK, ImageBlock(
+                index=block,
+                offset=offset,
+                data=target,
+                rows=(offset + block_bytes) // row_bytes,
+                checksum_errors=csum_errs,
+                short_reads=short,
+            ))
+
+    def stop_transfer_ops(self, block):
+        '''
+        Protocol: stop a transfer from image_block_ops() which is no longer
+        wanted, unless it has finished
+
+        block -- the index of the last block handed out
+        '''
+        # the camera is already sending the next block
+        if block < BLOCKS_PER_FRAME - 1:
+            yield from self.__block_reply_ops(STOP_XFER)
+            yield from self.drain_ops()
+
+    def xfer_image_ops(self, progress_callback=None, verify=True, out=None, block_callback=None, resumes=0):
+        '''
+        Protocol: fetch an image from the camera, see AbstractCamera.xfer_image()
+
+        return -- the raw pixel data from the camera as a bytearray (out, if given)
+        '''
+        if out is None:
+            out = allocate_frame_buffer()
+
+        if len(out) != FRAME_BYTES:
+            raise AllSkyException('Frame buffer has wrong size: %d bytes' % len(out))
+
+        # Download Image
+        tstart = time.time()
+        ack_count = self.ack_rtt.count
+
+        retries = []
+        checksum_errors = 0
+        short_reads = 0
+        for attempt in range(resumes + 1):
+            blocks = self.image_block_ops(out, verify, first_block=len(retries))
+            result = None
+            error = None
+            try:
+                while True:
+                    try:
+                        op = blocks.throw(error) if error is not None else blocks.send(result)
+                    except StopIteration:
+                        break
+
+                    result = None
+                    error = None
+                    if op[0] != IO_BLOCK:
+                        try:
+                            result = yield op
+                        except Exception as ex:
+                            error = ex
+                        continue
+
+                    block = op[1]
+                    retries.append(block.checksum_errors + block.short_reads)
+                    checksum_errors += block.checksum_errors
+                    short_reads += block.short_reads
+
+                    # a callback which raises stops the transfer before the
+                    # camera is used again
+                    try:
+                        if block_callback is not None:
+                            block_callback(block)
+                        if progress_callback is not None:
+                            progress_callback(float(block.index + 1) / BLOCKS_PER_FRAME * 100)
+                    except BaseException:
+                        blocks.close()
+                        yield from self.stop_transfer_ops(block.index)
+                        raise
+
+                break
+            except ImageTransferError as ex:
+                self.xfer_stats = TransferStatistics(
+                    blocks=ex.blocks,
+                    retries=retries,
+                    checksum_errors=checksum_errors,
+                    short_reads=short_reads,
+                    duration=time.time() - tstart,
+                    ack_rtt=self.__mean_ack_rtt(self.ack_rtt.count - ack_count),
+                )
+
+                if attempt == resumes:
+                    raise
+
+                self.logger.warning('Image transfer failed after %d blocks, resuming', ex.blocks)
+                yield from self.drain_ops()
+
+        self.xfer_stats = TransferStatistics(
+            blocks=BLOCKS_PER_FRAME,
+            retries=retries,
+            checksum_errors=checksum_errors,
+            short_reads=short_reads,
+            duration=time.time() - tstart,
+            ack_rtt=self.__mean_ack_rtt(self.ack_rtt.count - ack_count),
+        )
+
+        self.logger.debug('Image download complete: %d blocks, %d retries', BLOCKS_PER_FRAME, sum(retries))
+        return out
+
+    def checksum(self, command):
+        '''
+        Return the checksum of an arbitrary command
+
+        command -- command string to checksum
+        '''
+        return command_checksum(command)
+
+    def hexify(self, s, join_char=':'):
+        '''
+        Print a string as hex values
+        '''
+        s = str(s)
+        return join_char.join(hex(ord(c))[2:] for c in s)
+
+    def bufdump(self, buf):
+        '''
+        Print a byte buffer in the convenient format of a hex-ified string and
+        the total length
+        '''
+        return '"%s" (%d bytes)' % (self.hexify(buf), len(buf))
+
+
+class AbstractCamera(CameraProtocol, ABC):
 
     def __init__(self):
         # set log level to debug
         logging.basicConfig(level=logging.DEBUG)
-        self.logger = logging.getLogger("all_sky_camera")
+        super().__init__()
+
+        # all received data passes through this buffer
+        self.reader = BufferedReader(self.transport_read_into)
 
     @abstractmethod
     def camera_tx(self, data):
@@ -76,16 +667,60 @@ class AbstractCamera(ABC):
         pass
 
     @abstractmethod
-    def camera_rx(self, nbytes, timeout=0.5):
+    def transport_read_into(self, buf, timeout):
+        '''
+        Receive data from the underlying device with a single read operation.
+
+        Waits up to timeout seconds for data to arrive, then receives as many
+        bytes as are available, up to len(buf).
+
+        buf -- the writable memoryview to receive into
+        timeout -- the maximum number of seconds to wait for data
+
+        return -- the number of bytes received, zero if nothing arrived
+        '''
+        pass
+
+    def close(self):
+        '''
+        Close the connection to the camera. The camera object cannot be used
+        afterwards, a new one must be created to connect again.
+        '''
+        pass
+
+    def perform_io(self, op):
+        '''Perform an IO_TX or IO_RX_INTO operation of the protocol (see CameraProtocol)'''
+        if op[0] == IO_TX:
+            return self.camera_tx(op[1])
+
+        return self.reader.readinto_exactly(op[1], op[2])
+
+    def camera_rx(self, nbytes, timeout=None):
         '''
         Receive data from camera with a timeout
 
         nbytes -- the maximum number of bytes to receive
         timeout -- the maximum number of seconds to wait for data
         '''
-        pass
+        if timeout is None:
+            timeout = self.default_timeout
+
+        return self.reader.read_exactly(nbytes, time.monotonic() + timeout)
+
+    def camera_rx_into(self, buf, timeout=None):
+        '''
+        Receive data from camera directly into a writable buffer with a timeout
+
+        buf -- the writable buffer (bytearray or memoryview) to fill completely
+        timeout -- the maximum number of seconds to wait for data
+
+        Returns the number of bytes received
+        '''
+        if timeout is None:
+            timeout = self.default_timeout
+
+        return self.reader.readinto_exactly(buf, time.monotonic() + timeout)
 
-    @abstractmethod
     def camera_rx_until(self, terminator, timeout=5.0):
         '''
         Receive data from a camera until a certain terminator character is received
@@ -93,21 +728,27 @@ class AbstractCamera(ABC):
         terminator -- the single character which terminates the receive operation
         timeout -- the maximum amount of time in seconds to wait
 
-        Returns all the data read up to (but not including) the terminator
+        Returns all the data read up to (but not including) the terminator,
+        or all the data received if the timeout passes first
         '''
-        pass
+        if isinstance(terminator, str):
+            terminator = terminator.encode()
 
-    @abstractmethod
-    def camera_timeout_calc(self, nbytes):
+        return self.reader.read_until(terminator, time.monotonic() + timeout)
+
+    def check_communications(self, count=1):
         '''
-        Calculate the required timeout to transmit a certain number of bytes
-        based on the particular implementation of the camera device.
+        Run the communications test command, which the camera answers with "O"
 
-        nbytes -- the number of bytes that will be transmitted
+        count -- the maximum number of attempts
 
-        return -- the time required to transmit in seconds
+        return -- True as soon as one test succeeds, False otherwise
         '''
-        pass
+        for _ in range(count):
+            if self.send_command(COM_TEST) and self.camera_rx(1) == b'O':
+                return True
+
+        return False
 
     def firmware_version(self):
         '''
@@ -119,12 +760,7 @@ class AbstractCamera(ABC):
         '''
         self.send_command(GET_FVERSION)
         data = self.camera_rx(2)
-
-        version_type = (data[0] & 0x80) and 'T' or 'R'
-        version_major = (data[0] & 0x7f)
-        version_minor = (data[1])
-
-        return '%s%d.%d' % (version_type, version_major, version_minor)
+        return parse_firmware_version(data)
 
     def serial_number(self):
         '''
@@ -185,19 +821,13 @@ class AbstractCamera(ABC):
         dark -- take a dark current exposure
         return -- the timestamp that the exposure was taken in ISO format
         '''
-        # Camera exposure time works in 100us units, with a maximum value
-        exptime = min(exposure / 100e-6, MAX_EXPOSURE)
-
-        # choose between light/dark exposure type
-        exptype = EXP_DARK_ONLY if dark else EXP_LIGHT_ONLY
-
-        exp = struct.pack('I', int(exptime))[:3]
-        com = (TAKE_IMAGE.encode() + exp[::-1] + BIN_1X1_FULL.encode() + exptype.encode())
+        com = take_image_command(exposure, dark)
 
         timestamp = datetime.datetime.utcnow()
 
         self.logger.debug('Exposure begin: command %s', self.hexify(com))
-        self.send_command(com)
+        if not self.send_command(com):
+            raise AllSkyException('Camera did not acknowledge the exposure command')
 
         # wait until the exposure is finished, with plenty of timing slack to
         # handle hardware latency on very short exposures (measurements show
@@ -208,99 +838,104 @@ class AbstractCamera(ABC):
 
         return timestamp
 
-    def __xfer_image_block(self, expected=4096, ignore_csum=False, tries=10):
+    def iter_image_blocks(self, out, verify=True, first_block=0):
         '''
-        Get one 'block' of image data. At full frame the camera returns image
-        data in chunks of 4096 pixels. For different imaging modes this value
-        will change, but the caller can simply change the value of expected.
+        Transfer an image from the camera, yielding each block as soon as it
+        has been received (and verified) into its place in the frame buffer,
+        so that it can be used while the rest of the frame is still arriving
 
-        This routine will automatically retry if a communication error occurs,
-        up to the maximum number of retries specified.
+        The protocol has no way to request a particular block, every transfer
+        starts with the first one. To continue a failed transfer, the blocks
+        before first_block are received again, acknowledged and discarded.
 
-        expected -- Number of pixels to retrieve
-        ignore_csum -- Always pass checksum without checking (for debug only)
-        tries -- The maximum number of tries before aborting transfer
+        If a block cannot be received, the transfer is stopped and an
+        ImageTransferError is raised, with the blocks received so far. The
+        transfer is also stopped if the generator is closed early.
 
-        return -- the raw pixel data from the camera as a Python array of unsigned bytes
-        '''
-        for i in range(tries):
-            self.logger.debug('Get Image Block: try %d', i)
+        out -- the frame buffer, from allocate_frame_buffer()
+        verify -- Verify the checksum of each block (disable for debug only)
+        first_block -- the first block to yield (and store in out)
 
-            # not the first try, transmit checksum error so the camera will try again
-            if i > 0:
-                self.camera_tx(CSUM_ERROR.encode())
+        Yields an ImageBlock for each block from first_block onwards
+        '''
+        stream = drive_protocol(self.image_block_ops(out, verify, first_block), self.perform_io)
+        block = None
+        try:
+            for block in stream:
+                yield block
+        except GeneratorExit:
+            # closed by the caller
+            stream.close()
+            run_protocol(self.stop_transfer_ops(block.index), self.perform_io)
+            raise
 
-            # calculate number of bytes and expected transfer time
-            nbytes = expected * PIXEL_SIZE
-            timeout = self.camera_timeout_calc(nbytes)
+    def verify_transfer(self, blocks):
+        '''
+        Check that image blocks arrive reliably: take a short dark exposure
+        and receive its first blocks, which must arrive without a single
+        checksum error or timeout, then stop the transfer
 
-            # read the data and checksum
-            self.logger.debug('Get Image Block: attempt to read %d bytes in %s seconds', nbytes, timeout)
-            data = self.camera_rx(nbytes, timeout)
-            csum_byte = self.camera_rx(1)
-            self.logger.debug('Get Image Block: finished reading data')
+        blocks -- the number of blocks to receive
 
-            # not enough bytes, therefore transfer failed
-            if len(data) != nbytes:
-                self.logger.debug('Not enough data returned before timeout')
-                continue
+        return -- True if the blocks arrived without errors
+        '''
+        try:
+            self.take_image(exposure=VERIFY_EXPOSURE, dark=True)
+            stream = self.iter_image_blocks(allocate_frame_buffer())
+            try:
+                for block in stream:
+                    if block.checksum_errors or block.short_reads:
+                        self.logger.debug('Test transfer error in block %d', block.index)
+                        return False
 
-            # calculate XOR-based checksum, convert data to ints, then xor
-            # Python has some weird sign extension thing, hence the extra bitwise ands
-            data = array.array('B', data)
-            csum = 0
-            for byte in data:
-                csum ^= (byte & 0xff)
-                csum &= 0xff
+                    if block.index + 1 >= blocks:
+                        return True
+            finally:
+                stream.close()
+        except (OSError, AllSkyException) as ex:
+            self.logger.debug('Test transfer failed: %s', str(ex))
+            return False
 
-            # convert csum_byte to an integer
-            csum_byte = ord(csum_byte)
+        return True
 
-            self.logger.debug('Checksum from camera: %.2x', csum_byte)
-            self.logger.debug('Checksum calculated: %.2x', csum)
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        '''
+        Discard everything received from the camera until nothing has arrived
+        for timeout seconds, for example the rest of a stopped transfer
 
-            # enough bytes and csum valid, exit the loop
-            if ignore_csum or csum == csum_byte:
-                self.logger.debug('Checksum OK, successfully received block')
-                self.camera_tx(CSUM_OK.encode())
-                return data
+        return -- the number of bytes discarded
+        '''
+        return run_protocol(self.drain_ops(timeout), self.perform_io)
 
-            # enough bytes and csum invalid, try again
-            self.logger.debug('Checksum ERROR')
+    def xfer_image(self, progress_callback=None, verify=True, out=None, block_callback=None, resumes=0):
+        '''
+        Fetch an image from the camera
 
-        # too many retries passed, abort
-        self.logger.debug('Get Image Block: retries exhausted, abort transfer')
-        self.camera_tx(STOP_XFER.encode())
-        raise AllSkyException('Too many errors during image sub-block transfer')
+        Every block is verified against the checksum sent by the camera, and
+        requested again if it does not match. Statistics about the transfer are
+        stored in the xfer_stats attribute afterwards.
 
+        The image is received in place into a single frame buffer, each block
+        being written at its offset without any intermediate copies. Pass the
+        same buffer again to reuse it for the next frame.
 
-
-    def xfer_image(self, progress_callback=None):
-        '''
-        Fetch an image from the camera
+        When a block cannot be received, the transfer can be resumed: the
+        image stays in the camera until the next exposure, so it is requested
+        again, and continues from the first missing block (see
+        iter_image_blocks). Otherwise an ImageTransferError is raised, which
+        holds the partial frame.
 
         progress_callback -- Function to be called after each block downloaded
+        verify -- Verify the checksum of each block (disable for debug only)
+        out -- an optional buffer from allocate_frame_buffer() to receive the image
+        block_callback -- Function to be called with an ImageBlock as each
+                          block arrives
+        resumes -- the maximum number of times to resume a failed transfer
 
-        return -- the raw pixel data from the camera as a Python array of unsigned bytes
+        return -- the raw pixel data from the camera as a bytearray (out, if given)
         '''
-        # Calculate number of sub-blocks expected
-        blocks_expected = 75 # (640 * 480) / 4096
-
-        # Download Image
-        self.send_command(XFER_IMAGE)
-
-        data = array.array('B')
-        blocks_complete = 0
-        for _ in range(blocks_expected):
-            data += self.__xfer_image_block(ignore_csum=True)
-            blocks_complete += 1
-            self.logger.debug('Received block %d', blocks_complete)
-            if progress_callback is not None:
-                progress_callback(float(blocks_complete) / blocks_expected * 100)
-
-        self.logger.debug('Image download complete')
-        return data
-
+        protocol = self.xfer_image_ops(progress_callback, verify, out, block_callback, resumes)
+        return run_protocol(protocol, self.perform_io)
 
     def send_command(self, command):
         '''
@@ -310,48 +945,17 @@ class AbstractCamera(ABC):
 
         return -- True on success, False otherwise
         '''
+        return run_protocol(self.command_ops(command, self.default_timeout), self.perform_io)
 
-        if isinstance(command, str):
-            command = command.encode()
-        csum = self.checksum(command)
-        data = command + csum.encode()
-
-        self.camera_tx(data)
-        rxsum = self.camera_rx(1)
-
-        if rxsum[0:1] != csum.encode():
-            self.logger.error('command %s csum %s rxsum %s', self.bufdump(command), self.bufdump(csum), self.bufdump(rxsum))
-
-        return rxsum[0:1] == csum.encode()
-
-    def checksum(self, command):
+    def measure_latency(self, count=10):
         '''
-        Return the checksum of an arbitrary command
-
-        command -- command string to checksum
+        Measure the command round trip latency with communications test commands
 
-        The checksum is simply calculated by complementing the byte, clearing the
-        most significant bit and XOR with the current checksum, going through each byte
-        in the command. For each individual command the checksum starts as 0
-        '''
-        cs = 0
-        for b in command:
-            if isinstance(command, str):
-                b = ord(b)
-            csb = ~b & 0x7F
-            cs = cs ^ csb
-        return chr(cs)
+        count -- the number of test commands to send
 
-    def hexify(self, s, join_char=':'):
-        '''
-        Print a string as hex values
+        return -- a dictionary summarizing the round trip times in seconds
         '''
-        s = str(s)
-        return join_char.join(hex(ord(c))[2:] for c in s)
+        for _ in range(count):
+            self.check_communications()
 
-    def bufdump(self, buf):
-        '''
-        Print a byte buffer in the convenient format of a hex-ified string and
-        the total length
-        '''
-        return '"%s" (%d bytes)' % (self.hexify(buf), len(buf))
\ No newline at end of file
+        return self.command_rtt.summary()
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+
+'''
+asyncio interface to the SBIG AllSky 340/340C
+
+The camera protocol is shared with AbstractCamera (see CameraProtocol), but
+every operation which waits for the camera is a coroutine. This allows a single event loop to drive
+several cameras (for example the day and night cameras) at the same time,
+including heater control and health checks, without threads:
+
+    day = await AsyncTcpCamera.create('moxa-day', 4001)
+    night = await AsyncTcpCamera.create('moxa-night', 4001)
+    image, ok = await asyncio.gather(
+        capture_image_camera(day, 0.001),
+        night.check_communications(),
+    )
+'''
+
+import asyncio
+import datetime
+import functools
+import time
+from abc import ABC, abstractmethod
+
+from pyallsky.abstract_camera import AllSkyException, CameraProtocol, IO_BLOCK, IO_TX
+from pyallsky.abstract_camera import parse_firmware_version, take_image_command
+from pyallsky.abstract_camera import CLOSE_SHUTTER, COM_TEST, DE_ENERGIZE, DRAIN_TIMEOUT
+from pyallsky.abstract_camera import EXPOSURE_DONE, GET_FVERSION, GET_SERIAL, HEATER_OFF, HEATER_ON
+from pyallsky.abstract_camera import OPEN_SHUTTER
+from pyallsky.imagecapture import AllSkyImage
+from pyallsky.tcp_camera import configure_socket, DEFAULT_SERIAL_BAUDRATE, TCP_RESPONSE_TIMEOUT_SECONDS
+from pyallsky.transfer_timing import serial_byte_rate
+
+# the guider commands may return an unlimited amount of text, so allow the
+# stream buffer to hold much more than the asyncio default of 64 KiB
+STREAM_LIMIT = 1024 * 1024
+
+# the maximum number of bytes camera_rx_until() reads at once
+RX_CHUNK_SIZE = 64 * 1024
+
+def exclusive(method):
+    '''
+    Decorator which serializes a camera operation with all other operations on
+    the same camera, since the protocol cannot interleave commands
+    '''
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        async with self.lock:
+            return await method(self, *args, **kwargs)
+
+    return wrapper
+
+async def run_protocol(protocol, perform):
+    '''
+    Run a protocol generator of CameraProtocol which hands out no image
+    blocks to completion, awaiting perform(op) for each of its I/O operations,
+    see pyallsky.abstract_camera.drive_protocol()
+
+    return -- the return value of the protocol
+    '''
+    result = None
+    error = None
+    while True:
+        try:
+            op = protocol.throw(error) if error is not None else protocol.send(result)
+        except StopIteration as ex:
+            return ex.value
+
+        result = None
+        error = None
+        if op[0] == IO_BLOCK:
+            raise AllSkyException('Unexpected image block from the camera protocol')
+
+        try:
+            result = await perform(op)
+        except Exception as ex:
+            error = ex
+
+
+class AsyncAbstractCamera(CameraProtocol, ABC):
+    '''
+    The camera protocol with asyncio I/O: the protocol itself is implemented
+    by CameraProtocol, this class only performs its I/O operations
+    '''
+
+    def __init__(self):
+        super().__init__()
+
+        # held for the duration of each camera operation
+        self.lock = asyncio.Lock()
+
+    @abstractmethod
+    async def camera_tx(self, data):
+        '''
+        Write data to the camera.
+
+        data -- the data to send
+        '''
+        pass
+
+    @abstractmethod
+    async def camera_rx_into(self, buf, timeout=None):
+        '''
+        Receive data from camera directly into a writable buffer with a timeout
+
+        buf -- the writable buffer (bytearray or memoryview) to fill completely
+        timeout -- the maximum number of seconds to wait for data
+
+        Returns the number of bytes received
+        '''
+        pass
+
+    @abstractmethod
+    async def camera_rx_until(self, terminator, timeout=5.0):
+        '''
+        Receive data from a camera until a certain terminator character is received
+
+        terminator -- the single character which terminates the receive operation
+        timeout -- the maximum amount of time in seconds to wait
+
+        Returns all the data read up to (but not including) the terminator,
+        or all the data received if the timeout passes first
+        '''
+        pass
+
+    async def perform_io(self, op):
+        '''Perform an IO_TX or IO_RX_INTO operation of the protocol (see CameraProtocol)'''
+        if op[0] == IO_TX:
+            return await self.camera_tx(op[1])
+
+        return await self.camera_rx_into(op[1], max(0.0, op[2] - time.monotonic()))
+
+    async def camera_rx(self, nbytes, timeout=None):
+        '''
+        Receive data from camera with a timeout
+
+        nbytes -- the maximum number of bytes to receive
+        timeout -- the maximum number of seconds to wait for data
+        '''
+        buf = bytearray(nbytes)
+        received = await self.camera_rx_into(buf, timeout)
+        return bytes(buf[:received])
+
+    async def send_command(self, command):
+        '''
+        Send a command to the camera and read back and check the checksum
+
+        command -- the command to send
+
+        return -- True on success, False otherwise
+        '''
+        return await run_protocol(self.command_ops(command, self.default_timeout), self.perform_io)
+
+    @exclusive
+    async def check_communications(self, count=1):
+        '''
+        Run the communications test command, which the camera answers with "O"
+
+        count -- the maximum number of attempts
+
+        return -- True as soon as one test succeeds, False otherwise
+        '''
+        for _ in range(count):
+            if await self.send_command(COM_TEST) and await self.camera_rx(1) == b'O':
+                return True
+
+        return False
+
+    @exclusive
+    async def firmware_version(self):
+        '''Request the firmware version, see AbstractCamera.firmware_version()'''
+        await self.send_command(GET_FVERSION)
+        data = await self.camera_rx(2)
+        return parse_firmware_version(data)
+
+    @exclusive
+    async def serial_number(self):
+        '''
+        Returns the camera's serial number (9 byte string)
+        '''
+        await self.send_command(GET_SERIAL)
+        return await self.camera_rx(9)
+
+    @exclusive
+    async def open_shutter(self):
+        '''
+        Open the camera shutter, then de-energize the shutter motor.
+        '''
+        await self.send_command(OPEN_SHUTTER)
+        await asyncio.sleep(0.2)
+        await self.send_command(DE_ENERGIZE)
+
+    @exclusive
+    async def close_shutter(self):
+        '''
+        Close the camera shutter, then de-energize the shutter motor.
+        '''
+        await self.send_command(CLOSE_SHUTTER)
+        await asyncio.sleep(0.2)
+        await self.send_command(DE_ENERGIZE)
+
+    @exclusive
+    async def activate_heater(self):
+        '''
+        Activate the built in heater
+        '''
+        await self.send_command(HEATER_ON)
+
+    @exclusive
+    async def deactivate_heater(self):
+        '''
+        Deactivate the built in heater
+        '''
+        await self.send_command(HEATER_OFF)
+
+    @exclusive
+    async def take_image(self, exposure=1.0, dark=False):
+        '''
+        Run an exposure of the CCD. Other tasks keep running while the
+        camera is exposing.
+
+        exposure -- exposure time in seconds
+        dark -- take a dark current exposure
+        return -- the timestamp that the exposure was taken
+        '''
+        com = take_image_command(exposure, dark)
+
+        timestamp = datetime.datetime.utcnow()
+
+        self.logger.debug('Exposure begin: command %r', com)
+        if not await self.send_command(com):
+            raise AllSkyException('Camera did not acknowledge the exposure command')
+
+        # same timing slack as AbstractCamera.take_image()
+        timeout = exposure + 15.0
+        await self.camera_rx_until(EXPOSURE_DONE, timeout)
+        self.logger.debug('Exposure complete')
+
+        return timestamp
+
+    async def drain(self, timeout=DRAIN_TIMEOUT):
+        '''
+        Discard everything received from the camera until nothing has arrived
+        for timeout seconds, see AbstractCamera.drain()
+
+        return -- the number of bytes discarded
+        '''
+        return await run_protocol(self.drain_ops(timeout), self.perform_io)
+
+    @exclusive
+    async def xfer_image(self, progress_callback=None, verify=True, out=None, block_callback=None, resumes=0):
+        '''
+        Fetch an image from the camera, see AbstractCamera.xfer_image()
+
+        progress_callback -- Function to be called after each block downloaded
+        verify -- Verify the checksum of each block (disable for debug only)
+        out -- an optional buffer from allocate_frame_buffer() to receive the image
+        block_callback -- Function to be called with an ImageBlock as each
+                          block arrives
+        resumes -- the maximum number of times to resume a failed transfer
+
+        return -- the raw pixel data from the camera as a bytearray (out, if given)
+        '''
+        protocol = self.xfer_image_ops(progress_callback, verify, out, block_callback, resumes)
+        return await run_protocol(protocol, self.perform_io)
+
+
+class AsyncTcpCamera(AsyncAbstractCamera):
+    '''
+    asyncio version of TcpCamera, using asyncio streams to talk to the
+    Moxa NPort 5150A serial to network convertor.
+
+    Use the create() coroutine to construct a connected instance.
+    '''
+
+    default_timeout = TCP_RESPONSE_TIMEOUT_SECONDS
+
+    def __init__(self, host, port, baudrate=DEFAULT_SERIAL_BAUDRATE):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.baudrate = baudrate
+        self.reader = None
+        self.writer = None
+
+        # data received after a terminator, not yet consumed
+        self.pending = bytearray()
+
+    @classmethod
+    async def create(cls, host, port, baudrate=DEFAULT_SERIAL_BAUDRATE):
+        '''Create an AsyncTcpCamera and connect it to the camera'''
+        camera = cls(host, port, baudrate)
+        await camera.connect()
+        return camera
+
+    async def connect(self):
+        '''Open the connection to the camera'''
+        self.reader, self.writer = await asyncio.open_connection(self.host, int(self.port), limit=STREAM_LIMIT)
+        configure_socket(self.writer.get_extra_info('socket'))
+
+    async def close(self):
+        '''Close the connection to the camera'''
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
+            self.reader = None
+
+    async def camera_tx(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def camera_rx_into(self, buf, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        view = memoryview(buf).cast('B')
+        received = min(len(self.pending), len(view))
+        view[:received] = self.pending[:received]
+        del self.pending[:received]
+
+        while received < len(view):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+
+            # read() returns whatever is buffered, so partial data is never
+            # lost when the timeout passes
+            try:
+                chunk = await asyncio.wait_for(self.reader.read(len(view) - received), remaining)
+            except asyncio.TimeoutError:
+                break
+
+            if not chunk:
+                raise ConnectionError('Connection closed by camera %s:%s' % (self.host, self.port))
+
+            view[received:received + len(chunk)] = chunk
+            received += len(chunk)
+
+        return received
+
+    async def camera_rx_until(self, terminator, timeout=5.0):
+        if isinstance(terminator, str):
+            terminator = terminator.encode()
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        scan = 0
+
+        while True:
+            index = self.pending.find(terminator, scan)
+            if index >= 0:
+                data = bytes(self.pending[:index])
+                del self.pending[:index + len(terminator)]
+                return data
+
+            # allow for a terminator which is split between two reads
+            scan = max(0, len(self.pending) - len(terminator) + 1)
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+
+            try:
+                chunk = await asyncio.wait_for(self.reader.read(RX_CHUNK_SIZE), remaining)
+            except asyncio.TimeoutError:
+                break
+
+            if not chunk:
+                raise ConnectionError('Connection closed by camera %s:%s' % (self.host, self.port))
+
+            self.pending += chunk
+
+        # the timeout passed, return everything received (like AbstractCamera)
+        data = bytes(self.pending)
+        self.pending.clear()
+        return data
+
+    def link_rate(self):
+        return serial_byte_rate(self.baudrate)
+
+
+async def capture_image_camera(camera, exposure, dark=False, out=None, resumes=0):
+    '''
+    Capture an image from an SBIG AllSky 340/340C camera, see
+    pyallsky.imagecapture.capture_image_camera()
+
+    camera -- an instance of AsyncAbstractCamera
+    exposure -- the exposure time to use (in seconds)
+    dark -- capture a dark current image
+    out -- an optional frame buffer to download the image into (reused in place)
+    resumes -- the maximum number of times to resume a failed image download
+
+    Returns an instance of AllSkyImage
+    '''
+    timestamp = await camera.take_image(exposure=exposure, dark=dark)
+    data = await camera.xfer_image(out=out, resumes=resumes)
+    return AllSkyImage(timestamp=timestamp, exposure=exposure, data=data)
@@ -0,0 +1,669 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks for the pyallsky capture and processing hot paths
+
+Run with: python -m pyallsky.benchmark
+
+Every stage of the pipeline (block checksums, image block assembly, dark
+subtraction, demosaicing, the stretch and 8-bit scaling, and each output
+format) is timed on synthetic 640x480 frames, and its peak memory use is
+measured with tracemalloc. The results can be written as JSON, and compared
+against a previous run (the baseline): any stage which has become slower or
+uses more memory than the baseline by more than the threshold is reported,
+and the run exits with a non-zero status. Small absolute slowdowns, and
+slowdowns within the timing noise of a stage, are allowed, and a stage which
+looks slower is timed again to confirm it before it is reported.
+
+The --compare option also runs the reference comparisons, which check the
+optimized implementations against the original ones and time both.
+'''
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from collections import namedtuple
+
+import numpy
+
+from pyallsky.abstract_camera import AbstractCamera
+from pyallsky.abstract_camera import block_checksum, command_checksum
+from pyallsky.abstract_camera import allocate_frame_buffer
+from pyallsky.abstract_camera import BLOCK_PIXELS, BLOCKS_PER_FRAME, FRAME_BYTES, FRAME_HEIGHT, FRAME_WIDTH, PIXEL_SIZE
+from pyallsky.emulator import EmulatorSettings, PtyEmulator, TcpEmulator
+from pyallsky.imagecapture import AllSkyImage
+from pyallsky.imageprocessor import AllSkyDeviceConfiguration, AllSkyImageProcessor
+from pyallsky.imageprocessor import circle_mask, circle_mask_index, create_circle_mask, stretch_dynamic_range
+from pyallsky.imageprocessor import display_8bit, maximize_dynamic_range, scale_to_8bit, subtract_dark
+from pyallsky.imageprocessor import demosaic, rgb2gray_uint16, DEMOSAIC_ALGORITHMS
+from pyallsky.util import setup_logging
+
+# format of the JSON results, increased on incompatible changes
+RESULTS_VERSION = 1
+
+# default allowed slowdown (or memory growth) relative to the baseline
+DEFAULT_THRESHOLD = 0.25
+
+# memory growth below this many bytes is never a regression, small
+# allocations vary between numpy versions and runs
+MEMORY_SLACK = 64 * 1024
+
+# a slowdown of less than this is never a regression (in seconds), the
+# timing of the fastest stages is dominated by scheduling noise
+TIME_SLACK = 0.0005
+
+# number of times the stages which look slower than the baseline are timed
+# again before they are reported: a slowdown of the whole machine during one
+# run (frequency scaling, other jobs) makes every stage slower, the code
+# only one
+DEFAULT_CONFIRM = 2
+
+# The timing and memory use of one benchmarked stage
+BenchmarkResult = namedtuple('BenchmarkResult', [
+    'name',             # the name of the stage
+    'repeat',           # the number of timed runs
+    'mean',             # mean time per run (in seconds)
+    'min',              # fastest run (in seconds)
+    'max',              # slowest run (in seconds)
+    'peak_memory',      # peak memory allocated during one run (in bytes)
+    'median',           # median time per run (in seconds), None in older results
+], defaults=(None, ))
+
+def make_blocks(count=BLOCKS_PER_FRAME):
+    '''Create a list of random image blocks, the size of a full frame transfer'''
+    nbytes = BLOCK_PIXELS * PIXEL_SIZE
+    return [os.urandom(nbytes) for _ in range(count)]
+
+def make_frame(color=False, seed=0):
+    '''
+    Create a synthetic 640x480 16-bit frame with a sky-like distribution of
+    pixel values (mostly dark with a long bright tail)
+
+    color -- create a 3 channel (debayered) frame instead of a mono frame
+    '''
+    shape = (FRAME_HEIGHT, FRAME_WIDTH, 3) if color else (FRAME_HEIGHT, FRAME_WIDTH)
+    rng = numpy.random.default_rng(seed)
+    return rng.gamma(2.0, 2000.0, size=shape).clip(0, 65535).astype(numpy.uint16)
+
+def percentile_stretch(data, mask, pct=(2.5, 97.5)):
+    '''The original numpy.percentile stretch, as a reference implementation'''
+    image = data.astype(numpy.float32)
+    lower, upper = numpy.percentile(image[mask], pct)
+    image -= lower
+    image /= (upper - lower)
+    image[(image > 1.0)] = 1.0
+    image[(image < 0.0)] = 0.0
+    image *= 65535.0
+    return image.astype(numpy.uint16)
+
+def benchmark_stretch(color=False, repeat=20):
+    '''
+    Compare the histogram stretch against the numpy.percentile reference
+
+    color -- use a debayered (3 channel) frame
+    repeat -- the number of frames to stretch
+
+    return -- a tuple of the reference and histogram times per frame in seconds
+    '''
+    data = make_frame(color)
+    mask = create_circle_mask(data)
+    index = circle_mask_index(tuple(data.shape[0:2]))
+
+    expected = percentile_stretch(data, mask)
+    result, _ = stretch_dynamic_range(data, index)
+    if not numpy.array_equal(expected, result):
+        raise RuntimeError('Histogram stretch does not match the reference')
+
+    reference = timeit.timeit(lambda: percentile_stretch(data, mask), number=repeat) / repeat
+    histogram = timeit.timeit(lambda: stretch_dynamic_range(data, index), number=repeat) / repeat
+    return reference, histogram
+
+def benchmark_display(color=False, repeat=20):
+    '''
+    Compare the lookup table display conversion against the separate
+    stretch and 8-bit scaling steps
+
+    color -- use a debayered (3 channel) frame
+    repeat -- the number of frames to convert
+
+    return -- a tuple of the separate and lookup table times per frame in seconds
+    '''
+    data = make_frame(color)
+    index = circle_mask_index(tuple(data.shape[0:2]))
+
+    def separate():
+        return scale_to_8bit(maximize_dynamic_range(data, index))
+
+    if not numpy.array_equal(separate(), display_8bit(data, index)):
+        raise RuntimeError('Lookup table display conversion does not match the reference')
+
+    reference = timeit.timeit(separate, number=repeat) / repeat
+    lut = timeit.timeit(lambda: display_8bit(data, index), number=repeat) / repeat
+    return reference, lut
+
+def peak_memory(func):
+    '''Return the peak memory allocated while running func, in bytes'''
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchmark_demosaic(repeat=10):
+    '''
+    Time each demosaic algorithm producing both the color and the grayscale
+    image, as the image processor does. When the colour-demosaicing package
+    is installed, the Malvar result is checked against it and its own time
+    is included as the reference.
+
+    repeat -- the number of frames to demosaic
+
+    return -- a dictionary of algorithm to (time per frame in seconds, peak memory in bytes)
+    '''
+    data = make_frame()
+    results = {}
+
+    try:
+        from colour_demosaicing import demosaicing_CFA_Bayer_Malvar2004
+    except ImportError:
+        demosaicing_CFA_Bayer_Malvar2004 = None
+
+    if demosaicing_CFA_Bayer_Malvar2004 is not None:
+        def reference():
+            rgb = demosaicing_CFA_Bayer_Malvar2004(data, 'BGGR')
+            return rgb, rgb2gray_uint16(rgb)
+
+        rgb, gray = reference()
+        result = demosaic(data, 'malvar', rgb=True, gray=True)
+        if not numpy.array_equal(result.rgb, numpy.rint(rgb.clip(0, 65535))):
+            raise RuntimeError('Malvar demosaic does not match colour-demosaicing')
+        if not numpy.allclose(result.gray, gray, rtol=1e-5, atol=0.01):
+            raise RuntimeError('Demosaic grayscale does not match colour-demosaicing')
+
+        elapsed = timeit.timeit(reference, number=repeat) / repeat
+        results['colour-demosaicing'] = (elapsed, peak_memory(reference))
+
+    for algorithm in DEMOSAIC_ALGORITHMS:
+        def run():
+            return demosaic(data, algorithm, rgb=True, gray=True)
+
+        elapsed = timeit.timeit(run, number=repeat) / repeat
+        results[algorithm] = (elapsed, peak_memory(run))
+
+    return results
+
+def benchmark_block_checksum(repeat=100):
+    '''
+    Time the checksum verification of all blocks in a full frame
+
+    repeat -- the number of frames to checksum
+
+    return -- the mean time per frame in seconds
+    '''
+    blocks = make_blocks()
+
+    def run():
+        for block in blocks:
+            block_checksum(block)
+
+    return timeit.timeit(run, number=repeat) / repeat
+
+def benchmark_capture(transport='tcp', settings=None, count=3, exposure=0.01):
+    '''
+    Time complete captures (take_image and xfer_image) from an emulated
+    camera, through the real camera classes and a local TCP socket or pty
+
+    transport -- 'tcp' (TcpCamera) or 'pty' (SerialCamera)
+    settings -- an EmulatorSettings (default: unpaced, no errors)
+    count -- the number of frames to capture
+    exposure -- the exposure time of each frame (in seconds)
+
+    return -- a tuple of the mean take_image and xfer_image times in seconds
+    '''
+    # imported here, the camera classes are not needed by the other benchmarks
+    from pyallsky.serial_camera import SerialCamera
+    from pyallsky.tcp_camera import TcpCamera
+
+    settings = settings or EmulatorSettings(readout_time=0.0, seed=0)
+    if transport == 'tcp':
+        emulator = TcpEmulator(settings).start()
+        host, port = emulator.address
+        camera = TcpCamera(host, port)
+    else:
+        emulator = PtyEmulator(settings).start()
+        camera = SerialCamera(emulator.device)
+
+    try:
+        buf = allocate_frame_buffer()
+        take = 0.0
+        xfer = 0.0
+        for _ in range(count):
+            tstart = time.monotonic()
+            camera.take_image(exposure)
+            take += time.monotonic() - tstart
+
+            tstart = time.monotonic()
+            camera.xfer_image(out=buf)
+            xfer += time.monotonic() - tstart
+
+            if bytes(buf) != emulator.camera.frame:
+                raise RuntimeError('Captured frame does not match the emulated camera')
+    finally:
+        emulator.stop()
+
+    return take / count, xfer / count
+
+class MemoryCamera(AbstractCamera):
+    '''
+    A camera which replays a prepared image transfer from memory, so that
+    xfer_image() can be timed without any device or socket in the way.
+
+    Every acknowledgement is assumed to be CSUM_OK, the replayed stream is
+    the checksum echo of the transfer command followed by every block and
+    its checksum.
+    '''
+
+    def __init__(self, blocks):
+        super().__init__()
+        stream = bytearray(command_checksum(b'X').encode())
+        for block in blocks:
+            stream += block
+            stream.append(block_checksum(block))
+
+        self.stream = memoryview(bytes(stream))
+        self.position = len(self.stream)
+
+    def camera_tx(self, data):
+        # restart the replay on each transfer command
+        if data[0:1] == b'X':
+            self.position = 0
+
+    def transport_read_into(self, buf, timeout):
+        nbytes = min(len(buf), len(self.stream) - self.position)
+        buf[:nbytes] = self.stream[self.position:self.position + nbytes]
+        self.position += nbytes
+        return nbytes
+
+    def link_rate(self):
+        return float(len(self.stream))
+
+def make_processor(debayer=True):
+    '''
+    Create an AllSkyImageProcessor for a synthetic raw frame, with the
+    configuration of a color camera at night
+    '''
+    config = AllSkyDeviceConfiguration(
+        device='memory',
+        exposure=60.0,
+        dark=False,
+        debayer=debayer,
+        grayscale=False,
+        postprocess=True,
+        rotate180=False,
+        overlay=True,
+        heating=False,
+    )
+    image = AllSkyImage(timestamp=datetime.datetime(2020, 1, 1), exposure=60.0, data=make_frame().tobytes())
+    return AllSkyImageProcessor('bench', image, config)
+
+def stage_block_checksum(workdir):
+    '''Checksum every block of a frame'''
+    blocks = make_blocks()
+
+    def run():
+        for block in blocks:
+            block_checksum(block)
+
+    return run
+
+def stage_xfer_image(workdir):
+    '''Receive and verify every block of a frame into a reused frame buffer'''
+    camera = MemoryCamera(make_blocks())
+    buf = allocate_frame_buffer()
+    return lambda: camera.xfer_image(out=buf)
+
+def stage_subtract_dark(workdir):
+    '''Subtract a dark of the same exposure time'''
+    data = make_frame(seed=1)
+    dark = AllSkyImage(timestamp=None, exposure=60.0, data=make_frame(seed=2).tobytes())
+    return lambda: subtract_dark(data, dark, 60.0)
+
+def stage_subtract_dark_scaled(workdir):
+    '''Subtract a dark scaled from a different exposure time (the dark library)'''
+    data = make_frame(seed=1)
+    dark = AllSkyImage(timestamp=None, exposure=30.0, data=make_frame(seed=2).tobytes())
+    return lambda: subtract_dark(data, dark, 60.0)
+
+def make_stage_demosaic(algorithm):
+    '''Create the stage for a demosaic algorithm, color and grayscale in one pass'''
+    def stage(workdir):
+        data = make_frame()
+        return lambda: demosaic(data, algorithm, rgb=True, gray=True)
+
+    return stage
+
+def stage_create_circle_mask(workdir):
+    '''Compute the circular sky mask (bypassing the per-process cache)'''
+    data = make_frame()
+
+    def run():
+        circle_mask.cache_clear()
+        return create_circle_mask(data)
+
+    return run
+
+def make_stage_maximize_dynamic_range(color):
+    '''Create the stage for the percentile stretch of a mono or color frame'''
+    def stage(workdir):
+        data = make_frame(color)
+        index = circle_mask_index(tuple(data.shape[0:2]))
+        return lambda: maximize_dynamic_range(data, index)
+
+    return stage
+
+def stage_scale_to_8bit(workdir):
+    '''Scale a stretched color frame to 8 bits'''
+    data = make_frame(color=True)
+    return lambda: scale_to_8bit(data)
+
+def stage_display_8bit(workdir):
+    '''Stretch, gamma correct and scale a color frame to 8 bits in one step'''
+    data = make_frame(color=True)
+    index = circle_mask_index(tuple(data.shape[0:2]))
+    return lambda: display_8bit(data, index, gamma=2.2)
+
+def make_stage_save(extension):
+    '''
+    Create the stage for writing one output format. The processing products
+    are computed beforehand, so only the encoding and writing is timed.
+    '''
+    def stage(workdir):
+        processor = make_processor()
+        processor.gray
+        processor.display
+        filename = os.path.join(workdir, 'bench' + extension)
+
+        def run():
+            # FITS files are appended to, start from scratch every time
+            if os.path.exists(filename):
+                os.unlink(filename)
+            processor.save(filename)
+
+        return run
+
+    return stage
+
+def stage_process_frame(workdir):
+    '''Process a raw frame from scratch into the FITS and JPEG products'''
+    def run():
+        processor = make_processor()
+        processor.gray
+        processor.display
+
+    return run
+
+# Every stage of the suite, in pipeline order: the name and a function which
+# prepares the stage's data in a working directory, and returns the
+# (argumentless) function to time
+STAGES = [
+    ('block_checksum', stage_block_checksum),
+    ('xfer_image', stage_xfer_image),
+    ('subtract_dark', stage_subtract_dark),
+    ('subtract_dark_scaled', stage_subtract_dark_scaled),
+] + [
+    ('demosaic_' + algorithm, make_stage_demosaic(algorithm)) for algorithm in DEMOSAIC_ALGORITHMS
+] + [
+    ('create_circle_mask', stage_create_circle_mask),
+    ('maximize_dynamic_range_mono', make_stage_maximize_dynamic_range(False)),
+    ('maximize_dynamic_range_color', make_stage_maximize_dynamic_range(True)),
+    ('scale_to_8bit', stage_scale_to_8bit),
+    ('display_8bit', stage_display_8bit),
+    ('process_frame', stage_process_frame),
+    ('save_raw', make_stage_save('.raw')),
+    ('save_fits', make_stage_save('.fits')),
+    ('save_fits_rice', make_stage_save('.fits.fz')),
+    ('save_jpeg', make_stage_save('.jpg')),
+]
+
+def time_stage(name, func, repeat):
+    '''
+    Time a function, after one untimed warm-up run, and measure its peak
+    memory use in a separate run (tracemalloc slows down allocations)
+
+    return -- an instance of BenchmarkResult
+    '''
+    func()
+
+    timings = []
+    for _ in range(repeat):
+        tstart = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - tstart)
+
+    return BenchmarkResult(
+        name=name,
+        repeat=repeat,
+        mean=sum(timings) / repeat,
+        min=min(timings),
+        max=max(timings),
+        peak_memory=peak_memory(func),
+        median=statistics.median(timings),
+    )
+
+def run_suite(repeat=20, select=None):
+    '''
+    Run the benchmark suite
+
+    repeat -- the number of timed runs of each stage
+    select -- only run the stages whose name contains one of these strings
+
+    return -- a list of BenchmarkResult, in suite order
+    '''
+    workdir = tempfile.mkdtemp(prefix='pyallsky-benchmark-')
+    try:
+        results = []
+        for name, stage in STAGES:
+            if select and not any(pattern in name for pattern in select):
+                continue
+
+            results.append(time_stage(name, stage(workdir), repeat))
+
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+def results_to_json(results):
+    '''Convert a list of BenchmarkResult to a JSON serializable dictionary'''
+    return {
+        'version': RESULTS_VERSION,
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+        },
+        'results': {result.name: result._asdict() for result in results},
+    }
+
+def load_baseline(filename):
+    '''
+    Read the results of a previous run, as written by --output
+
+    return -- a dictionary of stage name to BenchmarkResult
+    '''
+    with open(filename, 'r') as f:
+        baseline = json.load(f)
+
+    if baseline.get('version') != RESULTS_VERSION:
+        raise ValueError('Unsupported benchmark results version in %s' % filename)
+
+    return {name: BenchmarkResult(**result) for name, result in baseline['results'].items()}
+
+def spread(result):
+    '''
+    How far the typical run of a stage is from its fastest run (in seconds),
+    a measure of the timing noise of the stage
+    '''
+    typical = result.median if result.median is not None else result.mean
+    return max(0.0, typical - result.min)
+
+def stage_regressions(result, base, threshold=DEFAULT_THRESHOLD, slack=TIME_SLACK):
+    '''
+    Compare the result of one stage against its baseline. The fastest run is
+    compared, it is much less affected by other activity on the machine than
+    the mean. It may be slower by the threshold, plus the absolute slack,
+    plus the timing noise (see spread()) of the noisier of the two.
+
+    return -- a list of messages describing each regression
+    '''
+    regressions = []
+
+    limit = base.min * (1.0 + threshold) + slack + max(spread(result), spread(base))
+    if result.min > limit:
+        regressions.append('%s: %.3f ms, baseline %.3f ms (%+.0f%%)' % (
+            result.name, result.min * 1e3, base.min * 1e3, (result.min / base.min - 1.0) * 100))
+
+    if result.peak_memory > base.peak_memory * (1.0 + threshold) + MEMORY_SLACK:
+        regressions.append('%s: %.1f MiB peak memory, baseline %.1f MiB' % (
+            result.name, result.peak_memory / 2**20, base.peak_memory / 2**20))
+
+    return regressions
+
+def find_regressions(results, baseline, threshold=DEFAULT_THRESHOLD, slack=TIME_SLACK):
+    '''
+    Compare results against a baseline (see stage_regressions()). Stages
+    which are not in the baseline are ignored.
+
+    results -- a list of BenchmarkResult
+    baseline -- a dictionary of stage name to BenchmarkResult
+    threshold -- the allowed fractional increase in time or memory
+    slack -- the allowed absolute increase in time (in seconds)
+
+    return -- a list of messages describing each regression
+    '''
+    regressions = []
+    for result in results:
+        base = baseline.get(result.name)
+        if base is not None:
+            regressions += stage_regressions(result, base, threshold, slack)
+
+    return regressions
+
+def confirm_regressions(results, baseline, threshold=DEFAULT_THRESHOLD, slack=TIME_SLACK,
+                        repeat=20, confirm=DEFAULT_CONFIRM):
+    '''
+    Time the stages which look slower than the baseline again, up to confirm
+    times, keeping the fastest run and the lowest peak memory of each, so
+    that only a persistent regression is reported
+
+    return -- the results, with the stages which were timed again updated
+    '''
+    stages = dict(STAGES)
+    results = list(results)
+    workdir = tempfile.mkdtemp(prefix='pyallsky-benchmark-')
+    try:
+        for _ in range(confirm):
+            suspects = [i for i, result in enumerate(results)
+                        if result.name in baseline and
+                        stage_regressions(result, baseline[result.name], threshold, slack)]
+            if not suspects:
+                break
+
+            for i in suspects:
+                result = results[i]
+                logging.warning('Timing %s again to confirm a regression', result.name)
+                again = time_stage(result.name, stages[result.name](workdir), result.repeat)
+                if again.min < result.min:
+                    result = again._replace(peak_memory=min(again.peak_memory, result.peak_memory))
+                else:
+                    result = result._replace(peak_memory=min(again.peak_memory, result.peak_memory))
+
+                results[i] = result
+
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+def run_comparisons():
+    '''Run the reference comparisons and print the results'''
+    per_frame = benchmark_block_checksum()
+    print('block_checksum: %.3f ms per frame (%d blocks)' % (per_frame * 1e3, BLOCKS_PER_FRAME))
+
+    for name, color in (('mono', False), ('debayered', True)):
+        reference, histogram = benchmark_stretch(color)
+        print('stretch (%s): percentile %.3f ms, histogram %.3f ms per frame' % (name, reference * 1e3, histogram * 1e3))
+
+    for name, color in (('mono', False), ('debayered', True)):
+        reference, lut = benchmark_display(color)
+        print('display (%s): separate steps %.3f ms, lookup table %.3f ms per frame' % (name, reference * 1e3, lut * 1e3))
+
+    for algorithm, (elapsed, peak) in benchmark_demosaic().items():
+        print('demosaic (%s): %.3f ms per frame, %.1f MiB peak' % (algorithm, elapsed * 1e3, peak / 2**20))
+
+    for transport in ('tcp', 'pty'):
+        take, xfer = benchmark_capture(transport)
+        print('capture (%s emulator): take_image %.3f ms, xfer_image %.3f ms per frame (%.1f MB/s)' %
+              (transport, take * 1e3, xfer * 1e3, FRAME_BYTES / xfer / 1e6))
+
+def main(argv=None):
+    '''Run the benchmark suite, and compare it against a baseline'''
+    desc = '''Benchmark the pyallsky capture and processing stages'''
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('-r', '--repeat', type=int, help='Number of timed runs of each stage', default=20)
+    parser.add_argument('-k', '--select', nargs='+', help='Only run stages whose name contains one of these strings')
+    parser.add_argument('-o', '--output', help='Write the results to a JSON file')
+    parser.add_argument('-b', '--baseline', help='Compare the results against a previous JSON file')
+    parser.add_argument('-t', '--threshold', type=float, help='Allowed slowdown relative to the baseline (fraction)', default=DEFAULT_THRESHOLD)
+    parser.add_argument('--slack', type=float, help='Allowed slowdown relative to the baseline (seconds)', default=TIME_SLACK)
+    parser.add_argument('--confirm', type=int, help='Number of times to time apparent regressions again', default=DEFAULT_CONFIRM)
+    parser.add_argument('--compare', action='store_true', help='Also run the reference comparisons')
+    args = parser.parse_args(argv)
+
+    # the per-block debug messages would be timed too
+    setup_logging(logging.WARN)
+
+    # read the baseline first, do not run the suite for nothing
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+
+    results = run_suite(repeat=args.repeat, select=args.select)
+    if baseline:
+        results = confirm_regressions(results, baseline, args.threshold, args.slack, args.repeat, args.confirm)
+
+    for result in results:
+        line = '%-30s %9.3f ms mean %9.3f ms min %8.1f MiB peak' % (
+            result.name, result.mean * 1e3, result.min * 1e3, result.peak_memory / 2**20)
+        base = baseline.get(result.name)
+        if base is not None:
+            line += '  (baseline %.3f ms, %+.0f%%)' % (base.min * 1e3, (result.min / base.min - 1.0) * 100)
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results_to_json(results), f, indent=2)
+            f.write('\n')
+
+    if args.compare:
+        run_comparisons()
+
+    regressions = find_regressions(results, baseline, args.threshold, args.slack)
+    for message in regressions:
+        print('REGRESSION %s' % message)
+
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
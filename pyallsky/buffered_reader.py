@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+'''
+Buffered receive layer shared by all camera transports
+'''
+
+import time
+
+# default size of the internal receive buffer, large enough to hold several
+# full image blocks (8192 bytes of pixels + 1 byte checksum)
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+# requests at least this large bypass the internal buffer and are received
+# directly into the destination, to avoid copying image data twice
+DIRECT_READ_THRESHOLD = 1024
+
+class BufferedReader(object):
+    '''
+    Buffered reader sitting between a camera transport and the camera protocol
+
+    The transport only needs to provide a single primitive, read_into(buf, timeout),
+    which waits up to timeout seconds for data, then receives as many bytes as
+    are available (up to len(buf)) into buf and returns the number received,
+    zero when nothing arrived in time.
+
+    Data is received in large chunks into an internal buffer, and handed out
+    from there by read_exactly() and read_until(). Each call takes an absolute
+    deadline on the time.monotonic() clock, so that a wall clock step cannot
+    shorten or extend a read.
+
+    The internal buffer is a flat bytearray with a read and a write position.
+    When the write position reaches the end, the unread bytes are moved back
+    to the start, which keeps searching for a terminator a single bytes.find()
+    call over contiguous memory.
+    '''
+
+    def __init__(self, read_into, size=DEFAULT_BUFFER_SIZE):
+        '''
+        Create a BufferedReader
+
+        read_into -- the transport receive method, see above
+        size -- the initial size of the internal buffer in bytes
+        '''
+        self.read_into = read_into
+        self.buf = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def buffered(self):
+        '''Return the number of bytes received but not yet consumed'''
+        return self.end - self.start
+
+    def clear(self):
+        '''Discard all buffered data'''
+        self.start = 0
+        self.end = 0
+
+    def __fill(self, deadline):
+        '''
+        Receive more data into the internal buffer
+
+        deadline -- the time.monotonic() time at which to give up
+
+        return -- the number of bytes received
+        '''
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return 0
+
+        # make room at the end of the buffer, growing it only when it is full
+        # of unread data (for example a long guider status message)
+        if self.end == len(self.buf):
+            unread = self.buffered()
+            if unread == len(self.buf):
+                self.buf.extend(bytearray(len(self.buf)))
+            else:
+                self.buf[:unread] = self.buf[self.start:self.end]
+                self.start = 0
+                self.end = unread
+
+        count = self.read_into(memoryview(self.buf)[self.end:], remaining)
+        self.end += count
+        return count
+
+    def __consume_into(self, view):
+        '''Copy as much buffered data as possible into view, return the count'''
+        count = min(self.buffered(), len(view))
+        view[:count] = self.buf[self.start:self.start + count]
+        self.start += count
+
+        # reset the positions whenever the buffer empties, so that the next
+        # receive can use the full buffer without moving anything
+        if self.start == self.end:
+            self.clear()
+
+        return count
+
+    def readinto_exactly(self, dest, deadline):
+        '''
+        Receive exactly len(dest) bytes into the writable buffer dest
+
+        dest -- the bytearray or memoryview to fill
+        deadline -- the time.monotonic() time at which to give up
+
+        return -- the number of bytes received, which is only less than
+                  len(dest) if the deadline passed
+        '''
+        view = memoryview(dest).cast('B')
+        nbytes = len(view)
+        received = self.__consume_into(view)
+
+        while received < nbytes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            # large requests go straight into the destination; the transport
+            # never returns more than asked for, so nothing is over-read
+            if nbytes - received >= DIRECT_READ_THRESHOLD:
+                received += self.read_into(view[received:], remaining)
+                continue
+
+            if self.__fill(deadline):
+                received += self.__consume_into(view[received:])
+
+        return received
+
+    def read_exactly(self, nbytes, deadline):
+        '''
+        Receive exactly nbytes bytes
+
+        nbytes -- the number of bytes to receive
+        deadline -- the time.monotonic() time at which to give up
+
+        return -- the data as bytes, which is only shorter than nbytes if the
+                  deadline passed
+        '''
+        buf = bytearray(nbytes)
+        received = self.readinto_exactly(buf, deadline)
+        del buf[received:]
+        return bytes(buf)
+
+    def read_until(self, terminator, deadline):
+        '''
+        Receive data until the terminator is found
+
+        terminator -- the bytes which terminate the receive operation
+        deadline -- the time.monotonic() time at which to give up
+
+        return -- all the data up to (but not including) the terminator, which
+                  is consumed. If the deadline passes first, all data received
+                  so far is returned instead.
+        '''
+        scan = self.start
+        while True:
+            index = self.buf.find(terminator, scan, self.end)
+            if index >= 0:
+                data = bytes(self.buf[self.start:index])
+                self.start = index + len(terminator)
+                if self.start == self.end:
+                    self.clear()
+                return data
+
+            # do not search the same data twice, but allow for a terminator
+            # which is split between two receives
+            scan = max(self.start, self.end - len(terminator) + 1)
+            offset = scan - self.start
+
+            if not self.__fill(deadline) and deadline <= time.monotonic():
+                data = bytes(self.buf[self.start:self.end])
+                self.clear()
+                return data
+
+            # the buffer may have been compacted while filling
+            scan = self.start + offset
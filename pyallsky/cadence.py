@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+'''
+Frame cadence for the allsky_scheduler: exposure start times on a fixed grid
+
+The grid is anchored to a wall clock boundary (the start of a minute, so that
+images get predictable timestamps) and then followed on the monotonic clock,
+so the start times neither drift with the time taken by each frame nor jump
+when the system clock is set. When the wall clock is stepped (by NTP, or
+across a suspend/resume cycle, during which the monotonic clock stops) the
+grid is anchored to the wall clock again.
+
+A frame which takes longer than the interval makes the following slots late.
+What happens to them is an explicit policy:
+
+    skip     -- slots which are later than the grace time are skipped, the
+                next frame starts at the next slot of the grid
+    catch-up -- late slots are run immediately, one after the other, until
+                the frames are back on the grid (at most max_catch_up slots
+                behind, older slots are skipped)
+
+The clock is injectable: FakeClock makes the schedule deterministic for
+testing and dry runs.
+'''
+
+import datetime
+import logging
+import math
+import time
+from collections import namedtuple
+
+from pyallsky.util import RollingStatistics
+
+# policies for late slots
+SKIP = 'skip'
+CATCH_UP = 'catch-up'
+POLICIES = (SKIP, CATCH_UP)
+
+# a slot started less than this late is run rather than skipped (in seconds)
+DEFAULT_GRACE = 5.0
+
+# the catch-up policy runs at most this many slots behind the grid
+DEFAULT_MAX_CATCH_UP = 3
+
+# the grid is anchored to a multiple of this many seconds of the wall clock
+DEFAULT_ALIGN = 60.0
+
+# a change of the wall clock relative to the monotonic clock larger than this
+# is a clock step, and the grid is anchored again (in seconds)
+STEP_THRESHOLD = 1.0
+
+# the longest single sleep, so that clock steps are noticed while waiting
+MAX_SLEEP = 5.0
+
+# number of recent slots kept for the jitter and lateness statistics
+DEFAULT_WINDOW = 100
+
+# One slot of the grid, as returned by Cadence.wait()
+Tick = namedtuple('Tick', [
+    'slot',             # number of the slot since the grid was anchored
+    'utctime',          # the nominal UTC datetime of the slot
+    'deadline',         # time.monotonic() value at which the next slot is due
+    'delay',            # how late the slot started (in seconds)
+    'late',             # True if the slot was late because a frame overran it
+    'skipped',          # number of slots skipped before this one
+])
+
+class SystemClock(object):
+    '''The real monotonic and wall clocks'''
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def utcnow(self):
+        return datetime.datetime.utcnow()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class FakeClock(object):
+    '''
+    A clock which only moves when told to: sleep() advances it instantly,
+    advance() simulates work and step() simulates a wall clock step
+    '''
+
+    def __init__(self, utctime=None, monotonic=1000.0):
+        '''
+        Create a FakeClock
+
+        utctime -- the starting UTC datetime (default: the epoch)
+        monotonic -- the starting value of the monotonic clock
+        '''
+        self.now = monotonic
+        self.offset = (utctime or datetime.datetime(1970, 1, 1)) - datetime.timedelta(seconds=monotonic)
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def utcnow(self):
+        return self.offset + datetime.timedelta(seconds=self.now)
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        '''Move both clocks forward, as if work took this long'''
+        self.now += seconds
+
+    def step(self, seconds):
+        '''Move the wall clock only, as if it was set (or after a suspend)'''
+        self.offset += datetime.timedelta(seconds=seconds)
+
+class Cadence(object):
+    '''
+    Issues frame start times on a fixed grid of the monotonic clock, and
+    measures how closely they are kept:
+
+    jitter -- how late each on-time slot started after the sleep (the
+              scheduling error of the operating system)
+    lateness -- how late each late slot started (because a frame overran)
+    skipped -- the total number of slots skipped
+    '''
+
+    def __init__(self, interval, policy=SKIP, grace=DEFAULT_GRACE, max_catch_up=DEFAULT_MAX_CATCH_UP,
+                 align=DEFAULT_ALIGN, clock=None, window=DEFAULT_WINDOW):
+        '''
+        Create a Cadence
+
+        interval -- the time between frames (in seconds)
+        policy -- what to do with late slots, SKIP or CATCH_UP
+        grace -- a slot started less than this late is not skipped (in seconds)
+        max_catch_up -- the most slots the CATCH_UP policy runs behind the grid
+        align -- the grid is anchored to a multiple of this many seconds of
+                 the wall clock, or None to start immediately
+        clock -- the clock to use (default: SystemClock)
+        window -- the number of recent slots kept for the statistics
+        '''
+        if interval <= 0:
+            raise ValueError('interval must be positive: %s' % interval)
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy %s, expected one of: %s' % (policy, ', '.join(POLICIES)))
+
+        self.interval = interval
+        self.policy = policy
+        self.grace = grace
+        self.max_catch_up = max_catch_up
+        self.align = align
+        self.clock = clock or SystemClock()
+
+        self.jitter = RollingStatistics(size=window)
+        self.lateness = RollingStatistics(size=window)
+        self.skipped = 0
+        self.steps = 0
+
+        # the monotonic and wall clock time of slot zero, set by anchor()
+        self.origin = None
+        self.origin_utc = None
+        self.offset = None
+
+        # the next slot to run
+        self.slot = 0
+
+    def __wall_offset(self):
+        '''The wall clock minus the monotonic clock (in seconds)'''
+        monotonic = self.clock.monotonic()
+        utcnow = self.clock.utcnow()
+        return (utcnow - datetime.datetime(1970, 1, 1)).total_seconds() - monotonic
+
+    def anchor(self):
+        '''Anchor slot zero of the grid to the next align boundary of the wall clock'''
+        self.offset = self.__wall_offset()
+        now = self.clock.monotonic()
+        wall = now + self.offset
+
+        start = wall
+        if self.align:
+            start = math.ceil(wall / self.align) * self.align
+
+        self.origin = now + (start - wall)
+        self.origin_utc = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=start)
+        self.slot = 0
+        logging.info('Frame grid anchored at %s, every %s seconds', self.origin_utc, self.interval)
+
+    def __check_step(self):
+        '''Anchor the grid again if the wall clock was stepped, return True if it was'''
+        offset = self.__wall_offset()
+        step = offset - self.offset
+        if abs(step) <= STEP_THRESHOLD:
+            return False
+
+        logging.warning('Wall clock stepped by %.3f seconds, anchoring the frame grid again', step)
+        self.steps += 1
+        self.anchor()
+        return True
+
+    def due(self, slot):
+        '''The monotonic time at which a slot is due'''
+        return self.origin + slot * self.interval
+
+    def remaining(self):
+        '''The time left until the next slot is due (negative if it is late)'''
+        return self.due(self.slot) - self.clock.monotonic()
+
+    def __sleep_until(self, target):
+        '''
+        Sleep until the monotonic target, in short sleeps so that a wall
+        clock step is noticed. Return False if the grid was anchored again.
+        '''
+        while True:
+            remaining = target - self.clock.monotonic()
+            if remaining <= 0:
+                return True
+
+            self.clock.sleep(min(remaining, MAX_SLEEP))
+            if self.__check_step():
+                return False
+
+    def wait(self):
+        '''
+        Wait for the next slot which should run under the policy, and start it
+
+        return -- an instance of Tick
+        '''
+        if self.origin is None:
+            self.anchor()
+        else:
+            self.__check_step()
+
+        skipped = 0
+        while True:
+            now = self.clock.monotonic()
+            behind = int((now - self.due(self.slot)) // self.interval)
+
+            # skip the slots which the policy will not run: the catch-up
+            # policy keeps the most recent max_catch_up slots, the skip
+            # policy keeps the most recent one if it is within the grace time
+            skip = 0
+            if self.policy == CATCH_UP:
+                skip = max(0, behind - self.max_catch_up)
+            elif behind >= 0:
+                skip = behind
+                if now - self.due(self.slot + behind) > self.grace:
+                    skip += 1
+
+            if skip:
+                self.slot += skip
+                skipped += skip
+                self.skipped += skip
+                logging.warning('Skipped %d late frame slot(s)', skip)
+
+            late = self.due(self.slot) <= now
+            if late or self.__sleep_until(self.due(self.slot)):
+                break
+
+            # the grid was anchored again while sleeping
+            skipped = 0
+
+        delay = self.clock.monotonic() - self.due(self.slot)
+        if late:
+            self.lateness.add(delay)
+        else:
+            self.jitter.add(delay)
+
+        tick = Tick(
+            slot=self.slot,
+            utctime=self.origin_utc + datetime.timedelta(seconds=self.slot * self.interval),
+            deadline=self.due(self.slot + 1),
+            delay=delay,
+            late=late,
+            skipped=skipped,
+        )
+
+        self.slot += 1
+        return tick
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+'''
+Persistent library of master dark current images for SBIG AllSky 340/340C
+'''
+
+import ast
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+from collections import deque, namedtuple
+
+import numpy
+
+from pyallsky.abstract_camera import FRAME_HEIGHT, FRAME_WIDTH
+from pyallsky.imagecapture import AllSkyImage
+from pyallsky.imageprocessor import scale_dark
+from pyallsky.util import write_atomic
+
+# default number of dark frames median combined into each master
+DEFAULT_FRAMES = 5
+
+# default limit on the ratio between the exposure of a master dark and the
+# exposure it is scaled to, beyond which it is not used
+DEFAULT_MAX_SCALE = 2.0
+
+# the camera takes exposures in steps of 100 microseconds (in seconds)
+EXPOSURE_STEP = 100e-6
+
+# exposure of the bias frames, which hold the readout pedestal and almost no
+# dark current: the shortest exposure the camera takes (in seconds)
+BIAS_EXPOSURE = EXPOSURE_STEP
+
+# Metadata about a master dark, stored as JSON next to the image data
+MasterDark = namedtuple('MasterDark', [
+    'serialno',         # serial number of the camera which took the darks
+    'exposure',         # exposure time of the darks (in seconds)
+    'timestamp',        # datetime of the most recent dark in the master
+    'frames',           # number of darks combined into the master
+    'filename',         # the .npy file holding the master image data
+    'level',            # median pixel value of the master (bias plus dark current)
+])
+
+def serial_key(serialno):
+    '''
+    The library key for a camera serial number, which the camera reports as
+    a fixed length byte string, and the FITS SERIALNO header holds as the
+    text of that byte string (for example "b'A1234\\x00\\x00'")
+    '''
+    if isinstance(serialno, str) and re.match(r'^b([\'"]).*\1$', serialno):
+        try:
+            serialno = ast.literal_eval(serialno)
+        except (ValueError, SyntaxError):
+            pass
+
+    if isinstance(serialno, (bytes, bytearray)):
+        serialno = serialno.decode('ascii', errors='replace')
+
+    return str(serialno).strip('\x00 \t\r\n')
+
+def exposure_key(exposure):
+    '''
+    The library key for an exposure time: the number of camera exposure
+    steps, so that every exposure the camera can take has a key of its own
+    '''
+    return int(round(exposure / EXPOSURE_STEP))
+
+def is_bias(exposure):
+    '''Whether darks of this exposure time are bias frames'''
+    return exposure_key(exposure) == exposure_key(BIAS_EXPOSURE)
+
+def median_level(data):
+    '''The median pixel value of a master dark'''
+    return float(numpy.median(data))
+
+def master_basename(serialno, exposure):
+    '''The file name (without extension) of the master for a camera and exposure'''
+    serialno = re.sub(r'[^\w.-]', '_', serial_key(serialno))
+    return 'dark_%s_%dus' % (serialno, exposure_key(exposure) * 100)
+
+class DarkLibrary(object):
+    '''
+    A library of median combined master darks, kept on disk in a directory
+
+    Each master is keyed by camera serial number and exposure time. Every new
+    dark frame added to the library is combined with the previous frames of
+    the same key (up to a configured number) into a new master, which is
+    written to disk immediately, so the library survives a restart.
+
+    Masters are memory mapped when first used rather than read into memory.
+    '''
+
+    def __init__(self, directory, frames=DEFAULT_FRAMES, max_scale=DEFAULT_MAX_SCALE, bias=None):
+        '''
+        Create a DarkLibrary, loading the index of any masters already on disk
+
+        directory -- the directory holding the masters (created if necessary)
+        frames -- the number of darks median combined into each master
+        max_scale -- the maximum ratio between the exposure of a master and
+                     the exposure it may be used for
+        bias -- the bias level of the cameras, used when a camera has no
+                master bias frame (see bias_level())
+        '''
+        self.directory = directory
+        self.frames = frames
+        self.max_scale = max_scale
+        self.bias = bias
+
+        # (serialno, exposure key) -> MasterDark
+        self.masters = {}
+
+        # (serialno, exposure key) -> deque of the most recent dark frames
+        self.stacks = {}
+
+        # filename -> memory mapped master image data
+        self.mapped = {}
+
+        os.makedirs(directory, exist_ok=True)
+        self.load_index()
+
+    def load_index(self):
+        '''Read the metadata of every master in the library directory'''
+        for filename in sorted(glob.glob(os.path.join(self.directory, 'dark_*.json'))):
+            try:
+                with open(filename, 'r') as f:
+                    d = json.load(f)
+
+                master = MasterDark(
+                    serialno=d['serialno'],
+                    exposure=float(d['exposure']),
+                    timestamp=datetime.datetime.fromisoformat(d['timestamp']),
+                    frames=int(d['frames']),
+                    filename=os.path.join(self.directory, d['filename']),
+                    level=d.get('level'),
+                )
+            except (OSError, ValueError, KeyError) as ex:
+                logging.warning('Ignoring invalid master dark %s: %s', filename, str(ex))
+                continue
+
+            if not os.path.exists(master.filename):
+                logging.warning('Ignoring master dark without data: %s', filename)
+                continue
+
+            # masters written before the level was stored
+            if master.level is None:
+                master = master._replace(level=median_level(self.load(master)))
+
+            # masters named before the keys had 100 microsecond resolution
+            # may share a key with a newer one, which takes precedence
+            key = (master.serialno, exposure_key(master.exposure))
+            previous = self.masters.get(key)
+            if previous is not None and previous.timestamp > master.timestamp:
+                continue
+
+            self.masters[key] = master
+            logging.info('Loaded master dark: serialno=%s exposure=%s frames=%d timestamp=%s',
+                         master.serialno, master.exposure, master.frames, master.timestamp)
+
+    def master(self, serialno, exposure):
+        '''Return the MasterDark for exactly this camera and exposure, or None'''
+        return self.masters.get((serial_key(serialno), exposure_key(exposure)))
+
+    def age(self, serialno, exposure, utctime):
+        '''
+        Return the age of the master for exactly this camera and exposure, as
+        a datetime.timedelta, or None if there is no such master
+        '''
+        master = self.master(serialno, exposure)
+        if master is None:
+            return None
+
+        return utctime - master.timestamp
+
+    def load(self, master):
+        '''Return the (memory mapped, read only) image data of a master'''
+        data = self.mapped.get(master.filename)
+        if data is None:
+            data = numpy.load(master.filename, mmap_mode='r')
+            self.mapped[master.filename] = data
+
+        return data
+
+    def add(self, serialno, image):
+        '''
+        Add a dark frame to the library, and write out the updated master
+
+        When no earlier frames of this key are held in memory (for example
+        after a restart), the existing master seeds the stack as one frame.
+
+        serialno -- the serial number of the camera which took the dark
+        image -- an instance of AllSkyImage containing dark current only
+
+        return -- the updated MasterDark
+        '''
+        serialno = serial_key(serialno)
+        key = (serialno, exposure_key(image.exposure))
+        data = numpy.frombuffer(image.data, dtype=numpy.uint16)
+        data = data.reshape((FRAME_HEIGHT, FRAME_WIDTH))
+
+        stack = self.stacks.get(key)
+        if stack is None:
+            stack = deque(maxlen=self.frames)
+            if key in self.masters:
+                stack.append(numpy.array(self.load(self.masters[key])))
+            self.stacks[key] = stack
+
+        stack.append(data.copy())
+
+        # median combine the stack, rejecting cosmic rays and hot transients
+        if len(stack) == 1:
+            combined = stack[0]
+        else:
+            combined = numpy.median(numpy.stack(stack), axis=0)
+            combined = numpy.rint(combined).astype(numpy.uint16)
+
+        basename = master_basename(serialno, image.exposure)
+        master = MasterDark(
+            serialno=serialno,
+            exposure=float(image.exposure),
+            timestamp=image.timestamp,
+            frames=len(stack),
+            filename=os.path.join(self.directory, basename + '.npy'),
+            level=median_level(combined),
+        )
+
+        metadata = {
+            'serialno': master.serialno,
+            'exposure': master.exposure,
+            'timestamp': master.timestamp.isoformat(),
+            'frames': master.frames,
+            'filename': basename + '.npy',
+            'level': master.level,
+        }
+
+        # data first, so the metadata never refers to a missing master
+        write_atomic(master.filename, lambda f: numpy.save(f, combined))
+        write_atomic(os.path.join(self.directory, basename + '.json'),
+                     lambda f: f.write(json.dumps(metadata, indent=4).encode('utf-8')))
+
+        # the file was replaced, drop the mapping of the old one
+        self.mapped.pop(master.filename, None)
+
+        # a master of this key saved under an older name is superseded
+        previous = self.masters.get(key)
+        if previous is not None and previous.filename != master.filename:
+            self.remove_files(previous)
+
+        self.masters[key] = master
+
+        logging.info('Updated master dark: serialno=%s exposure=%s frames=%d',
+                     serialno, image.exposure, master.frames)
+        return master
+
+    def remove_files(self, master):
+        '''Delete the data and metadata files of a master from the library'''
+        self.mapped.pop(master.filename, None)
+        for filename in (master.filename, os.path.splitext(master.filename)[0] + '.json'):
+            try:
+                os.remove(filename)
+            except OSError as ex:
+                logging.warning('Unable to remove superseded master dark %s: %s', filename, str(ex))
+
+    def bias_level(self, serialno):
+        '''
+        The bias level (the readout pedestal) of a camera: the median level
+        of its master bias frame (a dark of BIAS_EXPOSURE), or the configured
+        bias level if the camera has no master bias frame
+
+        return -- the bias level, or None if it is not known
+        '''
+        master = self.master(serialno, BIAS_EXPOSURE)
+        if master is not None:
+            return master.level
+
+        return self.bias
+
+    def nearest(self, serialno, exposure):
+        '''
+        Find the master dark best suited to an exposure: the one with the
+        closest exposure time (by ratio) taken with the same camera
+
+        A master with a different exposure time is scaled to the exposure.
+        Only its dark current is scaled, the bias level (see bias_level()) is
+        the same at every exposure. When the bias level is not known, the
+        whole master is scaled in proportion to the exposure.
+
+        Master bias frames are never returned, they hold no dark current.
+
+        serialno -- the serial number of the camera
+        exposure -- the exposure time of the light frame (in seconds)
+
+        return -- an AllSkyImage with the master image data for this
+                  exposure, or None if no master is close enough
+        '''
+        serialno = serial_key(serialno)
+        best = None
+        best_ratio = None
+        for (master_serialno, _), master in self.masters.items():
+            if master_serialno != serialno or master.exposure <= 0.0 or exposure <= 0.0:
+                continue
+
+            if is_bias(master.exposure):
+                continue
+
+            ratio = max(exposure / master.exposure, master.exposure / exposure)
+            if ratio > self.max_scale:
+                continue
+
+            if best is None or ratio < best_ratio:
+                best = master
+                best_ratio = ratio
+
+        if best is None:
+            return None
+
+        data = self.load(best)
+        if exposure_key(best.exposure) == exposure_key(exposure):
+            return AllSkyImage(timestamp=best.timestamp, exposure=best.exposure, data=data)
+
+        scale = exposure / best.exposure
+        bias = self.bias_level(serialno)
+        if bias is None:
+            logging.debug('Scaling master dark %s by %f, the bias level is unknown', best.filename, scale)
+            bias = 0.0
+        else:
+            logging.debug('Scaling master dark %s by %f above bias level %.1f', best.filename, scale, bias)
+
+        return AllSkyImage(timestamp=best.timestamp, exposure=exposure, data=scale_dark(data, scale, bias))
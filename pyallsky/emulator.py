@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+
+'''
+Emulator for the SBIG AllSky 340/340C serial protocol
+
+Runs a fake camera behind a TCP socket (like the Moxa serial to ethernet
+adapter) or a pseudo terminal (like a serial port), so that TcpCamera and
+SerialCamera can be exercised and benchmarked without the hardware.
+
+The emulated camera implements the command checksums and the commands used
+by AbstractCamera: communications test, firmware version, serial number,
+baud rate change, shutter, heater, take image, abort image, transfer image
+(with the block acknowledgements), and the guider commands. Its behaviour
+can be made more realistic by pacing the output at the baud rate, adding
+response latency, and injecting block checksum errors and dropped bytes.
+'''
+
+import logging
+import os
+import select
+import socket
+import termios
+import threading
+import time
+from collections import namedtuple
+
+import numpy
+
+from pyallsky.abstract_camera import block_checksum, command_checksum
+from pyallsky.abstract_camera import BLOCK_PIXELS, BLOCKS_PER_FRAME, FRAME_HEIGHT, FRAME_WIDTH, MAX_EXPOSURE, PIXEL_SIZE
+from pyallsky.abstract_camera import CSUM_ERROR, CSUM_OK, STOP_XFER, TERMINATOR
+from pyallsky.abstract_camera import EXPOSURE_DONE, EXPOSURE_IN_PROGRESS, READOUT_IN_PROGRESS
+from pyallsky.serial_camera import BAUD_RATE
+
+# number of argument bytes following each command (before the checksum)
+COMMAND_ARGUMENTS = {
+    'E': 0,     # communications test
+    'O': 0,     # open shutter
+    'C': 0,     # close shutter
+    'K': 0,     # de-energize shutter motor
+    'V': 0,     # get firmware version
+    'r': 0,     # get serial number
+    'B': 1,     # change baud rate
+    'g': 1,     # heater on/off
+    'T': 5,     # take image
+    'A': 0,     # abort image
+    'X': 0,     # transfer image
+    'H': 0,     # calibrate guider
+    'I': 0,     # autonomous guide
+}
+
+# baud rate command argument -> baud rate
+BAUD_RATE_COMMANDS = dict((code[1], rate) for rate, code in BAUD_RATE.items())
+
+# interval between exposure in progress messages (from the specification)
+EXPOSURE_PROGRESS_INTERVAL = 0.15
+
+# time allowed for each step of the baud rate change handshake
+BAUD_HANDSHAKE_TIMEOUT = 1.0
+
+# size of the chunks in which paced output is written
+PACING_CHUNK = 256
+
+# Settings controlling the behaviour of the emulated camera
+EmulatorSettings = namedtuple('EmulatorSettings', [
+    'baudrate',         # the initial baud rate of the camera
+    'pace',             # limit the output rate to the baud rate (10 bits per byte)
+    'latency',          # delay before every response and image block (in seconds)
+    'readout_time',     # duration of the CCD readout after an exposure (in seconds)
+    'checksum_errors',  # probability of sending an image block with a bad checksum
+    'dropped_bytes',    # probability of dropping one byte of an image block
+    'serialno',         # the 9 byte serial number
+    'firmware',         # the 2 byte firmware version
+    'seed',             # seed for the image data and injected errors
+], defaults=(9600, False, 0.0, 0.5, 0.0, 0.0, b'EMU000001', b'\x01\x10', None))
+
+def line_rate(speed):
+    '''Convert a termios speed constant to a baud rate, or None if unknown'''
+    for rate in BAUD_RATE:
+        if getattr(termios, 'B%d' % rate, None) == speed:
+            return rate
+
+    return None
+
+class SocketStream(object):
+    '''Byte stream over a connected TCP socket'''
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def read(self, nbytes, timeout):
+        '''
+        Receive up to nbytes bytes, waiting at most timeout seconds
+
+        return -- the data, empty if nothing arrived in time
+        raises EOFError when the connection is closed
+        '''
+        readable, _, _ = select.select([self.sock], [], [], max(timeout, 0.0))
+        if not readable:
+            return b''
+
+        data = self.sock.recv(nbytes)
+        if not data:
+            raise EOFError('Connection closed')
+
+        return data
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    def line_rate(self):
+        '''The baud rate the host is using, None if the transport has none'''
+        return None
+
+class PtyStream(object):
+    '''Byte stream over the master side of a pseudo terminal'''
+
+    def __init__(self, master_fd, slave_fd):
+        self.master_fd = master_fd
+        self.slave_fd = slave_fd
+
+    def read(self, nbytes, timeout):
+        '''
+        Receive up to nbytes bytes, waiting at most timeout seconds
+
+        return -- the data, empty if nothing arrived in time
+        '''
+        readable, _, _ = select.select([self.master_fd], [], [], max(timeout, 0.0))
+        if not readable:
+            return b''
+
+        try:
+            return os.read(self.master_fd, nbytes)
+        except OSError:
+            # the slave side has been closed (the pty stays usable, since the
+            # emulator keeps its own slave descriptor open)
+            return b''
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(self.master_fd, view)
+            view = view[written:]
+
+    def line_rate(self):
+        '''The baud rate the host has configured on the serial port'''
+        return line_rate(termios.tcgetattr(self.slave_fd)[5])
+
+class CameraEmulator(object):
+    '''
+    The state and protocol handling of one emulated camera
+
+    serve() answers the commands arriving on a stream until it is closed,
+    or stop() is called.
+    '''
+
+    def __init__(self, settings=None):
+        self.settings = settings or EmulatorSettings()
+        self.baudrate = self.settings.baudrate
+        self.heater = False
+        self.shutter = 'closed'
+        self.rng = numpy.random.default_rng(self.settings.seed)
+        self.frame = bytes(FRAME_WIDTH * FRAME_HEIGHT * PIXEL_SIZE)
+        self.stopped = threading.Event()
+        self.logger = logging.getLogger('allsky_emulator')
+
+        # counters of everything sent, for tests and benchmarks
+        self.commands = 0
+        self.blocks_sent = 0
+        self.checksum_errors_sent = 0
+        self.bytes_dropped = 0
+
+        self.__stream = None
+        self.__next_write = 0.0
+
+    def stop(self):
+        '''Stop serving at the next opportunity'''
+        self.stopped.set()
+
+    ############################################################################
+    # Stream helpers
+    ############################################################################
+
+    def read(self, nbytes, timeout):
+        '''
+        Receive exactly nbytes bytes within timeout seconds
+
+        Data sent by the host at a different baud rate than the camera's
+        (only detectable on a pty) is discarded, as a real UART would only
+        receive garbage.
+
+        return -- the data, shorter than nbytes if the timeout passed
+        '''
+        deadline = time.monotonic() + timeout
+        data = b''
+        while len(data) < nbytes and not self.stopped.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            chunk = self.__stream.read(nbytes - len(data), min(remaining, 0.1))
+            rate = self.__stream.line_rate()
+            if chunk and rate is not None and rate != self.baudrate:
+                self.logger.debug('Discarding %d bytes received at %d baud', len(chunk), rate)
+                continue
+
+            data += chunk
+
+        return data
+
+    def write(self, data):
+        '''Send data, paced at the baud rate if configured'''
+        if isinstance(data, str):
+            data = data.encode()
+
+        if not self.settings.pace:
+            self.__stream.write(data)
+            return
+
+        seconds_per_byte = 10.0 / self.baudrate
+        self.__next_write = max(self.__next_write, time.monotonic())
+        for offset in range(0, len(data), PACING_CHUNK):
+            chunk = data[offset:offset + PACING_CHUNK]
+            delay = self.__next_write - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            self.__stream.write(chunk)
+            self.__next_write += len(chunk) * seconds_per_byte
+
+    def delay(self):
+        '''Wait for the configured response latency'''
+        if self.settings.latency > 0:
+            time.sleep(self.settings.latency)
+
+    ############################################################################
+    # Protocol
+    ############################################################################
+
+    def serve(self, stream):
+        '''
+        Answer commands from the stream until it is closed or stop() is called
+
+        stream -- a SocketStream or PtyStream
+        '''
+        self.__stream = stream
+        try:
+            while not self.stopped.is_set():
+                command = self.read(1, 0.1)
+                if not command:
+                    continue
+
+                self.handle_command(chr(command[0]))
+        except (EOFError, OSError) as ex:
+            self.logger.debug('Stream closed: %s', str(ex))
+        finally:
+            self.__stream = None
+
+    def handle_command(self, command):
+        '''Receive the arguments and checksum of a command, and execute it'''
+        nargs = COMMAND_ARGUMENTS.get(command)
+        if nargs is None:
+            self.logger.debug('Ignoring unknown command byte %r', command)
+            return
+
+        data = self.read(nargs + 1, 1.0)
+        if len(data) != nargs + 1:
+            self.logger.debug('Incomplete command %r', command)
+            return
+
+        args = data[:nargs]
+        csum = command_checksum(command.encode() + args).encode()
+
+        # the computed checksum is always echoed, the command only runs if
+        # it matches the one received
+        self.delay()
+        self.write(csum)
+        if csum != data[nargs:]:
+            self.logger.debug('Checksum mismatch for command %r', command)
+            return
+
+        self.commands += 1
+        self.logger.debug('Command %r arguments %r', command, args)
+
+        if command == 'E':
+            self.write(b'O')
+        elif command == 'V':
+            self.write(self.settings.firmware)
+        elif command == 'r':
+            self.write(self.settings.serialno)
+        elif command == 'B':
+            self.change_baudrate(chr(args[0]))
+        elif command == 'g':
+            self.heater = bool(args[0])
+        elif command in ('O', 'C'):
+            self.shutter = 'open' if command == 'O' else 'closed'
+        elif command == 'T':
+            self.take_image(args)
+        elif command == 'X':
+            self.transfer_image()
+        elif command in ('H', 'I'):
+            self.guide(command)
+
+    def change_baudrate(self, code):
+        '''
+        Switch to a new baud rate and run the handshake: send "S" at the new
+        rate, expect "Test", reply "TestOk", expect "k". Any failure reverts
+        to the previous baud rate.
+        '''
+        rate = BAUD_RATE_COMMANDS.get(code)
+        if rate is None:
+            return
+
+        previous = self.baudrate
+        self.baudrate = rate
+        self.write(b'S')
+
+        if self.read(4, BAUD_HANDSHAKE_TIMEOUT) == b'Test':
+            self.write(b'TestOk')
+            if self.read(1, BAUD_HANDSHAKE_TIMEOUT) == b'k':
+                self.logger.info('Baud rate changed to %d', rate)
+                return
+
+        self.logger.info('Baud rate handshake failed, reverting to %d', previous)
+        self.baudrate = previous
+
+    def make_frame(self, exposure, dark):
+        '''Create the image data for an exposure: a noisy, sky-like frame'''
+        scale = 50.0 + 2000.0 * min(exposure, 30.0) if not dark else 50.0 + 10.0 * exposure
+        data = self.rng.gamma(2.0, scale, size=(FRAME_HEIGHT, FRAME_WIDTH))
+        return data.clip(0, 65535).astype('<u2').tobytes()
+
+    def take_image(self, args):
+        '''Run an exposure, sending the progress messages, then read out'''
+        exptime = min(int.from_bytes(args[0:3], 'big'), MAX_EXPOSURE)
+        exposure = max(exptime * 100e-6, 50e-6)
+        dark = args[4] == 0x00
+
+        deadline = time.monotonic() + exposure
+        while not self.stopped.is_set():
+            self.write(EXPOSURE_IN_PROGRESS)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            # the only command accepted during an exposure is abort
+            data = self.read(2, min(remaining, EXPOSURE_PROGRESS_INTERVAL))
+            if data == b'A' + command_checksum('A').encode():
+                self.logger.debug('Exposure aborted')
+                break
+
+        self.write(READOUT_IN_PROGRESS)
+        self.frame = self.make_frame(exposure, dark)
+        time.sleep(self.settings.readout_time)
+        self.write(EXPOSURE_DONE)
+
+    def transfer_image(self):
+        '''Send the image block by block, waiting for each acknowledgement'''
+        block_bytes = BLOCK_PIXELS * PIXEL_SIZE
+        block = 0
+        while block < BLOCKS_PER_FRAME and not self.stopped.is_set():
+            data = self.frame[block * block_bytes:(block + 1) * block_bytes]
+            csum = block_checksum(data)
+
+            if self.rng.random() < self.settings.checksum_errors:
+                csum ^= 0x01
+                self.checksum_errors_sent += 1
+
+            if self.rng.random() < self.settings.dropped_bytes:
+                drop = int(self.rng.integers(len(data)))
+                data = data[:drop] + data[drop + 1:]
+                self.bytes_dropped += 1
+
+            self.delay()
+            self.write(data + bytes([csum]))
+            self.blocks_sent += 1
+
+            # the camera waits for the acknowledgement for as long as it takes
+            reply = b''
+            while not reply and not self.stopped.is_set():
+                reply = self.read(1, 1.0)
+
+            if reply == CSUM_OK.encode():
+                block += 1
+            elif reply == CSUM_ERROR.encode():
+                continue
+            elif reply == STOP_XFER.encode():
+                self.logger.debug('Transfer stopped by host')
+                return
+            else:
+                self.logger.debug('Unexpected block acknowledgement %r, transfer aborted', reply)
+                return
+
+    def guide(self, command):
+        '''Send some guider status text, terminated by Ctrl-Z'''
+        name = 'Calibration' if command == 'H' else 'Guiding'
+        self.write(('%s started\r\n%s complete\r\n' % (name, name)).encode() + TERMINATOR.encode())
+
+class TcpEmulator(object):
+    '''
+    A CameraEmulator served on a TCP port, one connection at a time (like a
+    serial to ethernet adapter)
+    '''
+
+    def __init__(self, settings=None, host='127.0.0.1', port=0):
+        '''
+        Create a TcpEmulator, listening immediately
+
+        port -- the port to listen on (0 chooses a free port, see address)
+        '''
+        self.camera = CameraEmulator(settings)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.address = self.server.getsockname()
+        self.thread = None
+
+        # the connection being served, None while waiting for one
+        self.connection = None
+
+    @property
+    def device(self):
+        '''The device name to connect to, in the host:port form'''
+        return '%s:%d' % self.address
+
+    def start(self):
+        '''Start serving in a background thread'''
+        self.thread = threading.Thread(target=self.serve_forever, name='tcp-emulator', daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        '''Accept and serve connections until stop() is called'''
+        while not self.camera.stopped.is_set():
+            readable, _, _ = select.select([self.server], [], [], 0.1)
+            if not readable:
+                continue
+
+            conn, peer = self.server.accept()
+            self.camera.logger.info('Connection from %s:%d', *peer[0:2])
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with conn:
+                self.connection = conn
+                try:
+                    self.camera.serve(SocketStream(conn))
+                finally:
+                    self.connection = None
+
+    def disconnect(self):
+        '''
+        Drop the connection being served (like a convertor losing its network
+        link), the emulator then waits for the next connection
+        '''
+        conn = self.connection
+        if conn is not None:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self):
+        '''Stop serving and close the listening socket'''
+        self.camera.stop()
+        if self.thread is not None:
+            self.thread.join()
+        self.server.close()
+
+class PtyEmulator(object):
+    '''
+    A CameraEmulator served on a pseudo terminal, which SerialCamera can open
+    like a serial port. Host data sent at a different baud rate than the
+    camera's is ignored, so baud rate detection behaves as with the hardware.
+    '''
+
+    def __init__(self, settings=None):
+        self.camera = CameraEmulator(settings)
+        self.master_fd, self.slave_fd = os.openpty()
+        self.device = os.ttyname(self.slave_fd)
+
+        # raw mode on the slave side, so no bytes are translated
+        attrs = termios.tcgetattr(self.slave_fd)
+        attrs[0] = attrs[1] = attrs[3] = 0
+        termios.tcsetattr(self.slave_fd, termios.TCSANOW, attrs)
+
+        self.thread = None
+
+    def start(self):
+        '''Start serving in a background thread'''
+        self.thread = threading.Thread(target=self.camera.serve, name='pty-emulator',
+                                       args=(PtyStream(self.master_fd, self.slave_fd), ), daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''Stop serving and close the pseudo terminal'''
+        self.camera.stop()
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+'''
+Sun ephemeris for SBIG AllSky 340/340C cameras: day/night state and the
+exposure time compensation around sunrise and sunset
+
+Searching for sunrise and sunset with pyephem takes milliseconds, so the
+SunEventTable computes the events for the coming days once per site, and
+then answers each lookup from the table. plan_exposures() computes a whole
+exposure schedule (a night, a year) from the same table with numpy, for
+capacity planning and dry runs.
+'''
+
+import bisect
+import datetime
+from collections import namedtuple
+
+import ephem
+import numpy
+
+# Choose a sun elevation at which the sky is sufficiently dark
+# that lack of stars means cloud. See the discussion here:
+# https://lcogt.slack.com/archives/C02507A9VTR/p1694632682594739
+DEFAULT_HORIZON = '-10.6'
+
+# number of days of events computed at a time
+DEFAULT_DAYS = 7
+
+# the exposure is compensated within this many minutes after sunrise and
+# before sunset, by up to COMPENSATION_FACTORS times the nominal exposure
+COMPENSATION_MINUTES = [0, 30, 60]
+COMPENSATION_FACTORS = [10.0, 5.0, 1.0]
+
+SunEphemeris = namedtuple('SunEphemeris', [
+    'prev_sunrise',
+    'next_sunrise',
+    'prev_sunset',
+    'next_sunset',
+    'utctime',
+    'state',
+])
+
+# An exposure schedule, as returned by plan_exposures()
+ExposurePlan = namedtuple('ExposurePlan', [
+    'times',            # numpy.ndarray(dtype='datetime64[us]') of the frame start times (UTC)
+    'day',              # numpy.ndarray(dtype=bool), True for day frames
+    'exposures',        # numpy.ndarray(dtype=float64) of the compensated exposures (in seconds)
+])
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def make_observer(latitude, longitude, elevation, horizon=DEFAULT_HORIZON):
+    '''Create a pyephem observer for the given latitude/longitude/elevation'''
+    observer = ephem.Observer()
+    observer.lat = str(latitude)
+    observer.lon = str(longitude)
+    observer.elevation = float(elevation)
+    observer.horizon = horizon
+
+    return observer
+
+def compute_sun(observer, utctime):
+    '''
+    Search for the sunrise/sunset times around utctime with pyephem, and
+    return them with the day/night state as a SunEphemeris object. This is
+    the reference for SunEventTable, which is much faster.
+
+    observer -- a pyephem observer for the correct latitude/longitude/elevation
+    utctime -- the UTC timestamp which will be used in the computation
+    '''
+    observer.date = utctime
+    sun = ephem.Sun()
+
+    d = {}
+    d['prev_sunrise'] = observer.previous_rising(sun).datetime()
+    d['next_sunrise'] = observer.next_rising(sun).datetime()
+    d['prev_sunset'] = observer.previous_setting(sun).datetime()
+    d['next_sunset'] = observer.next_setting(sun).datetime()
+    d['utctime'] = utctime
+    d['state'] = 'day' if d['next_sunset'] < d['next_sunrise'] else 'night'
+
+    return SunEphemeris(**d)
+
+def to_microseconds(utctime):
+    '''Convert a naive UTC datetime to integer microseconds since the epoch'''
+    return (utctime - EPOCH) // datetime.timedelta(microseconds=1)
+
+def compensation(day, minutes_since_sunrise, minutes_until_sunset, nominal_exposure):
+    '''
+    The exposure compensated for the brightness of the sky around sunrise and
+    sunset: up to 10 times the nominal exposure within an hour after sunrise
+    and before sunset, rounded to 100 microseconds for the camera. Works on
+    numbers and numpy arrays alike.
+
+    day -- True during the day, the exposure is never compensated at night
+    minutes_since_sunrise -- whole minutes since the previous sunrise
+    minutes_until_sunset -- whole minutes until the next sunset
+    nominal_exposure -- the normal exposure time during full day/night (in seconds)
+    '''
+    exposure = numpy.full(numpy.shape(day), nominal_exposure, dtype=numpy.float64)
+
+    # early morning (just after sunrise), the sky is still fairly dark
+    # so the exposure time needs to be increased
+    morning = day & (minutes_since_sunrise <= COMPENSATION_MINUTES[-1])
+    fp = [factor * nominal_exposure for factor in COMPENSATION_FACTORS]
+    exposure = numpy.where(morning, numpy.interp(minutes_since_sunrise, COMPENSATION_MINUTES, fp), exposure)
+
+    # early evening (just before sunset), the sky is beginning to get dark
+    # so the exposure time needs to be increased to compensate (on top of
+    # the morning compensation, on very short days)
+    evening = day & (minutes_until_sunset <= COMPENSATION_MINUTES[-1])
+    factor = numpy.interp(minutes_until_sunset, COMPENSATION_MINUTES, COMPENSATION_FACTORS)
+    exposure = numpy.where(evening, exposure * factor, exposure)
+
+    # round exposure time to the nearest 100 microsecond boundary for the camera
+    exposure = numpy.around(exposure * 1e6, -2) / 1e6
+    return exposure if numpy.ndim(exposure) else float(exposure)
+
+def calculate_exposure(sun_ephem, nominal_exposure):
+    '''
+    Calculate the compensated exposure time based on the time before/after
+    sunrise/sunset (see compensation())
+
+    sun_ephem -- calculated sun ephemeris for the current time
+    nominal_exposure -- the normal exposure time during full day/night (float, in seconds)
+    return -- compensated exposure time (float, in seconds)
+    '''
+    since = int((sun_ephem.utctime - sun_ephem.prev_sunrise).total_seconds()) // 60
+    until = int((sun_ephem.next_sunset - sun_ephem.utctime).total_seconds()) // 60
+    return compensation(sun_ephem.state == 'day', since, until, nominal_exposure)
+
+class SunEventTable(object):
+    '''
+    Sunrise and sunset times for one site, computed for several days at a
+    time, so that the sun ephemeris at any time is a table lookup
+
+    The table is extended (or recomputed, if the clock jumps backwards)
+    whenever a lookup falls outside it.
+    '''
+
+    def __init__(self, observer, days=DEFAULT_DAYS):
+        '''
+        Create a SunEventTable
+
+        observer -- a pyephem observer for the site, see make_observer()
+        days -- the number of days of events computed at a time
+        '''
+        self.observer = observer
+        self.days = days
+
+        # event times as datetimes (returned by lookups) and as integer
+        # microseconds since the epoch (searched)
+        self.sunrises = []
+        self.sunsets = []
+        self.sunrise_us = numpy.zeros(0, dtype=numpy.int64)
+        self.sunset_us = numpy.zeros(0, dtype=numpy.int64)
+
+        # the sunrise and sunset index of the last lookup, lookups in the
+        # same interval between events reuse it
+        self.__last = None
+
+    def __events(self, kind, start, stop):
+        '''
+        The times of one kind of event ('rising' or 'setting'), from the last
+        one before start until the first one after stop
+        '''
+        sun = ephem.Sun()
+        previous = getattr(self.observer, 'previous_' + kind)
+        following = getattr(self.observer, 'next_' + kind)
+
+        # start from the previous event, then step from event to event
+        self.observer.date = start
+        event = previous(sun).datetime()
+        events = [event]
+        while event <= stop:
+            self.observer.date = event + datetime.timedelta(minutes=1)
+            event = following(sun).datetime()
+            events.append(event)
+
+        return events
+
+    def compute(self, start, stop):
+        '''
+        Compute the events needed for lookups between start and stop (naive
+        UTC datetimes), replacing the current table
+        '''
+        self.sunrises = self.__events('rising', start, stop)
+        self.sunsets = self.__events('setting', start, stop)
+        self.sunrise_us = numpy.array([to_microseconds(t) for t in self.sunrises], dtype=numpy.int64)
+        self.sunset_us = numpy.array([to_microseconds(t) for t in self.sunsets], dtype=numpy.int64)
+        self.__last = None
+
+    def covers(self, start, stop):
+        '''Can lookups between start and stop be answered from the table'''
+        if not self.sunrises or not self.sunsets:
+            return False
+
+        first = max(self.sunrises[0], self.sunsets[0])
+        last = min(self.sunrises[-1], self.sunsets[-1])
+        return first <= start and stop < last
+
+    def ensure(self, start, stop=None):
+        '''Make sure the table covers start to stop (default: start plus the table length)'''
+        if stop is None:
+            stop = start
+
+        if not self.covers(start, stop):
+            self.compute(start, max(stop, start + datetime.timedelta(days=self.days)))
+
+    def sun(self, utctime):
+        '''
+        The sunrise/sunset times and day/night state at utctime, as a
+        SunEphemeris object (the same as compute_sun(), from the table)
+        '''
+        self.ensure(utctime)
+
+        # successive lookups are almost always between the same events
+        if self.__last is not None:
+            rise, sset = self.__last
+            if (self.sunrises[rise - 1] <= utctime < self.sunrises[rise] and
+                    self.sunsets[sset - 1] <= utctime < self.sunsets[sset]):
+                return self.__ephemeris(rise, sset, utctime)
+
+        rise = bisect.bisect_right(self.sunrises, utctime)
+        sset = bisect.bisect_right(self.sunsets, utctime)
+        self.__last = (rise, sset)
+        return self.__ephemeris(rise, sset, utctime)
+
+    def __ephemeris(self, rise, sset, utctime):
+        next_sunrise = self.sunrises[rise]
+        next_sunset = self.sunsets[sset]
+        return SunEphemeris(
+            prev_sunrise=self.sunrises[rise - 1],
+            next_sunrise=next_sunrise,
+            prev_sunset=self.sunsets[sset - 1],
+            next_sunset=next_sunset,
+            utctime=utctime,
+            state='day' if next_sunset < next_sunrise else 'night',
+        )
+
+def plan_exposures(table, start, stop, interval, day_exposure, night_exposure):
+    '''
+    Compute the exposure schedule of frames taken every interval seconds
+    from start until stop, without calling pyephem for each frame
+
+    table -- the SunEventTable of the site (extended as needed)
+    start -- the UTC datetime of the first frame
+    stop -- the UTC datetime after the last frame
+    interval -- the time between frames (in seconds)
+    day_exposure -- the nominal exposure of the day camera (in seconds)
+    night_exposure -- the nominal exposure of the night camera (in seconds)
+
+    return -- an instance of ExposurePlan
+    '''
+    table.ensure(start, stop)
+
+    step = int(round(interval * 1e6))
+    times = numpy.arange(to_microseconds(start), to_microseconds(stop), step, dtype=numpy.int64)
+
+    rise = numpy.searchsorted(table.sunrise_us, times, side='right')
+    sset = numpy.searchsorted(table.sunset_us, times, side='right')
+    day = table.sunset_us[sset] < table.sunrise_us[rise]
+
+    # whole minutes, as the scheduler computes them
+    since = (times - table.sunrise_us[rise - 1]) // 1000000 // 60
+    until = (table.sunset_us[sset] - times) // 1000000 // 60
+
+    exposures = numpy.where(day,
+                            compensation(day, since, until, day_exposure),
+                            compensation(day, since, until, night_exposure))
+
+    return ExposurePlan(times=times.astype('datetime64[us]'), day=day, exposures=exposures)
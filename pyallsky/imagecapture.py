@@ -4,14 +4,18 @@
 High level image capture interface to the SBIG AllSky 340/340C
 '''
 
-import array
+import calendar
 import datetime
 import logging
+import os
+import re
 from collections import namedtuple
 
-from pyallsky.serial_camera import SerialCamera
-from pyallsky.tcp_camera import TcpCamera
-from pyallsky.util import is_network_device
+import fitsio
+import numpy
+
+from pyallsky.abstract_camera import AllSkyException, FRAME_BYTES, FRAME_HEIGHT, FRAME_WIDTH
+from pyallsky.session import CameraSession
 
 # Tuple to hold all of the data about an exposure taken by an
 # SBIG AllSky 340/340C camera
@@ -21,23 +25,71 @@ AllSkyImage = namedtuple('AllSkyImage', [
     'data',
 ])
 
+# RAW files saved by allsky_scheduler are named <siteid>-<unix time>-<day|night>.raw
+RAW_FILENAME_PATTERN = re.compile(r'^(?P<siteid>.+)-(?P<timestamp>\d+)-(?P<state>day|night)\.raw$')
+
+# The information encoded in the name of a RAW file saved by allsky_scheduler
+RawFilename = namedtuple('RawFilename', [
+    'siteid',           # the site ID
+    'timestamp',        # the UTC datetime at which the exposure started
+    'state',            # 'day' or 'night'
+])
+
+def raw_filename_base(siteid, utctime, state):
+    '''
+    The name (without extension) of the files saved by allsky_scheduler for
+    a frame, see RAW_FILENAME_PATTERN
+
+    siteid -- the site ID
+    utctime -- the naive UTC datetime at which the exposure started
+    state -- 'day' or 'night'
+    '''
+    return '%s-%d-%s' % (siteid, calendar.timegm(utctime.utctimetuple()), state)
+
+def parse_raw_filename(filename):
+    '''
+    Parse the name of a RAW file saved by allsky_scheduler
+
+    Older versions of allsky_scheduler converted the timestamp with the local
+    time zone of the host, so names written on a host which was not set to
+    UTC are off by its UTC offset. The FITS sidecar, when there is one, holds
+    the correct time.
+
+    filename -- the file name (any directory is ignored)
+
+    return -- an instance of RawFilename, or None if the name does not match
+    '''
+    match = RAW_FILENAME_PATTERN.match(os.path.basename(filename))
+    if match is None:
+        return None
+
+    timestamp = datetime.datetime.fromtimestamp(int(match.group('timestamp')), datetime.timezone.utc)
+    return RawFilename(
+        siteid=match.group('siteid'),
+        timestamp=timestamp.replace(tzinfo=None),
+        state=match.group('state'),
+    )
+
 def show_progress(pct):
     '''Method to display image transfer progress depending on logging level'''
     logging.info('Transfer progress: %.2f%%', pct)
 
 
-def capture_image_camera(camera, exposure, dark=False):
+def capture_image_camera(camera, exposure, dark=False, out=None, resumes=0):
     '''
     Capture an image from an SBIG AllSky 340/340C camera
     and control the heater (on or off)
 
-    device -- the device node to use (for example, /dev/ttyUSB0)
+    camera -- an instance of AbstractCamera
     exposure -- the exposure time to use (in seconds)
     dark -- capture a dark current image
+    out -- an optional frame buffer to download the image into (reused in place)
+    resumes -- the maximum number of times to resume a failed image download
 
     Exceptions:
     serial.serialutil.SerialException -- exception raised by pyserial
     AllSkyException -- exception raised by pyallsky
+    ImageTransferError -- the download failed, the exception holds the partial frame
 
     Returns an instance of AllSkyImage
     '''
@@ -46,53 +98,166 @@ def capture_image_camera(camera, exposure, dark=False):
     timestamp = camera.take_image(exposure=exposure, dark=dark)
 
     logging.info('Downloading image')
-    data = camera.xfer_image(progress_callback=show_progress)
+    data = camera.xfer_image(progress_callback=show_progress, out=out, resumes=resumes)
 
     return AllSkyImage(timestamp=timestamp, exposure=exposure, data=data)
 
 
-def capture_image_device(device_config, exposure, dark=False):
+def capture_image_device(device_config, exposure, dark=False, sessions=None):
     '''
     Capture an image from an SBIG AllSky 340/340C camera
     and control the heater (on or off)
 
-    device -- the device node to use (for example, /dev/ttyUSB0)
+    The capture is retried on a new connection if the link fails. Callers
+    which capture repeatedly pass their SessionManager, to keep the
+    connection open between calls; otherwise the camera is connected for
+    this capture only, and the connection is closed afterwards.
+
+    device_config -- the device configuration (its device is the serial device,
+                     for example /dev/ttyUSB0, or host:port)
     exposure -- the exposure time to use (in seconds)
     dark -- capture a dark current image
+    sessions -- the SessionManager holding the connection (default: a new
+                connection, closed after the capture)
 
     Exceptions:
     serial.serialutil.SerialException -- exception raised by pyserial
     AllSkyException -- exception raised by pyallsky
+    CameraUnavailable -- the camera cannot be reached
 
     Returns an instance of AllSkyImage
     '''
-    logging.info('Connecting to camera')
-    if is_network_device(device_config.device):
-        host, port = device_config.device.split(':')
-        cam = TcpCamera(host, int(port))
-    else:
-        cam = SerialCamera(device_config.device)
+    def capture(camera):
+        return capture_image_camera(camera, exposure, dark=dark)
 
-    logging.info('Taking exposure')
-    timestamp = cam.take_image(exposure=exposure, dark=dark)
+    if sessions is not None:
+        return sessions.session(device_config.device).run(capture)
 
-    logging.info('Downloading image')
-    data = cam.xfer_image(progress_callback=show_progress)
+    session = CameraSession(device_config.device)
+    try:
+        return session.run(capture)
+    finally:
+        session.close()
 
-    return AllSkyImage(timestamp=timestamp, exposure=exposure, data=data)
+# FITS files which may be saved next to a RAW file, holding its metadata
+SIDECAR_EXTENSIONS = ('.fits.fz', '.fits', '.fit')
+
+# The metadata of a RAW file, each member is None if it could not be found
+RawMetadata = namedtuple('RawMetadata', [
+    'timestamp',        # the UTC datetime at which the exposure started
+    'exposure',         # the exposure time (in seconds)
+    'headers',          # list of the other FITS headers, as {name, value, comment} dictionaries
+])
+
+# FITS headers which describe the layout of the file rather than the frame,
+# they are never carried over from a sidecar
+STRUCTURAL_HEADERS = frozenset([
+    'SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'EXTEND', 'PCOUNT', 'GCOUNT', 'TFIELDS',
+    'BSCALE', 'BZERO', 'CHECKSUM', 'DATASUM', 'COMMENT', 'HISTORY',
+])
+
+def is_structural_header(name, compressed):
+    '''Does a FITS header describe the layout of the file (see STRUCTURAL_HEADERS)'''
+    if name in STRUCTURAL_HEADERS or re.match(r'(NAXIS|TTYPE|TFORM)\d+$', name):
+        return True
+
+    # the tile compression headers of a compressed image
+    return compressed and name.startswith('Z')
 
-def capture_image_file(filename, exposure, dark=False):
+def read_sidecar_metadata(filename):
+    '''
+    Read the metadata of a RAW file from a FITS file with the same name
+    saved next to it (DATE-OBS and EXPTIME headers, and all of the others)
+
+    return -- an instance of RawMetadata
+    '''
+    base = filename[:-len('.raw')] if filename.lower().endswith('.raw') else filename
+
+    for ext in SIDECAR_EXTENSIONS:
+        sidecar = base + ext
+        if not os.path.exists(sidecar):
+            continue
+
+        try:
+            with fitsio.FITS(sidecar) as fits:
+                # compressed images keep their header in the first extension
+                for hdu in fits:
+                    header = hdu.read_header()
+                    if 'DATE-OBS' not in header:
+                        continue
+
+                    timestamp = datetime.datetime.fromisoformat(header['DATE-OBS'])
+                    exposure = header.get('EXPTIME')
+                    exposure = float(exposure) if exposure is not None else None
+
+                    compressed = bool(header.get('ZIMAGE', False))
+                    headers = [
+                        {'name': r['name'], 'value': r['value'], 'comment': r.get('comment', '')}
+                        for r in header.records()
+                        if 'value' in r and not is_structural_header(r['name'], compressed)
+                    ]
+                    return RawMetadata(timestamp=timestamp, exposure=exposure, headers=headers)
+        except (OSError, ValueError) as ex:
+            logging.warning('Unable to read sidecar %s: %s', sidecar, str(ex))
+
+    return RawMetadata(timestamp=None, exposure=None, headers=None)
+
+def load_raw_frame(filename):
+    '''
+    Memory map a RAW file as a frame, without reading it into memory
+
+    filename -- the RAW file, as saved by AllSkyImageProcessor.save_raw()
+
+    Exceptions:
+    AllSkyException -- the file is not the size of a full frame
+
+    return -- a read only numpy.memmap(dtype=numpy.uint16) of shape (rows, columns)
+    '''
+    size = os.path.getsize(filename)
+    if size != FRAME_BYTES:
+        raise AllSkyException('RAW file %s is %d bytes, expected a %dx%d frame of %d bytes' %
+                              (filename, size, FRAME_WIDTH, FRAME_HEIGHT, FRAME_BYTES))
+
+    return numpy.memmap(filename, dtype=numpy.uint16, mode='r', shape=(FRAME_HEIGHT, FRAME_WIDTH))
+
+def capture_image_file(filename, exposure=None, dark=False, metadata=None):
     '''
     Capture an image from a previously saved RAW file
 
-    This is primarily meant to be used to debug the image postprocessing code
-    without requiring the camera hardware.
+    This is used to debug the image postprocessing code without requiring
+    the camera hardware, and to reprocess archived frames. The file is
+    memory mapped, the image data is a zero-copy view of it.
+
+    The timestamp and exposure time are taken from a FITS file saved next to
+    the RAW file, if there is one. Otherwise the timestamp is taken from the
+    file name (if it was saved by allsky_scheduler) or the current time.
+
+    filename -- the RAW file
+    exposure -- the exposure time to use (in seconds) when there is no FITS file
+    metadata -- the RawMetadata of the file, if it has already been read
+
+    Exceptions:
+    AllSkyException -- the file is not a full frame, or the exposure is unknown
+
+    Returns an instance of AllSkyImage
     '''
-    # fake timestamp data
-    timestamp = datetime.datetime.utcnow()
+    data = load_raw_frame(filename)
+
+    if metadata is None:
+        metadata = read_sidecar_metadata(filename)
+
+    timestamp = metadata.timestamp
+    if timestamp is None:
+        parsed = parse_raw_filename(filename)
+        if parsed is not None:
+            timestamp = parsed.timestamp
+        else:
+            logging.warning('No timestamp for %s, using the current time', filename)
+            timestamp = datetime.datetime.utcnow()
 
-    data = array.array('B')
-    with open(filename, 'r') as f:
-        data = array.array('B', f.read())
+    if metadata.exposure is not None:
+        exposure = metadata.exposure
+    if exposure is None:
+        raise AllSkyException('No exposure time for %s' % filename)
 
     return AllSkyImage(timestamp=timestamp, exposure=exposure, data=data)
@@ -4,11 +4,16 @@
 Image processing for SBIG AllSky 340/340C
 '''
 
+import functools
 import logging
+import math
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import os
 import stat
+import threading
+import time
 
 import fitsio
 import numpy
@@ -18,8 +23,6 @@ from PIL import ImageDraw
 from PIL import ImageFont
 from PIL import ImageOps
 
-from colour_demosaicing import demosaicing_CFA_Bayer_Malvar2004
-
 # A container for all device configuration information
 AllSkyDeviceConfiguration = namedtuple('AllSkyDeviceConfiguration', [
     'device',           # device file
@@ -31,10 +34,103 @@ AllSkyDeviceConfiguration = namedtuple('AllSkyDeviceConfiguration', [
     'rotate180',        # rotate the image 180 degrees
     'overlay',          # add image overlay (date, time, exposure)
     'heating',          # turn heating on or off
-])
+    'gamma',            # display gamma applied to JPEG images (1.0 = linear)
+    'demosaic',         # debayer algorithm, one of DEMOSAIC_ALGORITHMS
+], defaults=(1.0, 'malvar'))
+
+def read_device_configuration(config, section):
+    '''
+    Read a device section of a configuration file into an AllSkyDeviceConfiguration
+
+    config -- an instance of configparser.ConfigParser
+    section -- the name of the device section (day or night)
+    '''
+    d = {}
+    d['device'] = config.get(section, 'device')
+    d['exposure'] = config.getfloat(section, 'exposure')
+    d['dark'] = config.getboolean(section, 'dark')
+    d['debayer'] = config.getboolean(section, 'debayer')
+    d['grayscale'] = config.getboolean(section, 'grayscale')
+    d['postprocess'] = config.getboolean(section, 'postprocess')
+    d['rotate180'] = config.getboolean(section, 'rotate180')
+    d['overlay'] = config.getboolean(section, 'overlay')
+    d['heating'] = config.getboolean(section, 'heating')
+    d['gamma'] = config.getfloat(section, 'gamma', fallback=1.0)
+    d['demosaic'] = config.get(section, 'demosaic', fallback='malvar')
+
+    if d['demosaic'] not in DEMOSAIC_ALGORITHMS:
+        raise ValueError('Unknown demosaic algorithm in [%s]: %s' % (section, d['demosaic']))
+
+    if not valid_gamma(d['gamma']):
+        raise ValueError('Invalid gamma in [%s], it must be a positive number: %s' % (section, d['gamma']))
+
+    return AllSkyDeviceConfiguration(**d)
+
+def cached_product(method):
+    '''
+    Decorator turning an AllSkyImageProcessor method into a lazily computed
+    intermediate product: a read only property which is computed on first
+    use and cached for the lifetime of the processor.
+
+    Each product has its own lock, so when several files are saved
+    concurrently a shared product is computed exactly once, while unrelated
+    products can still be computed in parallel.
+    '''
+    name = method.__name__
+
+    @functools.wraps(method)
+    def getter(self):
+        try:
+            return self.products[name]
+        except KeyError:
+            pass
+
+        with self.lock:
+            lock = self.product_locks.setdefault(name, threading.Lock())
+
+        with lock:
+            if name not in self.products:
+                tstart = time.monotonic()
+                self.products[name] = method(self)
+                self.product_timings[name] = time.monotonic() - tstart
+                logging.debug('Computed %s in %.3f seconds', name, self.product_timings[name])
+
+        return self.products[name]
+
+    return property(getter)
+
+def products_needed(filenames):
+    '''
+    The intermediate products (color, gray) needed to write these files:
+    RAW files need neither, FITS files the grayscale image and JPEG files
+    the color image
+    '''
+    needed = set()
+    for filename in filenames:
+        lowercase = filename.lower()
+        if lowercase.endswith('.fit') or lowercase.endswith('.fits') or lowercase.endswith('.fz'):
+            needed.add('gray')
+        elif lowercase.endswith('.jpg') or lowercase.endswith('.jpeg'):
+            needed.add('color')
+
+    return needed
+
+def orient(data, rotate180):
+    '''Rotate the image 180 degrees for mis-mounted cameras (returns a view)'''
+    if rotate180:
+        return numpy.rot90(data, 2)
+
+    return data
 
 class AllSkyImageProcessor(object):
-    '''Image processing for SBIG AllSky 340/340C camera'''
+    '''
+    Image processing for SBIG AllSky 340/340C camera
+
+    The processing steps are only run when an output format needs them, and
+    each intermediate product (dark subtracted, debayered, grayscale, 8-bit
+    display image) is computed at most once per frame, even when several
+    formats are saved concurrently by save_all().
+    '''
 
     def __init__(self, siteid, image, device_config, dark=None):
         '''
@@ -49,32 +145,87 @@ class AllSkyImageProcessor(object):
         self.config = device_config
         self.fits_headers = []
 
-        # standard FITS headers
-        self.add_fits_header('DATAMODE', '1X1 BIN', 'Data Mode')
+        # standard FITS headers, the superpixel debayer combines each 2x2
+        # cell into one pixel
+        binning = '2X2 BIN' if device_config.debayer and device_config.demosaic == 'superpixel' else '1X1 BIN'
+        self.add_fits_header('DATAMODE', binning, 'Data Mode')
         self.add_fits_header('EXPOSURE', '%f' % image.exposure, '[s] Exposure length')
         self.add_fits_header('EXPTIME',  '%f' % image.exposure, '[s] Exposure length')
         self.add_fits_header('DATE-OBS', image.timestamp.isoformat(), '[UTC] Date of observation')
 
-        # convert to numpy array and rotate correctly
-        data = numpy.frombuffer(image.data, dtype=numpy.uint16)
-        data = data.reshape((480, 640))
+        self.dark = dark
 
-        # subtract the dark if present
-        if dark:
-            darkdata = numpy.frombuffer(dark.data, dtype=numpy.uint16)
-            darkdata = darkdata.reshape((480, 640))
-            data = data - darkdata
+        # intermediate products, computed on first use (see cached_product),
+        # and the time taken to compute each of them (in seconds)
+        self.products = {}
+        self.product_locks = {}
+        self.product_timings = {}
+        self.lock = threading.Lock()
 
-        # debayer for color ccd
-        if device_config.debayer:
-            data = demosaicing_CFA_Bayer_Malvar2004(data, 'BGGR')
+        # the products the output formats will need, narrowed by save_all()
+        self.needed = {'color', 'gray'}
 
-        # rotate180 for mis-mounted cameras
-        if device_config.rotate180:
-            data = numpy.rot90(numpy.rot90(data))
+    @cached_product
+    def raw(self):
+        '''The raw frame buffer viewed as a numpy array (no copy is made)'''
+        data = numpy.frombuffer(self.image.data, dtype=numpy.uint16)
+        return data.reshape((480, 640))
 
-        # store our processed data for later
-        self.data = data
+    @cached_product
+    def dark_subtracted(self):
+        '''The raw image with the dark subtracted, if there is one'''
+        if not self.dark:
+            return self.raw
+
+        return subtract_dark(self.raw, self.dark, self.image.exposure)
+
+    @cached_product
+    def demosaiced(self):
+        '''
+        The debayered image (color ccd only), as a DemosaicResult. Only the
+        color and grayscale images which the output formats need are
+        produced, both in the same pass.
+        '''
+        rgb = 'color' in self.needed
+        gray = 'gray' in self.needed
+        return demosaic(self.dark_subtracted, self.config.demosaic, rgb=rgb, gray=gray)
+
+    @cached_product
+    def color(self):
+        '''The image as shown in JPEG files: debayered and rotated as configured'''
+        data = self.dark_subtracted
+        if self.config.debayer:
+            data = self.demosaiced.rgb
+            if data is None:
+                data = demosaic(self.dark_subtracted, self.config.demosaic, rgb=True).rgb
+
+        return orient(data, self.config.rotate180)
+
+    @cached_product
+    def gray(self):
+        '''
+        The grayscale image for FITS files, rotated as configured: the same
+        as the color image for a mono ccd
+        '''
+        if not self.config.debayer:
+            return self.color
+
+        data = self.demosaiced.gray
+        if data is None:
+            data = demosaic(self.dark_subtracted, self.config.demosaic, rgb=False, gray=True).gray
+
+        return orient(data, self.config.rotate180)
+
+    @cached_product
+    def display(self):
+        '''The 8-bit JPEG data: stretched (if configured), gamma corrected'''
+        index = circle_mask_index(tuple(self.color.shape[0:2]))
+        return display_8bit(self.color, index, stretch=self.config.postprocess, gamma=self.config.gamma)
+
+    @property
+    def data(self):
+        '''The processed image (for compatibility, the same as color)'''
+        return self.color
 
     def add_fits_header(self, name, value, comment):
         '''Add an extra header to FITS files'''
@@ -103,10 +254,55 @@ class AllSkyImageProcessor(object):
         else:
             raise RuntimeError('Unsupported file type: %s' % filename)
 
+    def save_all(self, filenames, max_workers=None):
+        '''
+        Write the image to several files concurrently, one thread per file.
+
+        The FITS (RICE compression) and JPEG encoders release the GIL while
+        encoding, so the formats are written in parallel rather than one
+        after the other. Every file is attempted even if another one fails;
+        the first error is raised once all of them have finished.
+
+        filenames -- the files to write, the type is chosen by extension
+        max_workers -- the maximum number of threads (default: one per file)
+
+        return -- a dictionary of filename to the time taken to write it (in seconds)
+        '''
+        def timed_save(filename):
+            tstart = time.monotonic()
+            self.save(filename)
+            return time.monotonic() - tstart
+
+        if not filenames:
+            return {}
+
+        # only compute what these formats need, unless something else was
+        # already computed
+        if not self.products:
+            self.needed = products_needed(filenames)
+
+        max_workers = max_workers or len(filenames)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(fn, executor.submit(timed_save, fn)) for fn in filenames]
+
+        timings = {}
+        errors = []
+        for fn, future in futures:
+            try:
+                timings[fn] = future.result()
+            except Exception as ex:
+                logging.error('Error saving file %s: %s', fn, str(ex))
+                errors.append(ex)
+
+        if errors:
+            raise errors[0]
+
+        return timings
+
     def save_raw(self, filename):
         '''Write the raw CCD output to a file without any manipulation'''
         with open(filename, 'wb') as f:
-            f.write(self.image.data.tostring())
+            f.write(self.image.data)
 
     def save_fits(self, filename, compress=False):
         '''
@@ -114,15 +310,14 @@ class AllSkyImageProcessor(object):
 
         compress -- compress the FITS image with RICE compression (lossless)
         '''
-        # copy the image so we don't change the internal data
-        data = self.data.copy()
-
-        # debayered images need to be turned into grayscale for FITS
-        if data.shape[-1] == 3:
-            data = rgb2gray_uint16(data)
-
+        # debayered images need to be turned into grayscale for FITS, and
         # FITS needs some rotation
-        data = numpy.flipud(data)
+        data = numpy.flipud(self.gray)
+
+        # the grayscale conversion works in float32, but the FITS files have
+        # always been written as float64 (BITPIX = -64), keep them that way
+        if data.dtype == numpy.float32:
+            data = data.astype(numpy.float64)
 
         # write out the FITS file
         compress = 'RICE' if compress else None
@@ -130,19 +325,8 @@ class AllSkyImageProcessor(object):
 
     def save_jpeg(self, filename):
         '''Write the image to a file in JPEG format'''
-        # copy the image so we don't change the internal data
-        data = self.data.copy()
-
-        # improve brightness and contrast
-        if self.config.postprocess:
-            mask = create_circle_mask(data)
-            data = maximize_dynamic_range(data, mask)
-
-        # scale to 8 bit
-        data = scale_to_8bit(data)
-
-        # convert to PIL Image
-        image = Image.fromarray(data)
+        # improve brightness and contrast, and scale to 8 bit
+        image = Image.fromarray(self.display)
 
         # convert to grayscale
         if self.config.grayscale:
@@ -161,24 +345,84 @@ class AllSkyImageProcessor(object):
         image.save(filename, quality=95, optimize=True, progressive=True)
         os.chmod(filename, os.stat(filename).st_mode | stat.S_IROTH)
 
-def create_circle_mask(data, rad_frac=0.92):
+def scale_dark(darkdata, scale, bias=0.0):
+    '''
+    Scale a dark current image to a different exposure time
+
+    Only the dark current grows with the exposure, the bias level (the
+    readout pedestal) is the same in every frame, so it is taken out before
+    scaling and added back afterwards.
+
+    Arguments:
+        darkdata - a numpy.ndarray(dtype=numpy.uint16) of the dark
+        scale    - the ratio of the new exposure time to the dark's
+        bias     - the bias level of the dark
+
+    Returns:
+        A new numpy.ndarray(dtype=numpy.uint16) of the scaled dark
+    '''
+    bias = numpy.float32(bias)
+    scaled = darkdata - bias
+    scaled *= numpy.float32(scale)
+    scaled += bias
+    numpy.rint(scaled, out=scaled)
+    numpy.clip(scaled, 0, 65535, out=scaled)
+    return scaled.astype(numpy.uint16)
+
+def subtract_dark(data, dark, exposure, bias=0.0):
+    '''
+    Subtract a dark current image from a raw image
+
+    When the dark was taken with a different exposure time, it is scaled to
+    the exposure of the image first (see scale_dark()). Pixels where the dark
+    is brighter than the image are clipped to zero rather than wrapping around.
+
+    Arguments:
+        data     - a numpy.ndarray(dtype=numpy.uint16) of the raw image
+        dark     - an instance of AllSkyImage containing dark current only
+        exposure - the exposure time of the raw image (in seconds)
+        bias     - the bias level of the dark, which is not scaled
+
+    Returns:
+        A new numpy.ndarray(dtype=numpy.uint16) of the dark subtracted image
+    '''
+    darkdata = numpy.frombuffer(dark.data, dtype=numpy.uint16)
+    darkdata = darkdata.reshape(data.shape)
+
+    if dark.exposure > 0.0 and abs(exposure - dark.exposure) > 0.0005:
+        scale = exposure / dark.exposure
+        logging.debug('Scaling dark current image by %f', scale)
+        darkdata = scale_dark(darkdata, scale, bias)
+
+    return data - numpy.minimum(data, darkdata)
+
+def circle_mask(shape, rad_frac=0.92):
     '''
     Create the mask needed to retrieve pixels inside and outside of a circular
     area over the center of the image. This is used to retrieve the pixels from
     within the "area of interest" (the sky) in the center of the image,
     excluding the borders.
 
+    The geometry never changes for a given camera, so the mask is computed
+    once per process for each (shape, rad_frac) and shared by all callers.
+
     Arguments:
-        data     - a numpy.ndarray(dtype=numpy.uint16) representing the image
+        shape    - the (rows, columns) shape of the image
         rad_frac - the fraction of the image to use as the radius of the circle
 
     Returns:
-        A numpy.ndarray(dtype=bool) with the same shape as the input, where a
+        A read-only numpy.ndarray(dtype=bool) with the given shape, where a
         True value represents a pixel inside the circle
     '''
-    # Pixel coordinates
-    ny, nx = data.shape[0:2]
-    xx, yy = numpy.meshgrid(1 + numpy.arange(nx), 1 + numpy.arange(ny))
+    # normalize the arguments, so that every spelling shares one cache entry
+    return _circle_mask(tuple(int(n) for n in shape), float(rad_frac))
+
+@functools.lru_cache(maxsize=8)
+def _circle_mask(shape, rad_frac):
+    '''The cached implementation of circle_mask()'''
+    # Pixel coordinates, as a column and a row which broadcast to the full image
+    ny, nx = shape
+    yy, xx = numpy.ogrid[1:ny + 1, 1:nx + 1]
 
     # Image center
     xp_mid = 0.5 * (nx + 1)
@@ -194,35 +438,162 @@ def create_circle_mask(data, rad_frac=0.92):
     ysep2 = (yy - yp_mid)
     rsep2 = numpy.sqrt(xsep2 ** 2 + ysep2 ** 2)
 
-    return (rsep2 <= pix_rad)
+    mask = (rsep2 <= pix_rad)
+    mask.setflags(write=False)
+    return mask
 
-def maximize_dynamic_range(data, mask=None, pct=(2.5, 97.5)):
+def circle_mask_index(shape, rad_frac=0.92):
     '''
-    Use the percentile method to maximize dynamic range of the image.
+    Flat pixel index of the pixels inside the circle_mask() of the same
+    arguments, computed once per process and shared by all callers.
+
+    Returns:
+        A read-only numpy.ndarray of indices into the flattened image
+    '''
+    return _circle_mask_index(tuple(int(n) for n in shape), float(rad_frac))
+
+@functools.lru_cache(maxsize=8)
+def _circle_mask_index(shape, rad_frac):
+    '''The cached implementation of circle_mask_index()'''
+    index = numpy.flatnonzero(_circle_mask(shape, rad_frac))
+    index.setflags(write=False)
+    return index
+
+def create_circle_mask(data, rad_frac=0.92):
+    '''
+    Return the circle_mask() for an image, see above
 
     Arguments:
-        data   - a numpy.ndarray(dtype=numpy.uint16) representing the image
+        data     - a numpy.ndarray(dtype=numpy.uint16) representing the image
+        rad_frac - the fraction of the image to use as the radius of the circle
+
+    Returns:
+        A read-only numpy.ndarray(dtype=bool) with the same shape as the input,
+        where a True value represents a pixel inside the circle
+    '''
+    return circle_mask(tuple(data.shape[0:2]), rad_frac)
+
+def select_pixels(data, mask):
+    '''
+    Select the pixels inside a mask from a grayscale or color image
+
+    Arguments:
+        data   - a numpy.ndarray representing the image, with optional color axis
         mask   - a numpy.ndarray(dtype=bool) mask where True represents the
-                 pixels that should be used when calculating the histogram
+                 pixels to select, a flat pixel index such as the one from
+                 circle_mask_index(), or None to select all pixels
+
+    Returns:
+        The selected pixels, one per row for color images
+    '''
+    if mask is None:
+        return data
+
+    # boolean indexing handles the trailing color axis poorly, so color
+    # images are always gathered by flat index
+    if mask.dtype == bool:
+        if data.ndim == mask.ndim:
+            return data[mask]
+
+        mask = numpy.flatnonzero(mask)
+
+    pixels = data.reshape((data.shape[0] * data.shape[1], ) + data.shape[2:])
+    return pixels.take(mask, axis=0)
+
+def histogram_uint16(data, mask=None):
+    '''
+    Count the pixel values of a 16-bit image
+
+    Arguments:
+        data   - a numpy.ndarray(dtype=numpy.uint16) representing the image
+        mask   - the pixels to count, see select_pixels (default: all pixels)
+
+    Returns:
+        A numpy.ndarray of 65536 counts, one for each possible pixel value
+    '''
+    pixels = select_pixels(data, mask)
+    return numpy.bincount(pixels.ravel(), minlength=65536)
+
+def histogram_percentiles(histogram, pct):
+    '''
+    Calculate exact percentiles from a histogram of integer pixel values
+
+    This gives the same result as numpy.percentile() (with the default linear
+    interpolation) on the pixels themselves, in linear time instead of
+    partitioning all of the pixels.
+
+    Arguments:
+        histogram - the pixel value counts, see histogram_uint16
+        pct       - a sequence of percentiles in the range [0, 100]
+
+    Returns:
+        A numpy.ndarray(dtype=numpy.float64) with one value per percentile
+    '''
+    cumulative = numpy.cumsum(histogram)
+    count = cumulative[-1]
+
+    # same virtual index and interpolation as numpy.percentile
+    quantiles = numpy.true_divide(numpy.asarray(pct, dtype=numpy.float64), 100)
+    virtual = (count - 1) * quantiles
+    previous = numpy.floor(virtual)
+    gamma = virtual - previous
+
+    # the value of the k-th smallest pixel is the first bin whose
+    # cumulative count exceeds k
+    previous = numpy.clip(previous, 0, count - 1)
+    following = numpy.clip(previous + 1, 0, count - 1)
+    a = numpy.searchsorted(cumulative, previous, side='right').astype(numpy.float64)
+    b = numpy.searchsorted(cumulative, following, side='right').astype(numpy.float64)
+
+    diff = b - a
+    return numpy.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+
+# The parameters of a dynamic range stretch
+StretchParameters = namedtuple('StretchParameters', [
+    'lower',            # pixel value which becomes black
+    'upper',            # pixel value which becomes white
+    'histogram',        # histogram of the selected pixels (None for non-integer images)
+])
+
+def compute_stretch(data, mask=None, pct=(2.5, 97.5)):
+    '''
+    Calculate the percentile stretch parameters of an image
+
+    16-bit integer images use an exact histogram method, which also returns
+    the histogram for other consumers. Floating point images fall back to
+    numpy.percentile.
+
+    Arguments:
+        data   - a numpy.ndarray representing the image
+        mask   - the pixels to use, see select_pixels (default: all pixels)
         pct    - the lower and upper percentiles to use
 
     Returns:
-        A copy of the input image which has been transformed to maximize the
-        dynamic range
+        An instance of StretchParameters
     '''
-    if type(data) is not numpy.ndarray:
-        raise TypeError('Input was not a numpy.ndarray')
+    if data.dtype in (numpy.uint8, numpy.uint16):
+        histogram = histogram_uint16(data, mask)
+        lower, upper = histogram_percentiles(histogram, pct)
+        return StretchParameters(lower=lower, upper=upper, histogram=histogram)
 
+    lower, upper = numpy.percentile(select_pixels(data.astype(numpy.float32), mask), pct)
+    return StretchParameters(lower=lower, upper=upper, histogram=None)
 
-    # if no mask was given, use all pixels
-    if mask is None:
-        mask = numpy.ones(data.shape, dtype=bool)
+def apply_stretch(data, lower, upper):
+    '''
+    Linearly stretch an image so that lower becomes black and upper becomes
+    white, clamping the pixels outside of that range
 
-    # make a copy of the data (as float32)
-    image = data.astype(numpy.float32)
+    Arguments:
+        data   - a numpy.ndarray representing the image
+        lower  - the pixel value which becomes black
+        upper  - the pixel value which becomes white
 
-    # calculate the percentiles on the pixels we are interested in
-    lower, upper = numpy.percentile(image[mask], pct)
+    Returns:
+        A new numpy.ndarray(dtype=numpy.uint16)
+    '''
+    # make a copy of the data (as float32), all further steps work in place
+    image = data.astype(numpy.float32)
 
     # make the darkest colored pixel in the usable area of the image black
     image -= lower
@@ -231,22 +602,343 @@ def maximize_dynamic_range(data, mask=None, pct=(2.5, 97.5)):
     image /= (upper - lower)
 
     # clamp any pixel values to within the [0.0, 1.0] range
-    image[(image > 1.0)] = 1.0
-    image[(image < 0.0)] = 0.0
+    numpy.clip(image, 0.0, 1.0, out=image)
 
     # scale back to the numpy.uint16 data type
     image *= 65535.0
     return image.astype(numpy.uint16)
 
+def stretch_dynamic_range(data, mask=None, pct=(2.5, 97.5)):
+    '''
+    Use the percentile method to maximize dynamic range of the image, and
+    return the stretch parameters (including the histogram) for reuse.
+
+    Arguments: see maximize_dynamic_range
+
+    Returns:
+        A tuple of the stretched copy of the image and the StretchParameters
+    '''
+    if type(data) is not numpy.ndarray:
+        raise TypeError('Input was not a numpy.ndarray')
+
+    params = compute_stretch(data, mask, pct)
+    return apply_stretch(data, params.lower, params.upper), params
+
+def maximize_dynamic_range(data, mask=None, pct=(2.5, 97.5)):
+    '''
+    Use the percentile method to maximize dynamic range of the image.
+
+    Arguments:
+        data   - a numpy.ndarray(dtype=numpy.uint16) representing the image
+        mask   - a numpy.ndarray(dtype=bool) mask where True represents the
+                 pixels that should be used when calculating the histogram,
+                 or a flat pixel index (see select_pixels)
+        pct    - the lower and upper percentiles to use
+
+    Returns:
+        A copy of the input image which has been transformed to maximize the
+        dynamic range
+    '''
+    image, _ = stretch_dynamic_range(data, mask, pct)
+    return image
+
 def scale_to_8bit(data):
     '''Scale a 16-bit image to an 8-bit image'''
 
     return numpy.array(data / 256.0, dtype=numpy.uint8)
 
+def valid_gamma(gamma):
+    '''Is this a usable display gamma: a positive, finite number'''
+    return math.isfinite(gamma) and gamma > 0.0
+
+def apply_gamma(data, gamma):
+    '''
+    Apply a display gamma curve to a 16-bit image
+
+    Returns:
+        A numpy.ndarray(dtype=numpy.float64) in the 16-bit range
+    '''
+    return numpy.power(data / 65535.0, 1.0 / gamma) * 65535.0
+
+def build_display_lut(lower=None, upper=None, gamma=1.0):
+    '''
+    Build a lookup table mapping every 16-bit pixel value to its 8-bit
+    display value, combining the dynamic range stretch, the gamma curve and
+    the 8-bit scaling. Each entry is computed with exactly the same arithmetic
+    as applying those steps to the whole image.
+
+    Arguments:
+        lower  - the pixel value which becomes black (None for no stretch)
+        upper  - the pixel value which becomes white
+        gamma  - the display gamma (1.0 for none)
+
+    Returns:
+        A numpy.ndarray(dtype=numpy.uint8) with 65536 entries
+    '''
+    values = numpy.arange(65536, dtype=numpy.uint16)
+
+    if lower is not None:
+        values = apply_stretch(values, lower, upper)
+
+    if gamma != 1.0:
+        values = apply_gamma(values, gamma)
+
+    return scale_to_8bit(values)
+
+def display_8bit(data, mask=None, stretch=True, gamma=1.0, pct=(2.5, 97.5)):
+    '''
+    Convert an image to 8 bits for display, optionally maximizing its dynamic
+    range (see maximize_dynamic_range) and applying a gamma curve.
+
+    16-bit color images, and 16-bit images with a gamma curve, are converted
+    with a single lookup table, which replaces all of the full frame floating
+    point temporaries with one take(). Building the table costs about as much
+    as converting a single channel frame directly, so a single channel frame
+    without a gamma curve is converted directly.
+
+    Arguments:
+        data   - a numpy.ndarray representing the image
+        mask   - the pixels used to calculate the stretch, see select_pixels
+        stretch - maximize the dynamic range of the image
+        gamma  - the display gamma (1.0 for none)
+        pct    - the lower and upper percentiles to use for the stretch
+
+    Returns:
+        A numpy.ndarray(dtype=numpy.uint8) with the same shape as the input
+    '''
+    if data.dtype == numpy.uint16 and (data.ndim == 3 or gamma != 1.0):
+        lower, upper = None, None
+        if stretch:
+            lower, upper, _ = compute_stretch(data, mask, pct)
+
+        lut = build_display_lut(lower, upper, gamma)
+        return lut.take(data)
+
+    if stretch:
+        data = maximize_dynamic_range(data, mask, pct)
+
+    if gamma != 1.0:
+        data = apply_gamma(data, gamma)
+
+    return scale_to_8bit(data)
+
+################################################################################
+# Demosaic (debayer) engine
+################################################################################
+
+# Luminance weights used to flatten a color image into grayscale
+GRAY_WEIGHTS = (0.299, 0.587, 0.114)
+
+# Supported demosaic algorithms
+DEMOSAIC_ALGORITHMS = ('bilinear', 'malvar', 'superpixel')
+
+# The four phases of the BGGR color filter array, as the (row, column) of
+# each filter within a 2x2 cell
+BGGR_BLUE = (0, 0)
+BGGR_GREEN_BLUE_ROW = (0, 1)
+BGGR_GREEN_RED_ROW = (1, 0)
+BGGR_RED = (1, 1)
+
+# Interpolation kernels, as lists of (row offset, column offset, weight) taps.
+# The Malvar, He and Cutler (2004) kernels are the gradient corrected linear
+# interpolation filters from the paper, the same as used by colour-demosaicing.
+def _taps(kernel, scale):
+    '''Convert a 5x5 kernel into a list of its non-zero taps'''
+    return [(dy - 2, dx - 2, weight / scale)
+            for dy, row in enumerate(kernel)
+            for dx, weight in enumerate(row) if weight]
+
+MALVAR_G_AT_RB = _taps([
+    [ 0,  0, -1,  0,  0],
+    [ 0,  0,  2,  0,  0],
+    [-1,  2,  4,  2, -1],
+    [ 0,  0,  2,  0,  0],
+    [ 0,  0, -1,  0,  0],
+], 8.0)
+
+MALVAR_RB_AT_G_ROW = _taps([
+    [ 0,  0, 0.5,  0,  0],
+    [ 0, -1,   0, -1,  0],
+    [-1,  4,   5,  4, -1],
+    [ 0, -1,   0, -1,  0],
+    [ 0,  0, 0.5,  0,  0],
+], 8.0)
+
+MALVAR_RB_AT_G_COLUMN = [(dx, dy, weight) for dy, dx, weight in MALVAR_RB_AT_G_ROW]
+
+MALVAR_RB_AT_BR = _taps([
+    [   0, 0, -1.5, 0,    0],
+    [   0, 2,    0, 2,    0],
+    [-1.5, 0,    6, 0, -1.5],
+    [   0, 2,    0, 2,    0],
+    [   0, 0, -1.5, 0,    0],
+], 8.0)
+
+BILINEAR_G_AT_RB = [(-1, 0, 0.25), (1, 0, 0.25), (0, -1, 0.25), (0, 1, 0.25)]
+BILINEAR_RB_AT_G_ROW = [(0, -1, 0.5), (0, 1, 0.5)]
+BILINEAR_RB_AT_G_COLUMN = [(-1, 0, 0.5), (1, 0, 0.5)]
+BILINEAR_RB_AT_BR = [(-1, -1, 0.25), (-1, 1, 0.25), (1, -1, 0.25), (1, 1, 0.25)]
+
+# For each algorithm: the kernels for green at red/blue sites, red/blue at
+# green sites in the same row, red/blue at green sites in the same column,
+# and red at blue sites (or blue at red sites)
+DEMOSAIC_KERNELS = {
+    'bilinear': (BILINEAR_G_AT_RB, BILINEAR_RB_AT_G_ROW, BILINEAR_RB_AT_G_COLUMN, BILINEAR_RB_AT_BR),
+    'malvar': (MALVAR_G_AT_RB, MALVAR_RB_AT_G_ROW, MALVAR_RB_AT_G_COLUMN, MALVAR_RB_AT_BR),
+}
+
+# The result of demosaic(), either member may be None if it was not requested
+DemosaicResult = namedtuple('DemosaicResult', [
+    'rgb',              # the color image, numpy.ndarray(dtype=numpy.uint16) of shape (rows, columns, 3)
+    'gray',             # the grayscale image, numpy.ndarray(dtype=numpy.float32) of shape (rows, columns)
+])
+
+def _interpolate(padded, phase, shape, taps):
+    '''
+    Evaluate an interpolation kernel at the pixels of one CFA phase only
+
+    padded -- the float32 image, padded by 2 pixels on each side
+    phase -- the (row, column) of the phase within the 2x2 cell
+    shape -- the (rows, columns) shape of the unpadded image
+    taps -- the kernel as a list of (row offset, column offset, weight)
+
+    return -- a float32 array with one value per pixel of the phase
+    '''
+    ny, nx = shape
+    row, col = phase
+    out = None
+    for dy, dx, weight in taps:
+        y = row + 2 + dy
+        x = col + 2 + dx
+        plane = padded[y:y + ny - row:2, x:x + nx - col:2]
+        if out is None:
+            out = plane * numpy.float32(weight)
+        else:
+            out += plane * numpy.float32(weight)
+
+    return out
+
+def _demosaic_phases(data, algorithm):
+    '''
+    Interpolate all three colors at each phase of a BGGR color filter array
+
+    Each kernel is only evaluated at the pixels where its result is used, on
+    float32 data, rather than convolving the whole image with every kernel.
+
+    Yields a tuple of (phase, red, green, blue) for each phase, where each
+    color is a float32 array with one value per pixel of the phase
+    '''
+    g_at_rb, rb_at_g_row, rb_at_g_column, rb_at_br = DEMOSAIC_KERNELS[algorithm]
+
+    # mirror the edges in the same way as scipy.ndimage.convolve
+    padded = numpy.pad(data.astype(numpy.float32), 2, mode='symmetric')
+
+    def raw(phase):
+        row, col = phase
+        return padded[2 + row:2 + data.shape[0]:2, 2 + col:2 + data.shape[1]:2]
+
+    def interpolate(phase, taps):
+        return _interpolate(padded, phase, data.shape, taps)
+
+    phase = BGGR_BLUE
+    yield phase, interpolate(phase, rb_at_br), interpolate(phase, g_at_rb), raw(phase)
+
+    phase = BGGR_GREEN_BLUE_ROW
+    yield phase, interpolate(phase, rb_at_g_column), raw(phase), interpolate(phase, rb_at_g_row)
+
+    phase = BGGR_GREEN_RED_ROW
+    yield phase, interpolate(phase, rb_at_g_row), raw(phase), interpolate(phase, rb_at_g_column)
+
+    phase = BGGR_RED
+    yield phase, raw(phase), interpolate(phase, g_at_rb), interpolate(phase, rb_at_br)
+
+def _superpixel(data):
+    '''
+    Combine each 2x2 cell of a BGGR color filter array into a single pixel,
+    giving a half resolution image without any interpolation
+
+    Returns a tuple of the (red, green, blue) float32 planes
+    '''
+    red = data[1::2, 1::2].astype(numpy.float32)
+    green = data[0::2, 1::2].astype(numpy.float32)
+    green += data[1::2, 0::2]
+    green *= numpy.float32(0.5)
+    blue = data[0::2, 0::2].astype(numpy.float32)
+    return red, green, blue
+
+def _gray(red, green, blue, out=None):
+    '''Weighted sum of the color planes, see GRAY_WEIGHTS'''
+    wr, wg, wb = (numpy.float32(w) for w in GRAY_WEIGHTS)
+    out = numpy.multiply(red, wr, out=out)
+    out += green * wg
+    out += blue * wb
+    return out
+
+def _to_uint16(plane, out):
+    '''Round and clamp a float32 plane into a uint16 output array'''
+    numpy.clip(plane, 0.0, 65535.0, out=plane)
+    numpy.rint(plane, out=plane)
+    out[...] = plane
+
+def demosaic(data, algorithm='malvar', rgb=True, gray=False):
+    '''
+    Demosaic (debayer) a raw image from the color (BGGR) CCD
+
+    The color and grayscale images are produced in the same pass over the
+    data: the grayscale image is computed from each interpolated color plane
+    directly, without creating a color image first.
+
+    Arguments:
+        data      - a numpy.ndarray(dtype=numpy.uint16) of the raw image
+        algorithm - one of DEMOSAIC_ALGORITHMS:
+                    bilinear   - average of the nearest pixels of each color
+                    malvar     - gradient corrected interpolation (Malvar 2004)
+                    superpixel - one pixel per 2x2 cell (half resolution)
+        rgb       - produce the color image
+        gray      - produce the grayscale image
+
+    Returns:
+        An instance of DemosaicResult
+    '''
+    if algorithm not in DEMOSAIC_ALGORITHMS:
+        raise ValueError('Unknown demosaic algorithm: %s' % algorithm)
+
+    ny, nx = data.shape
+    if ny % 2 or nx % 2:
+        raise ValueError('Image dimensions must be even: %s' % (data.shape, ))
+
+    if algorithm == 'superpixel':
+        red, green, blue = _superpixel(data)
+
+        rgb_out = None
+        if rgb:
+            rgb_out = numpy.empty(red.shape + (3, ), dtype=numpy.uint16)
+            for i, plane in enumerate((red, green, blue)):
+                _to_uint16(plane.copy(), rgb_out[..., i])
+
+        gray_out = _gray(red, green, blue) if gray else None
+        return DemosaicResult(rgb=rgb_out, gray=gray_out)
+
+    rgb_out = numpy.empty((ny, nx, 3), dtype=numpy.uint16) if rgb else None
+    gray_out = numpy.empty((ny, nx), dtype=numpy.float32) if gray else None
+
+    for (row, col), red, green, blue in _demosaic_phases(data, algorithm):
+        if gray:
+            gray_out[row::2, col::2] = _gray(red, green, blue)
+
+        if rgb:
+            for i, plane in enumerate((red, green, blue)):
+                # raw planes are views of the padded input, copy before clamping
+                if plane.base is not None:
+                    plane = plane.copy()
+                _to_uint16(plane, rgb_out[row::2, col::2, i])
+
+    return DemosaicResult(rgb=rgb_out, gray=gray_out)
+
 def rgb2gray_uint16(data):
     '''Flatten a 16-bit debayered image into a grayscale image'''
 
-    return numpy.dot(data[...,:3], [0.299, 0.587, 0.114])
+    return numpy.dot(data[...,:3], GRAY_WEIGHTS)
 
 def is_supported_file_type(extension):
     '''Is the extension one that is supported by pyallsky'''
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+'''
+Metrics for the allsky_scheduler stages, exported as a Prometheus textfile
+or a JSON snapshot
+
+Each metric is declared once, with its type and help text, and then updated
+with a set of labels (for example the stage name and the camera). Histograms
+keep cumulative buckets, as Prometheus expects, and also the most recent
+samples, so the snapshot shows the recent behaviour (median, 95th
+percentile) of every stage rather than only the average since startup.
+
+The Prometheus file is meant for the node_exporter textfile collector: it
+is replaced atomically, so the collector never reads a partial file.
+'''
+
+import contextlib
+import json
+import math
+import threading
+import time
+
+from pyallsky.util import RollingStatistics, write_atomic
+
+# histogram buckets for durations (in seconds), from image processing steps
+# up to long exposures
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# histogram buckets for transfer rates (in bytes per second), from 9600 baud
+# serial lines to network cameras
+RATE_BUCKETS = (1e3, 2e3, 5e3, 1e4, 2e4, 5e4, 1e5, 2e5, 5e5, 1e6, 1e7)
+
+# number of recent samples kept for each histogram
+DEFAULT_WINDOW = 100
+
+# quantiles of the recent samples exported for each histogram
+ROLLING_QUANTILES = (0.5, 0.95)
+
+class Series(object):
+    '''The value of a metric for one set of labels'''
+
+    def __init__(self, buckets=None, window=DEFAULT_WINDOW):
+        self.value = 0.0
+        self.updated = None
+
+        # histograms only
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets) if buckets else None
+        self.count = 0
+        self.rolling = RollingStatistics(size=window) if buckets else None
+
+    def observe(self, value):
+        '''Add a sample to a histogram'''
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+        self.value += value
+        self.count += 1
+        self.rolling.add(value)
+        self.updated = time.time()
+
+class MetricFamily(object):
+    '''A declared metric: its type, help text and the series for each set of labels'''
+
+    def __init__(self, name, kind, description, buckets=None):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.buckets = buckets
+        self.series = {}
+
+class Metrics(object):
+    '''
+    A thread safe registry of counters, gauges and histograms
+
+    Labels are given as keyword arguments, for example:
+
+        metrics.histogram('allsky_stage_duration_seconds', 'Duration of each stage')
+        metrics.observe('allsky_stage_duration_seconds', 1.5, stage='transfer')
+    '''
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        '''
+        Create a Metrics registry
+
+        window -- the number of recent samples kept for each histogram
+        '''
+        self.window = window
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def __declare(self, name, kind, description, buckets=None):
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                self.families[name] = MetricFamily(name, kind, description, buckets)
+            elif family.kind != kind:
+                raise ValueError('Metric %s already declared as a %s' % (name, family.kind))
+
+    def counter(self, name, description):
+        '''Declare a counter: a total which only increases'''
+        self.__declare(name, 'counter', description)
+
+    def gauge(self, name, description):
+        '''Declare a gauge: a value which is set'''
+        self.__declare(name, 'gauge', description)
+
+    def histogram(self, name, description, buckets=DURATION_BUCKETS):
+        '''Declare a histogram: samples counted in cumulative buckets'''
+        self.__declare(name, 'histogram', description, tuple(buckets))
+
+    def __series(self, name, kind, labels):
+        '''Find (or create) the series of a metric, must be called with the lock held'''
+        family = self.families.get(name)
+        if family is None:
+            raise KeyError('Metric %s has not been declared' % name)
+        if family.kind != kind:
+            raise ValueError('Metric %s is a %s, not a %s' % (name, family.kind, kind))
+
+        key = tuple(sorted(labels.items()))
+        series = family.series.get(key)
+        if series is None:
+            series = Series(family.buckets, self.window)
+            family.series[key] = series
+
+        return series
+
+    def increment(self, name, amount=1, **labels):
+        '''Add to a counter'''
+        with self.lock:
+            series = self.__series(name, 'counter', labels)
+            series.value += amount
+            series.updated = time.time()
+
+    def set(self, name, value, **labels):
+        '''Set a gauge'''
+        with self.lock:
+            series = self.__series(name, 'gauge', labels)
+            series.value = value
+            series.updated = time.time()
+
+    def observe(self, name, value, **labels):
+        '''Add a sample to a histogram'''
+        with self.lock:
+            self.__series(name, 'histogram', labels).observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        '''Context manager observing the time taken by its body in a histogram'''
+        tstart = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - tstart, **labels)
+
+    def snapshot(self):
+        '''
+        Return the current value of every metric as a JSON serializable
+        dictionary. Histograms include the summary of their recent samples.
+        '''
+        with self.lock:
+            snapshot = {}
+            for family in self.families.values():
+                entries = []
+                for key, series in family.series.items():
+                    entry = {'labels': dict(key), 'updated': series.updated}
+                    if family.kind == 'histogram':
+                        entry['sum'] = series.value
+                        entry['count'] = series.count
+                        entry['buckets'] = [list(b) for b in zip(family.buckets, series.bucket_counts)]
+                        entry['recent'] = series.rolling.summary()
+                    else:
+                        entry['value'] = series.value
+
+                    entries.append(entry)
+
+                snapshot[family.name] = {
+                    'type': family.kind,
+                    'help': family.description,
+                    'series': entries,
+                }
+
+            return snapshot
+
+    def prometheus(self):
+        '''
+        Return every metric in the Prometheus text exposition format.
+        Histograms are followed by a <name>_recent gauge with quantiles of
+        their recent samples.
+        '''
+        lines = []
+        with self.lock:
+            for family in self.families.values():
+                lines.append('# HELP %s %s' % (family.name, family.description))
+                lines.append('# TYPE %s %s' % (family.name, family.kind))
+
+                for key, series in sorted(family.series.items()):
+                    labels = dict(key)
+                    if family.kind != 'histogram':
+                        lines.append(format_sample(family.name, labels, series.value))
+                        continue
+
+                    for bound, count in zip(family.buckets, series.bucket_counts):
+                        lines.append(format_sample(family.name + '_bucket', dict(labels, le=format_value(bound)), count))
+                    lines.append(format_sample(family.name + '_bucket', dict(labels, le='+Inf'), series.count))
+                    lines.append(format_sample(family.name + '_sum', labels, series.value))
+                    lines.append(format_sample(family.name + '_count', labels, series.count))
+
+                if family.kind != 'histogram':
+                    continue
+
+                recent = family.name + '_recent'
+                lines.append('# HELP %s %s (the most recent %d samples)' % (recent, family.description, self.window))
+                lines.append('# TYPE %s gauge' % recent)
+                for key, series in sorted(family.series.items()):
+                    for quantile in ROLLING_QUANTILES:
+                        value = series.rolling.percentile(quantile * 100)
+                        if value is not None:
+                            lines.append(format_sample(recent, dict(key, quantile=format_value(quantile)), value))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        '''
+        Atomically write all metrics to a file: a JSON snapshot if the name
+        ends with .json, otherwise the Prometheus text format
+        '''
+        if filename.lower().endswith('.json'):
+            text = json.dumps(self.snapshot(), indent=2, sort_keys=True) + '\n'
+        else:
+            text = self.prometheus()
+
+        write_atomic(filename, lambda f: f.write(text.encode()))
+
+def format_value(value):
+    '''Format a number for the Prometheus text format'''
+    if isinstance(value, int):
+        return str(value)
+
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+
+    return repr(float(value))
+
+def format_sample(name, labels, value):
+    '''Format one Prometheus sample line, escaping the label values'''
+    if labels:
+        pairs = []
+        for label, text in sorted(labels.items()):
+            text = str(text).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append('%s="%s"' % (label, text))
+        name += '{' + ','.join(pairs) + '}'
+
+    return '%s %s' % (name, format_value(value))
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+'''
+Batch reprocessing of archived RAW frames from SBIG AllSky 340/340C cameras
+'''
+
+import functools
+import itertools
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from pyallsky.darklibrary import DarkLibrary
+from pyallsky.imagecapture import capture_image_file, parse_raw_filename, read_sidecar_metadata
+from pyallsky.imageprocessor import AllSkyImageProcessor
+
+# A single RAW frame to reprocess, passed to a worker process
+ReprocessTask = namedtuple('ReprocessTask', [
+    'source',           # the RAW file
+    'filenames',        # the output files to (re)generate
+    'siteid',           # site ID for the overlay and FITS headers
+    'device_config',    # AllSkyDeviceConfiguration to process with
+    'fits_headers',     # list of (name, value, comment) extra FITS headers
+    'darks',            # DarkSettings of the master dark library, or None
+])
+
+# Where to find the master darks which the scheduler subtracted
+DarkSettings = namedtuple('DarkSettings', [
+    'directory',        # the DarkLibrary directory
+    'max_scale',        # the maximum exposure ratio a master is scaled by
+    'bias',             # the configured bias level, or None
+])
+
+# The outcome of a ReprocessTask
+ReprocessResult = namedtuple('ReprocessResult', [
+    'source',           # the RAW file
+    'filenames',        # the output files written
+    'duration',         # the time taken to load, process and save (in seconds)
+])
+
+def find_raw_frames(directory):
+    '''
+    Walk a directory tree and yield the path of every RAW frame in it, in
+    sorted order within each directory
+    '''
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith('.raw'):
+                yield os.path.join(root, name)
+
+def output_filenames(source, input_directory, output_directory, extensions):
+    '''
+    The output files for a RAW frame: the same name with each extension, in
+    the same place relative to output_directory as the frame is relative to
+    input_directory
+    '''
+    relative = os.path.relpath(source, input_directory)
+    base = os.path.join(output_directory, os.path.splitext(relative)[0])
+    return [base + ext for ext in extensions]
+
+def is_within(path, directory):
+    '''Is path the directory itself, or anywhere in the tree below it'''
+    path = os.path.realpath(path)
+    directory = os.path.realpath(directory)
+    return os.path.commonpath([path, directory]) == directory
+
+@functools.lru_cache(maxsize=4)
+def open_dark_library(darks):
+    '''The DarkLibrary for DarkSettings, opened once per worker process'''
+    return DarkLibrary(darks.directory, max_scale=darks.max_scale, bias=darks.bias)
+
+def header_value(headers, name):
+    '''The value of a FITS header from a list of header dictionaries, or None'''
+    for header in headers or ():
+        if header['name'] == name:
+            return header['value']
+
+    return None
+
+def find_dark(task, image, headers):
+    '''
+    The master dark for a frame, from the camera serial number in its
+    sidecar headers, or None if darks are not used or none is available
+    '''
+    if task.darks is None:
+        return None
+
+    serialno = header_value(headers, 'SERIALNO')
+    if serialno is None:
+        logging.warning('No camera serial number for %s, the dark is not subtracted', task.source)
+        return None
+
+    dark = open_dark_library(task.darks).nearest(serialno, image.exposure)
+    if dark is None:
+        logging.warning('No master dark for %s (exposure %s), the dark is not subtracted',
+                        task.source, image.exposure)
+
+    return dark
+
+def is_up_to_date(filename, mtime):
+    '''Does filename exist, and was it modified at or after mtime'''
+    try:
+        return os.stat(filename).st_mtime >= mtime
+    except FileNotFoundError:
+        return False
+
+def reprocess_frame(task):
+    '''
+    Load a RAW frame, process it and save it in every requested format
+
+    The nearest master dark is subtracted when the device configuration
+    takes darks, and the FITS headers of the sidecar saved with the frame
+    are carried over to the new files.
+
+    Runs in a worker process. Each file is written under a temporary name
+    and renamed into place, so an interrupted run never leaves a partial
+    file which looks up to date.
+
+    return -- an instance of ReprocessResult
+    '''
+    tstart = time.monotonic()
+
+    # the exposure time comes from the FITS file saved with the frame, the
+    # nominal exposure is only used if there is none
+    config = task.device_config
+    metadata = read_sidecar_metadata(task.source)
+    image = capture_image_file(task.source, config.exposure, metadata=metadata)
+
+    dark = find_dark(task, image, metadata.headers)
+    processor = AllSkyImageProcessor(task.siteid, image, config, dark)
+    for name, value, comment in task.fits_headers:
+        processor.add_fits_header(name, value, comment)
+
+    # keep the headers which the scheduler added (such as the camera serial
+    # number and firmware version), unless they were set again above
+    names = set(header['name'] for header in processor.fits_headers)
+    for header in metadata.headers or ():
+        if header['name'] not in names:
+            processor.add_fits_header(header['name'], header['value'], header['comment'])
+
+    # keep the extension, the file type is chosen by it
+    tmpnames = []
+    for fn in task.filenames:
+        os.makedirs(os.path.dirname(fn) or '.', exist_ok=True)
+        tmpname = os.path.join(os.path.dirname(fn), '.tmp-' + os.path.basename(fn))
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        tmpnames.append(tmpname)
+
+    try:
+        processor.save_all(tmpnames)
+        for tmpname, fn in zip(tmpnames, task.filenames):
+            os.replace(tmpname, fn)
+    finally:
+        for tmpname in tmpnames:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+
+    return ReprocessResult(source=task.source, filenames=task.filenames,
+                           duration=time.monotonic() - tstart)
+
+def reprocess(tasks, workers=None, backlog=4):
+    '''
+    Run reprocess_frame() on every task, spread over a pool of processes
+
+    Tasks are submitted as workers become free rather than all at once, so
+    an arbitrarily long (lazy) iterable of tasks uses constant memory.
+
+    tasks -- an iterable of ReprocessTask
+    workers -- the number of worker processes (default: one per CPU)
+    backlog -- the number of tasks queued per worker
+
+    Yields a tuple of (task, ReprocessResult or the exception raised) as
+    each task completes, in completion order
+    '''
+    workers = workers or os.cpu_count() or 1
+    tasks = iter(tasks)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def submit(count):
+            for task in itertools.islice(tasks, count):
+                pending[executor.submit(reprocess_frame, task)] = task
+
+        submit(workers * backlog)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                try:
+                    yield task, future.result()
+                except Exception as ex:
+                    yield task, ex
+
+            submit(len(done))
+
+def plan_tasks(input_directory, output_directory, extensions, device_configs,
+               fits_headers=(), force=False, newer_than=0.0, darks=None):
+    '''
+    Yield a ReprocessTask for every RAW frame in input_directory which has
+    at least one output missing or out of date
+
+    extensions -- the output file extensions (.raw is ignored)
+    device_configs -- dictionary of 'day'/'night' to AllSkyDeviceConfiguration
+    fits_headers -- extra (name, value, comment) FITS headers for every frame
+    force -- regenerate outputs even if they are up to date
+    newer_than -- outputs modified before this time (for example the time
+                  the configuration was changed) are out of date
+    darks -- DarkSettings of the master darks, subtracted from the frames of
+             device configurations which take darks
+    '''
+    extensions = [ext for ext in extensions if not ext.lower().endswith('.raw')]
+
+    for source in find_raw_frames(input_directory):
+        parsed = parse_raw_filename(source)
+        if parsed is None:
+            logging.warning('Skipping RAW file with an unknown name: %s', source)
+            continue
+
+        filenames = output_filenames(source, input_directory, output_directory, extensions)
+
+        mtime = max(os.stat(source).st_mtime, newer_than)
+        if not force:
+            filenames = [fn for fn in filenames if not is_up_to_date(fn, mtime)]
+
+        if not filenames:
+            continue
+
+        headers = list(fits_headers) + [
+            ('DAYNIGHT', parsed.state.upper(), 'DAY or NIGHT'),
+        ]
+
+        yield ReprocessTask(
+            source=source,
+            filenames=filenames,
+            siteid=parsed.siteid,
+            device_config=device_configs[parsed.state],
+            fits_headers=headers,
+            darks=darks if device_configs[parsed.state].dark else None,
+        )
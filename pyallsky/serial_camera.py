@@ -1,9 +1,14 @@
+import json
 import logging
-import time
+import os
+import select
+import threading
 
 import serial
 
-from pyallsky.abstract_camera import AbstractCamera
+from pyallsky.abstract_camera import AbstractCamera, AllSkyException
+from pyallsky.transfer_timing import serial_byte_rate
+from pyallsky.util import write_atomic
 
 BAUD_RATE = {9600: 'B0',
              19200: 'B1',
@@ -13,86 +18,142 @@ BAUD_RATE = {9600: 'B0',
              230400: 'B5',
              460800: 'B6'}
 
+# serial port read timeout, the manual recommends 100ms for baud rate detection
+SERIAL_POLL_INTERVAL = 0.1
 
-class SerialCameraException:
+# time allowed for each response of the baud rate change handshake
+BAUD_HANDSHAKE_TIMEOUT = 0.5
+
+# the fastest baud rate the camera supports
+MAX_BAUD_RATE = max(BAUD_RATE)
+
+# number of image blocks received to verify a new baud rate (about 64 KiB)
+VERIFY_BLOCKS = 8
+
+
+class SerialCameraException(AllSkyException):
     pass
 
 
+class BaudRateCache(object):
+    '''
+    The last baud rate which worked for each serial device, optionally kept
+    in a JSON file across restarts, so that the baud rate detection can try
+    it first
+    '''
+
+    def __init__(self, filename=None):
+        '''
+        Create a BaudRateCache
+
+        filename -- the JSON file to keep the rates in, None to keep them in memory only
+        '''
+        self.filename = filename
+        self.rates = {}
+        self.lock = threading.Lock()
+
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    self.rates = dict((device, int(rate)) for device, rate in json.load(f).items())
+            except (OSError, ValueError, AttributeError) as ex:
+                logging.warning('Ignoring unreadable baud rate cache %s: %s', filename, str(ex))
+
+    def get(self, device):
+        '''The last good baud rate of a device, or None if unknown'''
+        with self.lock:
+            return self.rates.get(device)
+
+    def set(self, device, rate):
+        '''Remember the good baud rate of a device'''
+        with self.lock:
+            if self.rates.get(device) == rate:
+                return
+
+            self.rates[device] = rate
+            if self.filename is None:
+                return
+
+            text = json.dumps(self.rates, indent=2, sort_keys=True) + '\n'
+            try:
+                write_atomic(self.filename, lambda f: f.write(text.encode()))
+            except OSError as ex:
+                logging.warning('Unable to write baud rate cache %s: %s', self.filename, str(ex))
+
+# the baud rate cache used when none is given, it lasts for the process
+DEFAULT_BAUD_CACHE = BaudRateCache()
+
 class SerialCamera(AbstractCamera):
     '''
     Class to interact with the SBIG AllSky 340/340C camera, encapsulating the
     serial communication protocol, and providing a pythonic api to access the
     device.
 
-    Automatically determines the baud rate necessary for communication.
+    Automatically determines the baud rate necessary for communication,
+    trying the last good rate of the device first.
     '''
 
-    def __init__(self, device):
+    def __init__(self, device, baud_cache=None):
+        '''
+        Create a SerialCamera and find the camera's baud rate
+
+        device -- the serial device, for example /dev/ttyUSB0
+        baud_cache -- the BaudRateCache to use (default: DEFAULT_BAUD_CACHE)
+        '''
+        super().__init__()
+        self.device = device
+        self.baud_cache = baud_cache if baud_cache is not None else DEFAULT_BAUD_CACHE
         ser = serial.Serial(device)
 
         # defaults taken from the manual
-        ser.setBaudrate(9600)
+        ser.baudrate = 9600
         ser.bytesize = serial.EIGHTBITS
         ser.parity = serial.PARITY_NONE
         ser.stopbits = serial.STOPBITS_ONE
 
-        # set a short timeout for reads during baud rate detection
-        ser.timeout = 0.1
+        # the port timeout is never changed afterwards (changing it reconfigures
+        # the port), reads are instead repeated until their deadline passes
+        ser.timeout = SERIAL_POLL_INTERVAL
+
+        self.serial_connection = ser
 
         # Camera baud rate is initially unknown, so find it
-        if not self.autobaud(count=3):
+        if not self.autobaud(count=3, first=self.baud_cache.get(device)):
             logging.debug('Autodetect baud rate failed')
+            ser.close()
             raise SerialCameraException('Autodetect baud rate failed')
 
-        self.serial_connection = ser
-
     def camera_tx(self, data):
         self.serial_connection.write(data)
 
-    def camera_rx(self, nbytes, timeout=0.5):
-        tstart = time.time()
-        data = ''
-
-        while True:
-            # timeout has passed, break out of the loop
-            tcurrent = time.time()
-            tdiff = tcurrent - tstart
-            if tdiff > timeout:
-                break
-
-            # we have all the bytes, break out of the loop
-            remain = nbytes - len(data)
-            if remain == 0:
-                break
-
-            # append more bytes as they come in
-            data += self.serial_connection.read(remain)
-
-    def camera_rx_until(self, terminator, timeout=5.0):
-        tstart = time.time()
-        data = ''
+    def transport_read_into(self, buf, timeout):
+        # wait for data without touching the port timeout, which would
+        # otherwise reconfigure the port before every receive, then take
+        # everything that has arrived in the same read
+        readable, _, _ = select.select([self.serial_connection.fileno()], [], [], max(timeout, 0.0))
+        if not readable:
+            return 0
 
-        while True:
-            # timeout has passed, break out of the loop
-            tcurrent = time.time()
-            tdiff = tcurrent - tstart
-            if tdiff > timeout:
-                break
+        nbytes = min(len(buf), max(1, self.serial_connection.in_waiting))
+        return self.serial_connection.readinto(buf[:nbytes])
 
-            c = self.serial_connection.read(1)
-            if c == terminator:
-                break
+    def link_rate(self):
+        return serial_byte_rate(self.serial_connection.baudrate)
 
-            # terminator was not found, append the current byte
-            data += c
+    def close(self):
+        self.serial_connection.close()
 
-        return data
+    def get_baudrate(self):
+        '''Return the current baud rate of the serial connection'''
+        return self.serial_connection.baudrate
 
-    def camera_timeout_calc(self, nbytes):
-        # (bits_per_second / number_of_bits) * overhead_fudge_factor
-        return (self.serial_connection.getBaudrate() / (nbytes * 8)) * 1.5
+    def __set_port_rate(self, rate):
+        '''Change the baud rate of the serial port, discarding any received data'''
+        self.serial_connection.baudrate = rate
+        self.serial_connection.reset_input_buffer()
+        self.reader.clear()
 
-    def autobaud(self, count=3):
+    def autobaud(self, count=3, first=None):
         '''
         Automatic Baud Rate Detection
 
@@ -105,18 +166,117 @@ class SerialCamera(AbstractCamera):
         check the communications several times to clear out any leftover junk.
         This method has been found to be extremely reliable.
 
-        ser -- the serial.Serial() to receive from
+        The rates are tried from the slowest upwards. This includes 230400 and
+        460800, which the camera only uses after a change of the baud rate
+        (see upgrade_baudrate()): it keeps the new rate across power cycles,
+        so it must still be found when the last good rate is not known. They
+        come last, so a camera at one of the slower rates is found as quickly
+        as before.
+
         count -- the maximum number of attempts to communicate at each baud rate
+        first -- the baud rate to try first (the last good one)
 
         return -- True on success, False otherwise
         '''
+        rates = sorted(BAUD_RATE)
+        if first in BAUD_RATE:
+            rates.remove(first)
+            rates.insert(0, first)
+
         found = False
-        for rate in sorted(BAUD_RATE, key=BAUD_RATE.get)[:-2]:
+        for rate in rates:
             logging.debug('Testing baud rate %s', rate)
-            self.serial_connection.setBaudrate(rate)
+            self.__set_port_rate(rate)
             found = self.check_communications(count)
             if found:
                 logging.info('Autodetect baud rate successful %d', rate)
+                self.baud_cache.set(self.device, rate)
                 break
 
         return found
+
+    def set_baudrate(self, rate):
+        '''
+        Change the camera's baud rate with the handshake from the manual: the
+        camera answers "S" at the new rate, the computer sends "Test", the
+        camera replies "TestOk" and the computer confirms with "k". The
+        camera keeps the new rate in non-volatile storage.
+
+        If the handshake fails, the camera reverts to its previous rate, and
+        so does the serial port.
+
+        rate -- the new baud rate, one of BAUD_RATE
+
+        Exceptions:
+        SerialCameraException -- the rate is not supported or the handshake failed
+        '''
+        if rate not in BAUD_RATE:
+            raise SerialCameraException('Unsupported baud rate %s, expected one of: %s' %
+                                        (rate, ', '.join(str(r) for r in sorted(BAUD_RATE))))
+
+        previous = self.get_baudrate()
+        if rate == previous:
+            return
+
+        logging.info('Changing baud rate from %d to %d', previous, rate)
+        if not self.send_command(BAUD_RATE[rate]):
+            raise SerialCameraException('Baud rate change command to %d not acknowledged' % rate)
+
+        # the checksum echo came at the old rate, everything else at the new
+        # one (the input is not discarded, the "S" may already be there)
+        self.serial_connection.baudrate = rate
+
+        # the "S" can be lost while the port changes speed, the camera waits
+        # for "Test" regardless
+        if self.camera_rx(1, BAUD_HANDSHAKE_TIMEOUT) != b'S':
+            logging.debug('No "S" after the baud rate change command')
+
+        self.camera_tx(b'Test')
+        if self.camera_rx(6, BAUD_HANDSHAKE_TIMEOUT) == b'TestOk':
+            self.camera_tx(b'k')
+            if self.check_communications(3):
+                logging.info('Baud rate changed to %d', rate)
+                self.baud_cache.set(self.device, rate)
+                return
+
+        # the camera reverts by itself, wait until it has done so
+        self.__set_port_rate(previous)
+        if not self.check_communications(3) and not self.autobaud():
+            raise SerialCameraException('Baud rate change to %d failed, and the camera was lost' % rate)
+
+        raise SerialCameraException('Baud rate change to %d failed, still at %d' % (rate, self.get_baudrate()))
+
+    def upgrade_baudrate(self, max_rate=MAX_BAUD_RATE, verify_blocks=VERIFY_BLOCKS):
+        '''
+        Switch to the fastest baud rate (up to max_rate) at which the link is
+        reliable: each faster rate is tried from the fastest downwards, and
+        kept if a test transfer of verify_blocks image blocks succeeds
+        without errors. Otherwise the camera falls back to the rate it was at.
+
+        max_rate -- the fastest baud rate to try
+        verify_blocks -- the number of image blocks in each test transfer
+
+        return -- the baud rate in use afterwards
+        '''
+        original = self.get_baudrate()
+        for rate in sorted((r for r in BAUD_RATE if original < r <= max_rate), reverse=True):
+            try:
+                self.set_baudrate(rate)
+            except SerialCameraException as ex:
+                logging.warning('Unable to change baud rate: %s', str(ex))
+                if self.get_baudrate() != original:
+                    break
+                continue
+
+            if self.verify_transfer(verify_blocks):
+                logging.info('Baud rate upgraded from %d to %d', original, rate)
+                return rate
+
+            logging.warning('Test transfer failed at %d baud, falling back to %d', rate, original)
+            try:
+                self.set_baudrate(original)
+            except SerialCameraException as ex:
+                logging.warning('Unable to fall back: %s', str(ex))
+                break
+
+        return self.get_baudrate()
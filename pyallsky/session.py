@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+'''
+Persistent sessions with SBIG AllSky 340/340C cameras
+
+Opening a camera is expensive: a serial camera runs the baud rate detection,
+and a network camera connects to the serial to network convertor. A
+CameraSession keeps the connection open between captures, checks that the
+camera still answers (with the cheap communications test command) before
+handing it out after it has been idle, and reconnects when it does not,
+backing off exponentially while the camera stays unreachable.
+
+A capture which fails because the link dropped is retried on a fresh
+connection, so a short dropout of a network convertor costs seconds rather
+than a frame.
+'''
+
+import contextlib
+import logging
+import threading
+import time
+
+from pyallsky.abstract_camera import AllSkyException
+from pyallsky.serial_camera import SerialCamera, MAX_BAUD_RATE
+from pyallsky.tcp_camera import TcpCamera
+from pyallsky.util import is_network_device
+
+# a session which was used successfully within this many seconds is handed
+# out without a communications test
+DEFAULT_PROBE_INTERVAL = 30.0
+
+# number of communications tests sent before a camera is considered dead
+PROBE_COUNT = 2
+
+# the delay before reconnecting doubles after each failure, between these
+# limits (in seconds)
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+# number of times a capture is retried on a new connection
+DEFAULT_RETRIES = 1
+
+# length of the serial number response
+SERIAL_NUMBER_BYTES = 9
+
+class CameraUnavailable(AllSkyException):
+    '''The camera cannot be reached, and the next reconnection is not due yet'''
+    pass
+
+def open_camera(device, baud_cache=None):
+    '''
+    Open a camera on a serial device (for example /dev/ttyUSB0) or on a
+    serial to network convertor (host:port)
+
+    baud_cache -- the BaudRateCache of serial cameras (default: DEFAULT_BAUD_CACHE)
+
+    Exceptions:
+    OSError -- the device could not be opened
+    AllSkyException -- the camera does not answer
+
+    return -- an instance of SerialCamera or TcpCamera
+    '''
+    if is_network_device(device):
+        host, port = device.split(':')
+        return TcpCamera(host, int(port))
+
+    return SerialCamera(device, baud_cache=baud_cache)
+
+class CameraSession(object):
+    '''
+    A connection to one camera device, kept open and checked between uses
+
+    listener -- an optional function called as listener(event, session) on
+                each 'connect', 'failure' and 'probe_failure' event
+    '''
+
+    def __init__(self, device, probe_interval=DEFAULT_PROBE_INTERVAL, min_backoff=MIN_BACKOFF,
+                 max_backoff=MAX_BACKOFF, opener=open_camera, listener=None):
+        self.device = device
+        self.probe_interval = probe_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.opener = opener
+        self.listener = listener
+        self.lock = threading.RLock()
+
+        self.camera = None
+
+        # information read from the camera when connecting
+        self.serialno = None
+        self.fwvers = None
+        self.baudrate = None
+
+        # time.monotonic() of the last successful use, None to probe before
+        # the next use
+        self.last_ok = None
+
+        # consecutive failures, and the time.monotonic() at which the next
+        # connection attempt is allowed
+        self.failures = 0
+        self.retry_at = 0.0
+
+        # totals since the session was created
+        self.connects = 0
+        self.probes = 0
+        self.last_error = None
+
+    def __event(self, event):
+        if self.listener is not None:
+            self.listener(event, self)
+
+    @property
+    def connected(self):
+        return self.camera is not None
+
+    def connect(self):
+        '''
+        Open a new connection to the camera, and read its identification
+
+        Exceptions:
+        OSError -- the device could not be opened
+        AllSkyException -- the camera does not answer
+        '''
+        with self.lock:
+            self.close()
+
+            logging.info('Connecting to camera %s', self.device)
+            camera = self.opener(self.device)
+            try:
+                serialno = camera.serial_number()
+                if len(serialno) != SERIAL_NUMBER_BYTES:
+                    raise AllSkyException('Invalid serial number response: %r' % serialno)
+
+                self.serialno = serialno
+                self.fwvers = camera.firmware_version()
+                self.baudrate = camera.get_baudrate()
+            except Exception:
+                camera.close()
+                raise
+
+            self.camera = camera
+            self.connects += 1
+            self.failures = 0
+            self.last_ok = time.monotonic()
+            logging.info('Connected to camera %s: serialno=%s fwvers=%s baudrate=%s',
+                         self.device, self.serialno, self.fwvers, self.baudrate)
+            self.__event('connect')
+
+    def close(self):
+        '''Close the connection, the next use will connect again'''
+        with self.lock:
+            if self.camera is not None:
+                try:
+                    self.camera.close()
+                except OSError as ex:
+                    logging.debug('Error closing camera %s: %s', self.device, str(ex))
+
+                self.camera = None
+
+    def upgrade_baudrate(self, max_rate=MAX_BAUD_RATE):
+        '''
+        Switch a serial camera to the fastest reliable baud rate, up to
+        max_rate (see SerialCamera.upgrade_baudrate()). The baud rate of a
+        network convertor is configured on the convertor instead.
+
+        return -- the baud rate in use afterwards
+        '''
+        with self.lock:
+            camera = self.acquire()
+            if not hasattr(camera, 'upgrade_baudrate'):
+                logging.info('Camera %s baud rate is set on the network convertor', self.device)
+                return self.baudrate
+
+            self.baudrate = camera.upgrade_baudrate(max_rate)
+            self.last_ok = time.monotonic()
+            return self.baudrate
+
+    def failed(self, ex):
+        '''Drop the connection after an error, and delay the next connection attempt'''
+        with self.lock:
+            self.close()
+            self.last_error = str(ex)
+            backoff = min(self.max_backoff, self.min_backoff * 2 ** self.failures)
+            self.failures += 1
+            self.retry_at = time.monotonic() + backoff
+            logging.warning('Camera %s failed (%s), reconnecting in %.1f seconds', self.device, str(ex), backoff)
+            self.__event('failure')
+
+    def probe(self):
+        '''
+        Check that the camera still answers the communications test
+
+        return -- True if it does, False if there is no connection or no answer
+        '''
+        with self.lock:
+            if self.camera is None:
+                return False
+
+            self.probes += 1
+            try:
+                alive = self.camera.check_communications(PROBE_COUNT)
+            except OSError as ex:
+                logging.debug('Probe of camera %s failed: %s', self.device, str(ex))
+                alive = False
+
+            if alive:
+                self.last_ok = time.monotonic()
+            else:
+                self.__event('probe_failure')
+
+            return alive
+
+    def acquire(self):
+        '''
+        Return a healthy camera: the open connection, probed first if it has
+        been idle for more than probe_interval, or a new connection
+
+        Exceptions:
+        CameraUnavailable -- the camera cannot be reached
+
+        return -- an instance of AbstractCamera
+        '''
+        with self.lock:
+            idle = self.last_ok is None or time.monotonic() - self.last_ok > self.probe_interval
+            if self.camera is not None and idle and not self.probe():
+                self.failed(AllSkyException('No answer to the communications test'))
+
+            if self.camera is None:
+                wait = self.retry_at - time.monotonic()
+                if wait > 0:
+                    raise CameraUnavailable('Camera %s unavailable, next attempt in %.1f seconds (%s)' %
+                                            (self.device, wait, self.last_error))
+
+                try:
+                    self.connect()
+                except (OSError, AllSkyException) as ex:
+                    self.failed(ex)
+                    raise CameraUnavailable('Unable to connect to camera %s: %s' % (self.device, str(ex))) from ex
+
+            return self.camera
+
+    @contextlib.contextmanager
+    def use(self):
+        '''
+        Context manager holding a healthy camera for its body. An OSError
+        (the link itself failed) drops the connection, any other error makes
+        the next use probe the camera first.
+        '''
+        with self.lock:
+            camera = self.acquire()
+            try:
+                yield camera
+            except OSError as ex:
+                self.failed(ex)
+                raise
+            except Exception:
+                self.last_ok = None
+                raise
+
+            self.last_ok = time.monotonic()
+
+    def run(self, function, retries=DEFAULT_RETRIES):
+        '''
+        Call function(camera) with a healthy camera and return its result.
+        If it fails because the link failed (an OSError, or an error after
+        which the camera does not answer), it is retried on a new connection
+        once the backoff delay has passed.
+
+        function -- the function to call
+        retries -- the number of times to retry on a new connection
+        '''
+        for attempt in range(retries + 1):
+            failures = self.failures
+            try:
+                with self.use() as camera:
+                    return function(camera)
+            except CameraUnavailable:
+                # retry only if the camera failed just now (the probe or the
+                # connection), not while waiting for an earlier backoff
+                if attempt == retries or self.failures == failures:
+                    raise
+            except OSError:
+                if attempt == retries:
+                    raise
+            except AllSkyException as ex:
+                # the camera itself may be fine, only retry if it is not
+                if attempt == retries or self.probe():
+                    raise
+
+                self.failed(ex)
+
+            logging.warning('Retrying on a new connection to camera %s', self.device)
+            time.sleep(max(0.0, self.retry_at - time.monotonic()))
+
+class SessionManager(object):
+    '''
+    The sessions of all cameras used by a program, one per device, so that
+    every user of a device shares its connection
+    '''
+
+    def __init__(self, **kwargs):
+        '''
+        Create a SessionManager
+
+        kwargs -- arguments for each new CameraSession
+        '''
+        self.kwargs = kwargs
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, device):
+        '''Return the session of a device, created on first use (not yet connected)'''
+        with self.lock:
+            session = self.sessions.get(device)
+            if session is None:
+                session = CameraSession(device, **self.kwargs)
+                self.sessions[device] = session
+
+            return session
+
+    def close(self):
+        '''Close all connections'''
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
@@ -1,9 +1,43 @@
+import select
 import socket
-import time
 
 from pyallsky.abstract_camera import AbstractCamera
+from pyallsky.transfer_timing import serial_byte_rate
 
-FIXED_TCP_IMAGE_READ_TIMEOUT_SECONDS = 30
+# time allowed for the response to a command, across the network and the
+# serial line behind the convertor
+TCP_RESPONSE_TIMEOUT_SECONDS = 5.0
+
+# time allowed for opening the connection to the convertor
+TCP_CONNECT_TIMEOUT_SECONDS = 10.0
+
+# baud rate of the serial line between the convertor and the camera
+DEFAULT_SERIAL_BAUDRATE = 115200
+
+# TCP keepalive settings: start probing an idle connection after 30 seconds,
+# probe every 10 seconds and give up after 3 failed probes
+TCP_KEEPALIVE_IDLE_SECONDS = 30
+TCP_KEEPALIVE_INTERVAL_SECONDS = 10
+TCP_KEEPALIVE_COUNT = 3
+
+def configure_socket(sock):
+    '''
+    Configure a socket for low latency request/response traffic
+
+    Nagle's algorithm is disabled so that each command and block
+    acknowledgement leaves immediately, and keepalive is enabled so that
+    a dead connection to the serial to network convertor is detected.
+    '''
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    # the keepalive timing options are not available on all platforms
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE_IDLE_SECONDS)
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPALIVE_INTERVAL_SECONDS)
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TCP_KEEPALIVE_COUNT)
 
 
 class TcpCamera(AbstractCamera):
@@ -13,67 +47,62 @@ class TcpCamera(AbstractCamera):
     api to access the device.
 
     '''
-    def __init__(self, host, port):
+
+    default_timeout = TCP_RESPONSE_TIMEOUT_SECONDS
+
+    def __init__(self, host, port, baudrate=DEFAULT_SERIAL_BAUDRATE):
+        '''
+        Create a TcpCamera and connect to the convertor, raises OSError if
+        the convertor cannot be reached
+
+        baudrate -- the baud rate of the convertor's serial line to the camera,
+                    the nominal link rate until transfers have been measured
+        '''
         super().__init__()
         self.host = host
         self.port = port
+        self.baudrate = baudrate
+        self.socket = None
         self.connect(host, port)
 
 
     def connect(self, host, port):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self.socket.connect((host, int(port)))
-        except socket.error as e:
-            print('Error connecting to camera: %s' % e)
+        '''Open the connection to the convertor, raises OSError on failure'''
+        sock = socket.create_connection((host, int(port)), timeout=TCP_CONNECT_TIMEOUT_SECONDS)
+
+        # reads wait in select(), the socket itself stays blocking
+        sock.settimeout(None)
+        configure_socket(sock)
+        self.socket = sock
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
 
     def camera_tx(self, data):
-        for char in data:
-            if isinstance(char, str):
-                self.socket.send(char.encode())
-            elif isinstance(char, int):
-                self.socket.send(bytes([char]))
-            else:
-                self.socket.send(char)
-
-    def camera_rx(self, nbytes, timeout=FIXED_TCP_IMAGE_READ_TIMEOUT_SECONDS):
-        tstart = time.time()
-        self.socket.settimeout(timeout)
-        data = b''
-
-        while True:
-            # timeout has passed, break out of the loop
-            tcurrent = time.time()
-            tdiff = tcurrent - tstart
-            if tdiff > timeout:
-                break
-
-            # we have all the bytes, break out of the loop
-            remain = nbytes - len(data)
-            if remain == 0:
-                break
-
-            # append more bytes as they come in
-            data += self.socket.recv(remain)
-
-        return data
-
-    def camera_rx_until(self, terminator, timeout=5.0):
-        data = b''
-        start_time = time.time()
-        log_time = start_time + 1
-        while True:
-            if time.time() - start_time > timeout:
-                break
-            if time.time() > log_time:
-                log_time = time.time() + 1
-            chunk = self.socket.recv(1)
-            if chunk == terminator.encode():
-                break
-            if chunk == b'':
-                break
-            data += chunk
-        return data
-
-    def camera_timeout_calc(self, nbytes):
-        return FIXED_TCP_IMAGE_READ_TIMEOUT_SECONDS
+        # send the whole command (including checksum) as a single write
+        if isinstance(data, str):
+            data = data.encode()
+
+        self.socket.sendall(data)
+
+    def transport_read_into(self, buf, timeout):
+        # wait for data without touching the socket timeout, which would
+        # otherwise have to be changed before every receive
+        readable, _, _ = select.select([self.socket], [], [], timeout)
+        if not readable:
+            return 0
+
+        count = self.socket.recv_into(buf)
+        if count == 0:
+            raise ConnectionError('Connection closed by camera %s:%s' % (self.host, self.port))
+
+        return count
+
+    def link_rate(self):
+        return serial_byte_rate(self.baudrate)
+
+    def get_baudrate(self):
+        '''Return the baud rate of the convertor's serial line'''
+        return self.baudrate
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+'''
+Timing model for image downloads from SBIG AllSky 340/340C cameras
+
+The deadline for each image block is set from the latency and throughput
+measured on the recent blocks from the same camera, rather than from a
+fixed timeout: a slow link gets the time it really needs, and a dead link
+is noticed after a few block times instead of after a fixed 30 seconds.
+
+Until enough blocks have been measured, the deadline is based on the
+nominal rate of the link (the baud rate) with a generous margin.
+'''
+
+from collections import namedtuple
+
+from pyallsky.util import RollingStatistics
+
+# bits sent for each byte on the serial line, including start and stop bits
+BITS_PER_BYTE = 10
+
+# latency until the first byte of a block, assumed until measured (in seconds)
+DEFAULT_LATENCY = 0.1
+
+# percentile of the recent latency and byte time used for the deadline
+DEFAULT_PERCENTILE = 99
+
+# margin applied to the measured percentile
+DEFAULT_MARGIN = 2.0
+
+# margin applied to the nominal link rate, before enough blocks are measured
+NOMINAL_MARGIN = 3.0
+
+# number of measured blocks needed before the measurements are used
+MIN_SAMPLES = 10
+
+# number of recent blocks measured (two full frames)
+DEFAULT_WINDOW = 150
+
+# no block deadline is ever shorter than this (in seconds)
+MIN_TIMEOUT = 0.5
+
+# the deadline doubles after each timeout of the same block, up to 2 ** MAX_BACKOFF
+MAX_BACKOFF = 3
+
+# the percentiles are recomputed after this many new blocks (once per full
+# frame) rather than for every block, to keep the cost per block negligible
+RECOMPUTE_INTERVAL = 75
+
+# The current estimate of the image block timing on a link
+TransferEstimate = namedtuple('TransferEstimate', [
+    'latency',          # time from the block acknowledgement to its first byte (in seconds)
+    'byte_time',        # time to receive each further byte (in seconds)
+    'throughput',       # mean rate of the recent blocks, including latency (in bytes
+                        # per second), the nominal rate if none could be measured
+    'block_timeout',    # deadline for a block of the given size (in seconds)
+    'samples',          # number of blocks measured, zero if the nominal rate is used
+])
+
+def serial_byte_rate(baudrate):
+    '''The nominal number of bytes per second on a serial line'''
+    return float(baudrate) / BITS_PER_BYTE
+
+class TransferTimingModel(object):
+    '''
+    Learns the latency and per-byte time of image block transfers on one
+    link, and computes block deadlines from a high percentile of them
+    '''
+
+    def __init__(self, byte_rate, window=DEFAULT_WINDOW, percentile=DEFAULT_PERCENTILE,
+                 margin=DEFAULT_MARGIN, min_samples=MIN_SAMPLES):
+        '''
+        Create a TransferTimingModel
+
+        byte_rate -- the nominal rate of the link (in bytes per second)
+        window -- the number of recent blocks to learn from
+        percentile -- the percentile of the recent measurements to use
+        margin -- the factor applied to the percentile
+        min_samples -- the number of blocks needed before they are used
+        '''
+        self.window = window
+        self.percentile = percentile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.reset(byte_rate)
+
+    def reset(self, byte_rate):
+        '''Forget all measurements, for example after a baud rate change'''
+        self.byte_rate = byte_rate
+        self.latency = RollingStatistics(size=self.window)
+        self.byte_time = RollingStatistics(size=self.window)
+        self.throughput = RollingStatistics(size=self.window)
+
+        # the (latency, byte time) percentiles and the sample count they were computed at
+        self.__percentiles = None
+        self.__computed_at = 0
+
+    def add(self, latency, nbytes, duration):
+        '''
+        Add the measurement of a complete block
+
+        latency -- the time from the acknowledgement of the previous block to
+                   the first byte of this one, or None if not known
+        nbytes -- the number of bytes received after the first one
+        duration -- the time from the first byte to the last one (in seconds)
+        '''
+        self.byte_time.add(duration / nbytes)
+
+        # the rate includes the latency, blocks which arrive in a single
+        # network read would otherwise look infinitely fast
+        if latency is not None:
+            self.latency.add(latency)
+            duration += latency
+
+        if duration > 0:
+            self.throughput.add(nbytes / duration)
+
+    def measured(self):
+        '''Have enough blocks been measured to use the measurements'''
+        return len(self.byte_time) >= self.min_samples
+
+    def percentiles(self):
+        '''
+        The configured percentile of the recent latency (DEFAULT_LATENCY if
+        none was measured) and byte time, recomputed every RECOMPUTE_INTERVAL
+        blocks
+        '''
+        count = self.byte_time.count
+        if self.__percentiles is None or count - self.__computed_at >= RECOMPUTE_INTERVAL:
+            latency = self.latency.percentile(self.percentile)
+            if latency is None:
+                latency = DEFAULT_LATENCY
+
+            self.__percentiles = (latency, self.byte_time.percentile(self.percentile))
+            self.__computed_at = count
+
+        return self.__percentiles
+
+    def timeout(self, nbytes, retry=0):
+        '''
+        The deadline for receiving a block, measured from its request
+
+        nbytes -- the number of bytes in the block (including the checksum)
+        retry -- the number of times this block has already timed out
+        '''
+        if self.measured():
+            latency, byte_time = self.percentiles()
+            margin = self.margin
+        else:
+            latency = DEFAULT_LATENCY
+            byte_time = 1.0 / self.byte_rate
+            margin = NOMINAL_MARGIN
+
+        timeout = max(MIN_TIMEOUT, (latency + nbytes * byte_time) * margin)
+        return timeout * 2 ** min(retry, MAX_BACKOFF)
+
+    def estimate(self, nbytes):
+        '''
+        The current estimate of the link timing, for diagnostics
+
+        nbytes -- the block size to compute the deadline for
+
+        return -- an instance of TransferEstimate
+        '''
+        if not self.measured():
+            return TransferEstimate(
+                latency=DEFAULT_LATENCY,
+                byte_time=1.0 / self.byte_rate,
+                throughput=self.byte_rate,
+                block_timeout=self.timeout(nbytes),
+                samples=0,
+            )
+
+        # blocks which arrived within the clock resolution have no rate
+        throughput = self.throughput.mean()
+        if throughput is None:
+            throughput = self.byte_rate
+
+        latency, byte_time = self.percentiles()
+        return TransferEstimate(
+            latency=latency,
+            byte_time=byte_time,
+            throughput=throughput,
+            block_timeout=self.timeout(nbytes),
+            samples=len(self.byte_time),
+        )
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import logging
+from collections import deque
+
+import numpy
 
 def setup_logging(level=logging.INFO, stream=sys.stdout):
     # get the default logger instance
@@ -22,9 +26,69 @@ def setup_logging(level=logging.INFO, stream=sys.stdout):
     logger.addHandler(ch)
 
 
+def write_atomic(filename, write):
+    '''
+    Write a file by calling write(fileobj) on a temporary file which then
+    replaces filename, so readers (and memory maps) never see a partial file
+    '''
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+        write(f)
+
+    os.replace(tmpname, filename)
+
+
 def is_network_device(device):
     # a network device is identified by having a host followed by a colon followed by an integer port
     if ':' in device:
         host, port = device.split(':')
         return bool(host and port.isdigit())
     return False
+
+
+class RollingStatistics(object):
+    '''Summary statistics over the most recent samples of a measurement'''
+
+    def __init__(self, size=100):
+        '''
+        Create a RollingStatistics
+
+        size -- the number of most recent samples to keep
+        '''
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, value):
+        '''Add a new sample, discarding the oldest one if necessary'''
+        self.samples.append(value)
+        self.count += 1
+
+    def last(self):
+        '''The most recent sample, or None if there are no samples'''
+        return self.samples[-1] if self.samples else None
+
+    def mean(self):
+        '''The mean of the recent samples, or None if there are no samples'''
+        return float(numpy.mean(self.samples)) if self.samples else None
+
+    def percentile(self, pct):
+        '''The given percentile of the recent samples, or None if there are no samples'''
+        return float(numpy.percentile(self.samples, pct)) if self.samples else None
+
+    def summary(self):
+        '''Return a dictionary summarizing the recent samples'''
+        if not self.samples:
+            return {'count': self.count}
+
+        return {
+            'count': self.count,
+            'last': self.last(),
+            'mean': self.mean(),
+            'min': min(self.samples),
+            'max': max(self.samples),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+        }
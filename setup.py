@@ -13,7 +13,6 @@ setup(
     packages = ['pyallsky'],
     python_requires = '>=3.10',
     install_requires = [
-        'colour-demosaicing~=0.2.5',
         'matplotlib~=3.9.0',
         'daemonize~=2.5.0',
         'fitsio~=1.2.4',
@@ -25,8 +24,10 @@ setup(
     scripts = [
         'bin/allsky_capture_image',
         'bin/allsky_check_communications',
+        'bin/allsky_emulator',
         'bin/allsky_get_version',
         'bin/allsky_heater_control',
+        'bin/allsky_reprocess',
         'bin/allsky_set_baudrate',
         'bin/allsky_scheduler',
         'bin/allsky_shutter_control',
@@ -0,0 +1,48 @@
+'''
+The asyncio camera driver, against a scripted TCP peer
+'''
+
+import asyncio
+
+from pyallsky.async_camera import AsyncTcpCamera
+
+async def scripted_camera(replies, test):
+    '''
+    Run test(camera) with an AsyncTcpCamera connected to a server which sends
+    each of replies, with a short pause between them
+    '''
+    async def serve(reader, writer):
+        for reply in replies:
+            writer.write(reply)
+            await writer.drain()
+            await asyncio.sleep(0.05)
+
+        await reader.read()
+        writer.close()
+
+    server = await asyncio.start_server(serve, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        camera = await AsyncTcpCamera.create('127.0.0.1', port)
+        try:
+            return await test(camera)
+        finally:
+            await camera.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+def test_rx_until_timeout_returns_partial_reply():
+    async def test(camera):
+        return await camera.camera_rx_until('D', timeout=0.3)
+
+    assert asyncio.run(scripted_camera([b'EE', b'RR'], test)) == b'EERR'
+
+def test_rx_until_keeps_data_after_terminator():
+    async def test(camera):
+        first = await camera.camera_rx_until('D', timeout=1.0)
+        second = await camera.camera_rx_until('D', timeout=1.0)
+        rest = await camera.camera_rx(2, timeout=1.0)
+        return first, second, rest
+
+    assert asyncio.run(scripted_camera([b'EEDR', b'RD', b'OK'], test)) == (b'EE', b'RR', b'OK')
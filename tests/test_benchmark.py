@@ -0,0 +1,59 @@
+'''
+The regression gate of the benchmark suite
+'''
+
+import time
+
+from pyallsky import benchmark
+from pyallsky.benchmark import (BenchmarkResult, MEMORY_SLACK, TIME_SLACK, confirm_regressions,
+                                find_regressions)
+
+def result(name, fastest, median=None, peak_memory=1 << 20):
+    median = fastest if median is None else median
+    return BenchmarkResult(name=name, repeat=5, mean=median, min=fastest, max=median,
+                           peak_memory=peak_memory, median=median)
+
+def test_within_threshold():
+    baseline = {'a': result('a', 0.010)}
+    assert find_regressions([result('a', 0.012)], baseline) == []
+    assert len(find_regressions([result('a', 0.020)], baseline)) == 1
+
+def test_time_slack():
+    # +100% on a stage this fast is noise
+    baseline = {'a': result('a', TIME_SLACK / 4)}
+    assert find_regressions([result('a', TIME_SLACK / 2)], baseline) == []
+
+def test_noise_allowance():
+    # the same slowdown is accepted from a stage with a large spread
+    baseline = {'a': result('a', 0.010)}
+    assert len(find_regressions([result('a', 0.0145, median=0.0155)], baseline)) == 1
+    assert find_regressions([result('a', 0.0145, median=0.020)], baseline) == []
+
+def test_memory():
+    baseline = {'a': result('a', 0.010)}
+    assert find_regressions([result('a', 0.010, peak_memory=(1 << 20) + MEMORY_SLACK)], baseline) == []
+    assert len(find_regressions([result('a', 0.010, peak_memory=2 << 20)], baseline)) == 1
+
+def test_missing_baseline():
+    assert find_regressions([result('a', 1.0)], {}) == []
+
+def test_older_results():
+    # results written before the median was recorded
+    base = BenchmarkResult(name='a', repeat=5, mean=0.010, min=0.010, max=0.010, peak_memory=1 << 20)
+    assert find_regressions([result('a', 0.010)], {'a': base}) == []
+
+def test_confirm(monkeypatch):
+    monkeypatch.setattr(benchmark, 'STAGES', [
+        ('fast', lambda workdir: lambda: None),
+        ('slow', lambda workdir: lambda: time.sleep(0.02)),
+    ])
+
+    baseline = {'fast': result('fast', 0.001), 'slow': result('slow', 0.001)}
+
+    # a slowdown which does not persist is dropped, a real one is kept
+    results = [result('fast', 0.020), result('slow', 0.020)]
+    results = confirm_regressions(results, baseline, repeat=2)
+
+    assert results[0].min < 0.001
+    assert results[1].min >= 0.02
+    assert [message.split(':')[0] for message in find_regressions(results, baseline)] == ['slow']
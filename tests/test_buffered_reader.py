@@ -0,0 +1,79 @@
+'''
+The BufferedReader, over a fake transport delivering fixed chunks
+'''
+
+import time
+
+from pyallsky.buffered_reader import BufferedReader, DIRECT_READ_THRESHOLD
+
+class ChunkTransport(object):
+    '''A transport which delivers the given chunks, one per receive'''
+
+    def __init__(self, *chunks):
+        self.chunks = [bytes(chunk) for chunk in chunks]
+        self.reads = []
+
+    def read_into(self, buf, timeout):
+        self.reads.append(len(buf))
+        if not self.chunks:
+            time.sleep(min(timeout, 0.001))
+            return 0
+
+        chunk = self.chunks.pop(0)
+        count = min(len(chunk), len(buf))
+        buf[:count] = chunk[:count]
+        if count < len(chunk):
+            self.chunks.insert(0, chunk[count:])
+
+        return count
+
+def deadline(seconds=0.05):
+    return time.monotonic() + seconds
+
+def test_read_exactly_across_chunks():
+    reader = BufferedReader(ChunkTransport(b'ab', b'cde', b'fgh').read_into)
+    assert reader.read_exactly(4, deadline()) == b'abcd'
+    assert reader.read_exactly(4, deadline()) == b'efgh'
+
+def test_read_exactly_timeout():
+    reader = BufferedReader(ChunkTransport(b'abc').read_into)
+    assert reader.read_exactly(5, deadline()) == b'abc'
+    assert reader.buffered() == 0
+
+def test_read_until():
+    reader = BufferedReader(ChunkTransport(b'Test', b'Ok\x1aE').read_into)
+    assert reader.read_until(b'\x1a', deadline()) == b'TestOk'
+    assert reader.read_exactly(1, deadline()) == b'E'
+
+def test_read_until_split_terminator():
+    reader = BufferedReader(ChunkTransport(b'abc\r', b'\ndef').read_into)
+    assert reader.read_until(b'\r\n', deadline()) == b'abc'
+    assert reader.read_exactly(3, deadline()) == b'def'
+
+def test_read_until_timeout():
+    reader = BufferedReader(ChunkTransport(b'abc').read_into)
+    assert reader.read_until(b'\x1a', deadline()) == b'abc'
+
+def test_direct_read():
+    # large requests are received straight into the destination
+    data = bytes(range(256)) * 16
+    transport = ChunkTransport(data)
+    reader = BufferedReader(transport.read_into, size=64)
+
+    dest = bytearray(len(data))
+    assert reader.readinto_exactly(dest, deadline()) == len(data)
+    assert dest == data
+    assert transport.reads == [len(data)]
+    assert len(data) >= DIRECT_READ_THRESHOLD
+
+def test_buffer_grows_and_compacts():
+    reader = BufferedReader(ChunkTransport(b'x' * 100, b'y' * 100 + b'\x1a', b'tail').read_into, size=64)
+    assert reader.read_until(b'\x1a', deadline()) == b'x' * 100 + b'y' * 100
+    assert reader.read_exactly(4, deadline()) == b'tail'
+
+def test_clear():
+    reader = BufferedReader(ChunkTransport(b'abcdef').read_into)
+    assert reader.read_exactly(2, deadline()) == b'ab'
+    assert reader.buffered() == 4
+    reader.clear()
+    assert reader.read_exactly(1, deadline()) == b''
@@ -0,0 +1,121 @@
+'''
+The frame cadence, driven by a FakeClock
+'''
+
+import datetime
+
+import pytest
+
+from pyallsky.cadence import CATCH_UP, SKIP, Cadence, FakeClock
+
+START = datetime.datetime(2026, 1, 1, 0, 0, 17, 500000)
+
+def make_cadence(policy=SKIP, **kwargs):
+    clock = FakeClock(START)
+    return Cadence(60.0, policy=policy, clock=clock, **kwargs), clock
+
+def test_anchor_to_minute():
+    cadence, clock = make_cadence()
+    tick = cadence.wait()
+
+    assert tick.slot == 0
+    assert tick.utctime == datetime.datetime(2026, 1, 1, 0, 1)
+    assert clock.utcnow() == tick.utctime
+    assert tick.deadline == clock.monotonic() + 60.0
+    assert not tick.late
+
+def test_on_time():
+    cadence, clock = make_cadence()
+    for slot in range(5):
+        tick = cadence.wait()
+        assert tick.slot == slot
+        assert tick.delay == 0.0
+        clock.advance(10.0)
+
+    assert cadence.skipped == 0
+
+def test_no_drift():
+    cadence, clock = make_cadence()
+    for _ in range(10000):
+        tick = cadence.wait()
+        clock.advance(37.3)
+
+    assert tick.utctime == datetime.datetime(2026, 1, 1, 0, 1) + datetime.timedelta(minutes=9999)
+
+def test_skip_within_grace():
+    cadence, clock = make_cadence(grace=5.0)
+    cadence.wait()
+    clock.advance(63.0)
+
+    tick = cadence.wait()
+    assert tick.slot == 1
+    assert tick.late
+    assert tick.delay == pytest.approx(3.0)
+    assert tick.skipped == 0
+
+def test_skip_late_slots():
+    cadence, clock = make_cadence(grace=5.0)
+    cadence.wait()
+    clock.advance(200.0)
+
+    # slots 1 to 3 are due, and 3 is 20 seconds late: all are skipped
+    tick = cadence.wait()
+    assert tick.slot == 4
+    assert not tick.late
+    assert tick.skipped == 3
+    assert cadence.skipped == 3
+    assert tick.utctime == datetime.datetime(2026, 1, 1, 0, 5)
+
+def test_catch_up():
+    cadence, clock = make_cadence(CATCH_UP, max_catch_up=3)
+    cadence.wait()
+    clock.advance(200.0)
+
+    # slots 1 to 3 are run one after the other, then the grid is kept again
+    ticks = []
+    for _ in range(4):
+        ticks.append(cadence.wait())
+        clock.advance(1.0)
+
+    assert [tick.slot for tick in ticks] == [1, 2, 3, 4]
+    assert [tick.late for tick in ticks] == [True, True, True, False]
+    assert cadence.skipped == 0
+
+def test_catch_up_limit():
+    cadence, clock = make_cadence(CATCH_UP, max_catch_up=2)
+    cadence.wait()
+    clock.advance(400.0)
+
+    # slots 1 to 6 are due, only the most recent late ones are run
+    tick = cadence.wait()
+    assert tick.slot == 4
+    assert tick.late
+    assert tick.skipped == 3
+    assert cadence.wait().slot == 5
+
+def test_wall_clock_step():
+    cadence, clock = make_cadence()
+    cadence.wait()
+    clock.advance(10.0)
+    clock.step(3600.0)
+
+    # anchored again to the next minute of the new wall clock
+    tick = cadence.wait()
+    assert cadence.steps == 1
+    assert tick.slot == 0
+    assert tick.utctime == datetime.datetime(2026, 1, 1, 1, 2)
+    assert clock.utcnow() == tick.utctime
+
+def test_small_clock_change():
+    cadence, clock = make_cadence()
+    cadence.wait()
+    clock.step(0.5)
+
+    assert cadence.wait().slot == 1
+    assert cadence.steps == 0
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        Cadence(0.0)
+    with pytest.raises(ValueError):
+        Cadence(60.0, policy='never')
@@ -0,0 +1,147 @@
+'''
+The master dark library, and dark subtraction with scaled masters
+'''
+
+import datetime
+import json
+import os
+
+import numpy
+import pytest
+
+from pyallsky.abstract_camera import FRAME_HEIGHT, FRAME_WIDTH
+from pyallsky.darklibrary import DarkLibrary, BIAS_EXPOSURE, exposure_key
+from pyallsky.imagecapture import AllSkyImage
+from pyallsky.imageprocessor import subtract_dark
+
+SERIALNO = b'EMU000001'
+BIAS = 1000.0
+DARK_CURRENT = 50.0
+
+def expected_dark(exposure):
+    '''The noiseless dark: a bias pedestal plus dark current growing linearly with the exposure'''
+    rows = numpy.linspace(0.5, 1.5, FRAME_HEIGHT).reshape((FRAME_HEIGHT, 1))
+    return BIAS + DARK_CURRENT * exposure * rows * numpy.ones((1, FRAME_WIDTH))
+
+def dark_frame(exposure, seed=0):
+    '''A dark with a bias pedestal and dark current growing with the exposure'''
+    rng = numpy.random.default_rng(seed)
+    data = expected_dark(exposure) + rng.normal(0.0, 2.0, (FRAME_HEIGHT, FRAME_WIDTH))
+    return AllSkyImage(timestamp=datetime.datetime(2024, 1, 1), exposure=exposure,
+                       data=numpy.rint(data).astype(numpy.uint16).tobytes())
+
+def test_master_is_median(tmp_path):
+    library = DarkLibrary(str(tmp_path), frames=3)
+    for seed in range(3):
+        master = library.add(SERIALNO, dark_frame(1.0, seed))
+
+    assert master.frames == 3
+    assert master.level == pytest.approx(BIAS + DARK_CURRENT, abs=1.0)
+
+    # the library is reloaded from disk
+    library = DarkLibrary(str(tmp_path))
+    assert library.master(SERIALNO, 1.0) == master
+
+def test_nearest_exact(tmp_path):
+    library = DarkLibrary(str(tmp_path))
+    library.add(SERIALNO, dark_frame(1.0))
+
+    dark = library.nearest(SERIALNO, 1.0)
+    assert dark.exposure == 1.0
+    assert library.nearest(SERIALNO, 3.0) is None
+    assert library.nearest(b'OTHER0000', 1.0) is None
+
+def test_scaled_dark_keeps_bias(tmp_path):
+    library = DarkLibrary(str(tmp_path))
+    library.add(SERIALNO, dark_frame(BIAS_EXPOSURE))
+    library.add(SERIALNO, dark_frame(1.0))
+    assert library.bias_level(SERIALNO) == pytest.approx(BIAS, abs=1.0)
+
+    # a light frame of twice the exposure, with a flat sky level
+    sky = 200.0
+    light = numpy.frombuffer(dark_frame(2.0, seed=9).data, dtype=numpy.uint16) + numpy.uint16(sky)
+    light = light.reshape((FRAME_HEIGHT, FRAME_WIDTH))
+
+    dark = library.nearest(SERIALNO, 2.0)
+    assert dark.exposure == 2.0
+
+    result = subtract_dark(light, dark, 2.0)
+    assert numpy.median(result) == pytest.approx(sky, abs=2.0)
+
+@pytest.mark.parametrize('exposure', [0.5, 1.5])
+def test_scaled_master_matches_expected(tmp_path, exposure):
+    library = DarkLibrary(str(tmp_path), frames=3)
+    for seed in range(3):
+        library.add(SERIALNO, dark_frame(BIAS_EXPOSURE, seed))
+        library.add(SERIALNO, dark_frame(1.0, seed + 10))
+
+    # the bias frame is never used as a dark
+    assert library.nearest(SERIALNO, 0.6).exposure == 0.6
+
+    dark = library.nearest(SERIALNO, exposure)
+    error = numpy.asarray(dark.data, dtype=numpy.float64) - expected_dark(exposure)
+    assert abs(numpy.mean(error)) < 0.5
+    assert numpy.max(numpy.abs(error)) < 10.0
+
+def test_sub_millisecond_dark_next_to_bias(tmp_path):
+    # exposures below half a millisecond are not bias frames
+    library = DarkLibrary(str(tmp_path))
+    library.add(SERIALNO, dark_frame(BIAS_EXPOSURE))
+    library.add(SERIALNO, dark_frame(0.0004))
+    assert exposure_key(0.0004) != exposure_key(BIAS_EXPOSURE)
+
+    assert library.master(SERIALNO, BIAS_EXPOSURE).exposure == BIAS_EXPOSURE
+    assert library.nearest(SERIALNO, 0.0004).exposure == 0.0004
+    assert len(os.listdir(str(tmp_path))) == 4
+
+def test_exposures_in_camera_steps(tmp_path):
+    # darks of different exposures are never combined into one master
+    library = DarkLibrary(str(tmp_path))
+    library.add(SERIALNO, dark_frame(0.0012))
+    library.add(SERIALNO, dark_frame(0.0014))
+    assert library.master(SERIALNO, 0.0012).frames == 1
+    assert library.master(SERIALNO, 0.0014).frames == 1
+
+def test_master_with_millisecond_name(tmp_path):
+    # a master saved before the keys had 100 microsecond resolution
+    library = DarkLibrary(str(tmp_path))
+    master = library.add(SERIALNO, dark_frame(1.0))
+    base = os.path.splitext(master.filename)[0]
+    os.rename(master.filename, str(tmp_path / 'dark_EMU000001_1000ms.npy'))
+    os.remove(base + '.json')
+    with open(str(tmp_path / 'dark_EMU000001_1000ms.json'), 'w') as f:
+        json.dump({'serialno': master.serialno, 'exposure': 1.0, 'timestamp': master.timestamp.isoformat(),
+                   'frames': 1, 'filename': 'dark_EMU000001_1000ms.npy'}, f)
+
+    library = DarkLibrary(str(tmp_path))
+    assert library.nearest(SERIALNO, 1.0).exposure == 1.0
+
+    # the next dark replaces it with a master under the new name
+    master = library.add(SERIALNO, dark_frame(1.0, seed=1))
+    assert master.frames == 2
+    assert sorted(os.listdir(str(tmp_path))) == ['dark_EMU000001_1000000us.json', 'dark_EMU000001_1000000us.npy']
+
+def test_configured_bias(tmp_path):
+    library = DarkLibrary(str(tmp_path), bias=BIAS)
+    library.add(SERIALNO, dark_frame(1.0))
+    assert library.bias_level(SERIALNO) == BIAS
+
+    dark = library.nearest(SERIALNO, 0.5)
+    assert numpy.median(dark.data) == pytest.approx(numpy.median(expected_dark(0.5)), abs=1.0)
+
+def test_unknown_bias_scales_proportionally(tmp_path):
+    library = DarkLibrary(str(tmp_path))
+    library.add(SERIALNO, dark_frame(1.0))
+    assert library.bias_level(SERIALNO) is None
+
+    dark = library.nearest(SERIALNO, 0.5)
+    assert numpy.median(dark.data) == pytest.approx(numpy.median(expected_dark(1.0)) * 0.5, abs=1.0)
+
+def test_subtract_dark_bias():
+    dark = dark_frame(1.0)
+    light = numpy.frombuffer(dark_frame(0.5, seed=9).data, dtype=numpy.uint16)
+    light = light.reshape((FRAME_HEIGHT, FRAME_WIDTH)) + numpy.uint16(100)
+
+    # scaling the bias with the dark current subtracts far too little
+    assert numpy.median(subtract_dark(light, dark, 0.5)) > 500
+    assert numpy.median(subtract_dark(light, dark, 0.5, bias=BIAS)) == pytest.approx(100, abs=2.0)
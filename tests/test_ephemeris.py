@@ -0,0 +1,60 @@
+'''
+The sun event table, checked against the pyephem search it replaces
+'''
+
+import datetime
+
+import numpy
+import pytest
+
+from pyallsky.ephemeris import (SunEventTable, calculate_exposure, compensation, compute_sun,
+                                make_observer, plan_exposures)
+
+SITES = [(34.4, -119.8), (-30.17, -70.8), (60.0, 10.0)]
+START = datetime.datetime(2026, 3, 1, 0, 0, 7)
+
+@pytest.mark.parametrize('latitude, longitude', SITES)
+def test_table_matches_pyephem(latitude, longitude):
+    table = SunEventTable(make_observer(latitude, longitude, 100), days=2)
+    reference = make_observer(latitude, longitude, 100)
+
+    # five days in 37 minute steps, which extends the table twice
+    for step in range(0, 5 * 24 * 60, 37):
+        utctime = START + datetime.timedelta(minutes=step)
+        expected = compute_sun(reference, utctime)
+        sun = table.sun(utctime)
+
+        assert sun.state == expected.state
+        for field in ('prev_sunrise', 'next_sunrise', 'prev_sunset', 'next_sunset'):
+            assert abs((getattr(sun, field) - getattr(expected, field)).total_seconds()) < 1.0
+
+def test_table_backwards():
+    observer = make_observer(*SITES[0], 10)
+    table = SunEventTable(observer)
+    table.sun(START + datetime.timedelta(days=30))
+
+    utctime = START - datetime.timedelta(days=30)
+    assert table.sun(utctime).state == compute_sun(make_observer(*SITES[0], 10), utctime).state
+
+def test_compensation():
+    # ten times the exposure at sunrise, back to nominal an hour later
+    assert compensation(True, 0, 600, 0.001) == pytest.approx(0.01)
+    assert compensation(True, 30, 600, 0.001) == pytest.approx(0.005)
+    assert compensation(True, 90, 600, 0.001) == pytest.approx(0.001)
+    assert compensation(True, 600, 30, 0.001) == pytest.approx(0.005)
+    assert compensation(False, 0, 0, 30.0) == 30.0
+
+def test_plan_matches_lookups():
+    table = SunEventTable(make_observer(*SITES[0], 10))
+    plan = plan_exposures(table, START, START + datetime.timedelta(days=3), 60.0, 0.001, 30.0)
+    assert len(plan.times) == 3 * 24 * 60
+
+    for i in range(0, len(plan.times), 7):
+        utctime = plan.times[i].astype(datetime.datetime)
+        sun = table.sun(utctime)
+        exposure = calculate_exposure(sun, 0.001 if sun.state == 'day' else 30.0)
+
+        assert plan.day[i] == (sun.state == 'day')
+        assert plan.exposures[i] == exposure
+
+    assert numpy.any(plan.day) and not numpy.all(plan.day)
@@ -0,0 +1,110 @@
+'''
+RAW file names, and loading RAW files with their FITS sidecars
+'''
+
+import datetime
+import os
+import time
+from collections import namedtuple
+
+import fitsio
+import numpy
+import pytest
+
+from pyallsky.abstract_camera import FRAME_BYTES
+from pyallsky.emulator import EmulatorSettings, TcpEmulator
+from pyallsky.imagecapture import (capture_image_device, capture_image_file, parse_raw_filename, raw_filename_base,
+                                   read_sidecar_metadata)
+from pyallsky.session import SessionManager
+from pyallsky.tcp_camera import TcpCamera
+
+DeviceConfiguration = namedtuple('DeviceConfiguration', ['device'])
+
+@pytest.fixture
+def local_time_zone():
+    '''Run in a time zone far from UTC'''
+    saved = os.environ.get('TZ')
+    os.environ['TZ'] = 'America/Los_Angeles'
+    time.tzset()
+    yield
+    if saved is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = saved
+    time.tzset()
+
+def test_raw_filename(local_time_zone):
+    utctime = datetime.datetime(2026, 7, 1, 12, 30, 5)
+    base = raw_filename_base('tst', utctime, 'day')
+    assert base == 'tst-1782909005-day'
+
+    parsed = parse_raw_filename('/data/2026-07-01/' + base + '.raw')
+    assert parsed.siteid == 'tst'
+    assert parsed.timestamp == utctime
+    assert parsed.state == 'day'
+
+def test_raw_filename_site_with_dash():
+    parsed = parse_raw_filename('lco-ogg-1782909005-night.raw')
+    assert parsed.siteid == 'lco-ogg'
+    assert parsed.state == 'night'
+
+@pytest.mark.parametrize('filename', ['tst-1782909005-day.fits', 'tst-abc-day.raw', 'tst-1782909005-dusk.raw'])
+def test_not_raw_filename(filename):
+    assert parse_raw_filename(filename) is None
+
+def test_timestamp_from_filename(tmp_path, local_time_zone):
+    # without a FITS sidecar, the timestamp comes from the name
+    utctime = datetime.datetime(2026, 1, 15, 3, 0, 0)
+    filename = tmp_path / (raw_filename_base('tst', utctime, 'night') + '.raw')
+    filename.write_bytes(bytes(FRAME_BYTES))
+
+    image = capture_image_file(str(filename), 30.0)
+    assert image.timestamp == utctime
+    assert image.exposure == 30.0
+
+@pytest.mark.parametrize('ext, compress', [('.fits', None), ('.fits.fz', 'RICE')])
+def test_sidecar_headers(tmp_path, ext, compress):
+    base = str(tmp_path / raw_filename_base('tst', datetime.datetime(2026, 1, 15, 3, 0, 0), 'night'))
+    headers = [
+        {'name': 'DATE-OBS', 'value': '2026-01-15T03:00:00', 'comment': '[UTC] Date of observation'},
+        {'name': 'EXPTIME', 'value': '30.000000', 'comment': '[s] Exposure length'},
+        {'name': 'SERIALNO', 'value': 'A1234', 'comment': 'Camera Serial Number'},
+    ]
+    fitsio.write(base + ext, numpy.zeros((480, 640), dtype=numpy.uint16), compress=compress, header=headers)
+
+    # only the headers of the frame, not those describing the file layout
+    metadata = read_sidecar_metadata(base + '.raw')
+    assert metadata.timestamp == datetime.datetime(2026, 1, 15, 3, 0, 0)
+    assert metadata.exposure == 30.0
+    assert metadata.headers == headers
+
+@pytest.fixture
+def emulator():
+    emulator = TcpEmulator(EmulatorSettings(readout_time=0.0, seed=1)).start()
+    yield emulator
+    emulator.stop()
+
+def test_capture_device_closes_connection(emulator):
+    device_config = DeviceConfiguration(device=emulator.device)
+    image = capture_image_device(device_config, 0.001)
+    assert bytes(image.data) == emulator.camera.frame
+
+    # the emulator serves one connection at a time, so a new connection only
+    # gets an answer if the capture closed its own
+    host, port = emulator.device.split(':')
+    camera = TcpCamera(host, int(port))
+    assert camera.check_communications()
+    camera.close()
+
+def test_capture_device_with_sessions(emulator):
+    sessions = SessionManager()
+    device_config = DeviceConfiguration(device=emulator.device)
+    capture_image_device(device_config, 0.001, sessions=sessions)
+    capture_image_device(device_config, 0.001, sessions=sessions)
+
+    session = sessions.session(emulator.device)
+    assert session.connected
+    assert session.connects == 1
+
+    sessions.close()
+    assert not session.connected
@@ -0,0 +1,255 @@
+'''
+The 8-bit display conversion and the device configuration
+'''
+
+import configparser
+import datetime
+import os
+
+import fitsio
+import numpy
+import pytest
+
+from pyallsky import imageprocessor
+from pyallsky.imagecapture import AllSkyImage
+from pyallsky.imageprocessor import (AllSkyDeviceConfiguration, AllSkyImageProcessor, apply_gamma, build_display_lut, circle_mask,
+                                     circle_mask_index, compute_stretch, create_circle_mask, histogram_percentiles,
+                                     histogram_uint16, select_pixels, stretch_dynamic_range,
+                                     display_8bit, maximize_dynamic_range, products_needed, read_device_configuration,
+                                     scale_to_8bit)
+
+def make_image(color):
+    rng = numpy.random.default_rng(0)
+    shape = (480, 640, 3) if color else (480, 640)
+    return rng.gamma(2.0, 3000.0, size=shape).clip(0, 65535).astype(numpy.uint16)
+
+def stepwise_8bit(data, mask, stretch, gamma):
+    '''The display conversion as separate full frame steps'''
+    if stretch:
+        data = maximize_dynamic_range(data, mask)
+    if gamma != 1.0:
+        data = apply_gamma(data, gamma)
+    return scale_to_8bit(data)
+
+@pytest.mark.parametrize('color', [False, True])
+@pytest.mark.parametrize('gamma', [1.0, 2.2, 0.45])
+@pytest.mark.parametrize('stretch', [True, False])
+def test_display_8bit_matches_steps(color, gamma, stretch):
+    data = make_image(color)
+    mask = circle_mask_index(data.shape[0:2])
+
+    result = display_8bit(data, mask, stretch=stretch, gamma=gamma)
+    assert result.dtype == numpy.uint8
+    assert result.shape == data.shape
+    assert numpy.array_equal(result, stepwise_8bit(data, mask, stretch, gamma))
+
+def test_display_lut_matches_steps():
+    # the lookup table is identical even where display_8bit does not use it
+    data = make_image(False)
+    mask = circle_mask_index(data.shape)
+    lower, upper, _ = compute_stretch(data, mask)
+
+    lut = build_display_lut(lower, upper)
+    assert numpy.array_equal(lut.take(data), stepwise_8bit(data, mask, True, 1.0))
+
+def make_config(gamma):
+    config = configparser.ConfigParser()
+    config['day'] = {
+        'device': '/dev/ttyUSB0',
+        'exposure': '0.001',
+        'dark': 'false',
+        'debayer': 'true',
+        'grayscale': 'false',
+        'postprocess': 'true',
+        'rotate180': 'false',
+        'overlay': 'false',
+        'heating': 'false',
+        'gamma': gamma,
+    }
+    return config
+
+def test_gamma_configuration():
+    assert read_device_configuration(make_config('2.2'), 'day').gamma == 2.2
+
+@pytest.mark.parametrize('gamma', ['0', '-1.0', 'nan', 'inf'])
+def test_invalid_gamma(gamma):
+    with pytest.raises(ValueError):
+        read_device_configuration(make_config(gamma), 'day')
+
+def make_processor(debayer, demosaic='malvar', postprocess=False):
+    image = AllSkyImage(timestamp=datetime.datetime(2026, 1, 1), exposure=1.0, data=make_image(False).tobytes())
+    config = AllSkyDeviceConfiguration(
+        device='', exposure=1.0, dark=False, debayer=debayer, grayscale=False, postprocess=postprocess,
+        rotate180=False, overlay=False, heating=False, demosaic=demosaic,
+    )
+    return AllSkyImageProcessor('tst', image, config)
+
+def save_fits(tmp_path, debayer, demosaic):
+    filename = str(tmp_path / 'image.fits')
+    make_processor(debayer, demosaic).save_fits(filename)
+    return fitsio.read(filename, header=True)
+
+@pytest.mark.parametrize('debayer, demosaic, shape, datamode', [
+    (False, 'superpixel', (480, 640), '1X1 BIN'),
+    (True, 'malvar', (480, 640), '1X1 BIN'),
+    (True, 'superpixel', (240, 320), '2X2 BIN'),
+])
+def test_fits_datamode(tmp_path, debayer, demosaic, shape, datamode):
+    data, header = save_fits(tmp_path, debayer, demosaic)
+    assert data.shape == shape
+    assert header['DATAMODE'] == datamode
+
+@pytest.mark.parametrize('debayer, dtype', [
+    (False, numpy.uint16),
+    (True, numpy.float64),
+])
+def test_fits_dtype(tmp_path, debayer, dtype):
+    data, header = save_fits(tmp_path, debayer, 'malvar')
+    assert data.dtype == dtype
+
+def meshgrid_circle_mask(shape, rad_frac=0.92):
+    '''The original circle mask, built from two full meshgrids'''
+    ny, nx = shape
+    xx, yy = numpy.meshgrid(1 + numpy.arange(nx), 1 + numpy.arange(ny))
+    pix_rad = max(0.5 * nx * rad_frac, 0.5 * ny * rad_frac)
+    return numpy.sqrt((xx - 0.5 * (nx + 1)) ** 2 + (yy - 0.5 * (ny + 1)) ** 2) <= pix_rad
+
+@pytest.mark.parametrize('shape', [(480, 640), (240, 320), (7, 5)])
+def test_circle_mask_matches_meshgrid(shape):
+    assert numpy.array_equal(circle_mask(shape), meshgrid_circle_mask(shape))
+    assert numpy.array_equal(circle_mask_index(shape), numpy.flatnonzero(meshgrid_circle_mask(shape)))
+
+def test_circle_mask_is_cached():
+    mask = circle_mask((480, 640))
+    assert circle_mask((480, 640)) is mask
+    assert circle_mask([480, 640], 0.92) is mask
+    assert create_circle_mask(make_image(True)) is mask
+    assert circle_mask_index((480, 640)) is circle_mask_index((480, 640))
+
+    # shared between all callers, so nobody may modify it
+    with pytest.raises(ValueError):
+        mask[0, 0] = True
+    with pytest.raises(ValueError):
+        circle_mask_index((480, 640))[0] = 0
+
+@pytest.mark.parametrize('color', [False, True])
+def test_select_pixels_index_matches_mask(color):
+    data = make_image(color)
+    mask = circle_mask(data.shape[0:2])
+    expected = data[mask]
+
+    assert numpy.array_equal(select_pixels(data, mask), expected)
+    assert numpy.array_equal(select_pixels(data, circle_mask_index(data.shape[0:2])), expected)
+    assert select_pixels(data, None) is data
+
+@pytest.mark.parametrize('color', [False, True])
+@pytest.mark.parametrize('pct', [(2.5, 97.5), (0, 100), (0.1, 99.9), (50, 50)])
+def test_stretch_matches_percentile(color, pct):
+    data = make_image(color)
+    index = circle_mask_index(data.shape[0:2])
+
+    expected = numpy.percentile(select_pixels(data, index).astype(numpy.float64), pct)
+    params = compute_stretch(data, index, pct)
+    assert numpy.allclose((params.lower, params.upper), expected, rtol=0, atol=1e-9)
+    assert params.histogram.sum() == select_pixels(data, index).size
+
+@pytest.mark.parametrize('pixels', [
+    [7],
+    [3, 3, 3, 3],
+    [0, 65535],
+    [1, 2, 2, 9, 40000, 40001],
+])
+def test_histogram_percentiles_small(pixels):
+    data = numpy.array(pixels, dtype=numpy.uint16)
+    pct = [0, 2.5, 25, 50, 75, 97.5, 100]
+    result = histogram_percentiles(histogram_uint16(data), pct)
+    assert numpy.allclose(result, numpy.percentile(data.astype(numpy.float64), pct), rtol=0, atol=1e-9)
+
+def test_stretch_float_image():
+    data = make_image(False).astype(numpy.float32)
+    params = compute_stretch(data)
+    assert params.histogram is None
+    assert numpy.allclose((params.lower, params.upper), numpy.percentile(data, (2.5, 97.5)))
+
+def test_stretch_dynamic_range():
+    data = make_image(False)
+    image, params = stretch_dynamic_range(data)
+    assert image.dtype == numpy.uint16
+    assert numpy.array_equal(image, maximize_dynamic_range(data))
+
+    # the percentiles become black and white, beyond them the image clamps
+    assert image[data <= params.lower].max() == 0
+    assert image[data >= params.upper].min() == 65535
+
+@pytest.mark.parametrize('filenames, needed', [
+    ([], set()),
+    (['a.raw'], set()),
+    (['a.fits', 'b.FIT', 'c.fits.fz'], {'gray'}),
+    (['a.JPG', 'b.jpeg'], {'color'}),
+    (['a.raw', 'b.fits.fz', 'c.jpg'], {'color', 'gray'}),
+])
+def test_products_needed(filenames, needed):
+    assert products_needed(filenames) == needed
+
+@pytest.fixture
+def demosaic_calls(monkeypatch):
+    '''Record the arguments of every demosaic() call'''
+    calls = []
+    original = imageprocessor.demosaic
+
+    def recording_demosaic(data, algorithm='malvar', rgb=True, gray=False):
+        calls.append((rgb, gray))
+        return original(data, algorithm, rgb=rgb, gray=gray)
+
+    monkeypatch.setattr(imageprocessor, 'demosaic', recording_demosaic)
+    return calls
+
+@pytest.mark.parametrize('extensions, products, calls', [
+    (['raw'], set(), []),
+    (['fits'], {'raw', 'dark_subtracted', 'demosaiced', 'gray'}, [(False, True)]),
+    (['jpg'], {'raw', 'dark_subtracted', 'demosaiced', 'color', 'display'}, [(True, False)]),
+    (['raw', 'fits', 'fits.fz', 'jpg'], {'raw', 'dark_subtracted', 'demosaiced', 'color', 'gray', 'display'}, [(True, True)]),
+])
+def test_save_all_computes_needed_products_once(tmp_path, demosaic_calls, extensions, products, calls):
+    processor = make_processor(True, postprocess=True)
+    filenames = [str(tmp_path / ('image.' + ext)) for ext in extensions]
+
+    timings = processor.save_all(filenames)
+    assert sorted(timings) == sorted(filenames)
+    assert set(processor.products) == products
+    assert set(processor.product_timings) == products
+    assert demosaic_calls == calls
+
+@pytest.mark.parametrize('debayer', [False, True])
+def test_lazy_output_matches_full_processing(tmp_path, debayer):
+    # each format on its own must give the same file as all formats at once
+    everything = [str(tmp_path / ('all.' + ext)) for ext in ('fits', 'jpg')]
+    make_processor(debayer, postprocess=True).save_all(everything)
+
+    fits = str(tmp_path / 'one.fits')
+    make_processor(debayer, postprocess=True).save_all([fits])
+    assert numpy.array_equal(fitsio.read(fits), fitsio.read(everything[0]))
+
+    jpeg = str(tmp_path / 'one.jpg')
+    make_processor(debayer, postprocess=True).save_all([jpeg])
+    with open(jpeg, 'rb') as one, open(everything[1], 'rb') as full:
+        assert one.read() == full.read()
+
+def test_products_after_save_all(demosaic_calls):
+    # products used after save_all() are still computed on demand
+    processor = make_processor(True)
+    processor.save_all([])
+    assert processor.color.shape == (480, 640, 3)
+    assert processor.gray.shape == (480, 640)
+    assert processor.data is processor.color
+    assert len(demosaic_calls) == 1
+
+def test_save_all_attempts_every_file(tmp_path):
+    # a failing file does not stop the others, its error is raised at the end
+    filenames = [str(tmp_path / name) for name in ('image.fits', 'image.txt', 'image.jpg')]
+    with pytest.raises(RuntimeError, match='image.txt'):
+        make_processor(False).save_all(filenames, max_workers=1)
+
+    assert os.path.exists(filenames[0])
+    assert not os.path.exists(filenames[1])
+    assert os.path.exists(filenames[2])
@@ -0,0 +1,74 @@
+'''
+The metrics registry and its Prometheus and JSON output
+'''
+
+import json
+
+import pytest
+
+from pyallsky.metrics import Metrics, format_sample, format_value
+
+def test_format_value():
+    assert format_value(3) == '3'
+    assert format_value(0.25) == '0.25'
+    assert format_value(float('inf')) == '+Inf'
+    assert format_value(float('-inf')) == '-Inf'
+
+def test_format_sample_escapes_labels():
+    assert format_sample('m', {}, 1) == 'm 1'
+    assert format_sample('m', {'b': 'x', 'a': 'say "hi"\\\n'}, 1.5) == 'm{a="say \\"hi\\"\\\\\\n",b="x"} 1.5'
+
+def test_counter_and_gauge():
+    metrics = Metrics()
+    metrics.counter('frames_total', 'Frames taken')
+    metrics.gauge('temperature', 'Temperature')
+    metrics.increment('frames_total', camera='day')
+    metrics.increment('frames_total', 2, camera='day')
+    metrics.set('temperature', 21.5)
+
+    lines = metrics.prometheus().splitlines()
+    assert '# TYPE frames_total counter' in lines
+    assert 'frames_total{camera="day"} 3.0' in lines
+    assert 'temperature 21.5' in lines
+
+def test_histogram():
+    metrics = Metrics(window=10)
+    metrics.histogram('duration_seconds', 'Duration', buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        metrics.observe('duration_seconds', value, stage='save')
+
+    lines = metrics.prometheus().splitlines()
+    assert 'duration_seconds_bucket{le="0.1",stage="save"} 1' in lines
+    assert 'duration_seconds_bucket{le="1.0",stage="save"} 2' in lines
+    assert 'duration_seconds_bucket{le="+Inf",stage="save"} 3' in lines
+    assert 'duration_seconds_count{stage="save"} 3' in lines
+    assert 'duration_seconds_sum{stage="save"} 5.55' in lines
+    assert '# TYPE duration_seconds_recent gauge' in lines
+    assert any(line.startswith('duration_seconds_recent{quantile="0.5",stage="save"}') for line in lines)
+
+    series = metrics.snapshot()['duration_seconds']['series'][0]
+    assert series['labels'] == {'stage': 'save'}
+    assert series['count'] == 3
+    assert series['buckets'] == [[0.1, 1], [1.0, 2]]
+
+def test_declaration_errors():
+    metrics = Metrics()
+    metrics.counter('a', 'A')
+    with pytest.raises(ValueError):
+        metrics.gauge('a', 'A')
+    with pytest.raises(ValueError):
+        metrics.set('a', 1.0)
+    with pytest.raises(KeyError):
+        metrics.increment('b')
+
+def test_write(tmp_path):
+    metrics = Metrics()
+    metrics.counter('frames_total', 'Frames taken')
+    metrics.increment('frames_total')
+
+    metrics.write(str(tmp_path / 'allsky.prom'))
+    assert (tmp_path / 'allsky.prom').read_text() == metrics.prometheus()
+
+    metrics.write(str(tmp_path / 'allsky.json'))
+    snapshot = json.loads((tmp_path / 'allsky.json').read_text())
+    assert snapshot['frames_total']['series'][0]['value'] == 1.0
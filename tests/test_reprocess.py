@@ -0,0 +1,218 @@
+'''
+Batch reprocessing of RAW archives: planning, output files and worker errors
+'''
+
+import datetime
+import os
+import subprocess
+import sys
+
+import fitsio
+import numpy
+import pytest
+
+from pyallsky.abstract_camera import FRAME_HEIGHT, FRAME_WIDTH
+from pyallsky.darklibrary import DarkLibrary
+from pyallsky.imagecapture import AllSkyImage, capture_image_file, raw_filename_base
+from pyallsky.imageprocessor import AllSkyDeviceConfiguration, AllSkyImageProcessor
+from pyallsky.reprocess import DarkSettings, ReprocessResult, is_within, plan_tasks, reprocess, reprocess_frame
+
+EXTENSIONS = ['.fits', '.jpg']
+
+DEVICE_CONFIG = AllSkyDeviceConfiguration(
+    device='', exposure=1.0, dark=False, debayer=False, grayscale=False, postprocess=False,
+    rotate180=False, overlay=False, heating=False,
+)
+
+DEVICE_CONFIGS = {'day': DEVICE_CONFIG, 'night': DEVICE_CONFIG}
+
+def write_raw_frames(directory, count):
+    '''Write count synthetic RAW frames into directory, return their paths'''
+    rng = numpy.random.default_rng(0)
+    os.makedirs(directory, exist_ok=True)
+    sources = []
+    for i in range(count):
+        utctime = datetime.datetime(2026, 1, 1, 0, 0, 0) + datetime.timedelta(minutes=i)
+        source = os.path.join(directory, raw_filename_base('tst', utctime, 'night') + '.raw')
+        data = rng.integers(0, 4096, size=(FRAME_HEIGHT, FRAME_WIDTH), dtype=numpy.uint16)
+        with open(source, 'wb') as f:
+            f.write(data.tobytes())
+        sources.append(source)
+
+    return sources
+
+def plan(input_directory, output_directory, **kwargs):
+    return list(plan_tasks(str(input_directory), str(output_directory), EXTENSIONS, DEVICE_CONFIGS, **kwargs))
+
+def set_mtime(filename, mtime):
+    os.utime(filename, (mtime, mtime))
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_reprocess_and_skip_up_to_date(tmp_path, workers):
+    sources = write_raw_frames(str(tmp_path / 'in'), 3)
+    tasks = plan(tmp_path / 'in', tmp_path / 'out')
+    assert [task.source for task in tasks] == sources
+
+    results = list(reprocess(tasks, workers=workers))
+    assert len(results) == 3
+    for task, result in results:
+        assert isinstance(result, ReprocessResult)
+        for fn in task.filenames:
+            assert os.path.exists(fn)
+
+    # no temporary files are left behind
+    assert not [name for name in os.listdir(str(tmp_path / 'out')) if name.startswith('.tmp-')]
+
+    # everything is up to date
+    assert plan(tmp_path / 'in', tmp_path / 'out') == []
+    assert len(plan(tmp_path / 'in', tmp_path / 'out', force=True)) == 3
+
+def test_plan_source_newer_than_output(tmp_path):
+    sources = write_raw_frames(str(tmp_path / 'in'), 2)
+    for task in plan(tmp_path / 'in', tmp_path / 'out'):
+        for fn in task.filenames:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            open(fn, 'wb').close()
+            set_mtime(fn, 2000000000)
+
+    assert plan(tmp_path / 'in', tmp_path / 'out') == []
+
+    # one output is older than its source
+    jpg = os.path.join(str(tmp_path / 'out'), os.path.basename(sources[0])[:-len('.raw')] + '.jpg')
+    set_mtime(sources[0], 2000000100)
+    set_mtime(jpg, 2000000200)
+    tasks = plan(tmp_path / 'in', tmp_path / 'out')
+    assert [(task.source, [os.path.splitext(fn)[1] for fn in task.filenames]) for task in tasks] == \
+        [(sources[0], ['.fits'])]
+
+def test_plan_config_newer_than_output(tmp_path):
+    write_raw_frames(str(tmp_path / 'in'), 2)
+    for task in plan(tmp_path / 'in', tmp_path / 'out'):
+        for fn in task.filenames:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            open(fn, 'wb').close()
+            set_mtime(fn, 2000000000)
+
+    assert plan(tmp_path / 'in', tmp_path / 'out', newer_than=1999999999) == []
+    assert len(plan(tmp_path / 'in', tmp_path / 'out', newer_than=2000000001)) == 2
+
+def test_failed_save_keeps_previous_output(tmp_path):
+    write_raw_frames(str(tmp_path / 'in'), 1)
+    task = plan(tmp_path / 'in', tmp_path / 'out')[0]
+    fits = task.filenames[0]
+    os.makedirs(os.path.dirname(fits))
+    with open(fits, 'wb') as f:
+        f.write(b'previous')
+
+    # the second format cannot be written, so nothing is replaced
+    task = task._replace(filenames=[fits, fits[:-len('.fits')] + '.unknown'])
+    with pytest.raises(RuntimeError):
+        reprocess_frame(task)
+
+    with open(fits, 'rb') as f:
+        assert f.read() == b'previous'
+    assert os.listdir(os.path.dirname(fits)) == [os.path.basename(fits)]
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_worker_errors_are_returned(tmp_path, workers):
+    sources = write_raw_frames(str(tmp_path / 'in'), 3)
+    tasks = plan(tmp_path / 'in', tmp_path / 'out')
+
+    # one frame disappears before it is processed
+    os.unlink(sources[1])
+
+    results = dict((task.source, result) for task, result in reprocess(tasks, workers=workers))
+    assert isinstance(results[sources[0]], ReprocessResult)
+    assert isinstance(results[sources[1]], OSError)
+    assert isinstance(results[sources[2]], ReprocessResult)
+
+SERIALNO = b'A1234\x00\x00\x00\x00'
+
+def write_sidecar(source, exposure):
+    '''Save the FITS file of a RAW frame with the headers the scheduler adds'''
+    image = capture_image_file(source, exposure)
+    processor = AllSkyImageProcessor('tst', image, DEVICE_CONFIG)
+    processor.add_fits_header('SITEID', 'old', 'ID code of the Observatory site')
+    processor.add_fits_header('SERIALNO', SERIALNO, 'Camera Serial Number')
+    processor.add_fits_header('FWVERS', b'\x01\x02', 'Camera Firmware Version')
+    processor.save_fits(source[:-len('.raw')] + '.fits')
+
+def write_master_dark(directory, exposure, level):
+    darks = DarkLibrary(directory)
+    data = numpy.full((FRAME_HEIGHT, FRAME_WIDTH), level, dtype=numpy.uint16)
+    darks.add(SERIALNO, AllSkyImage(timestamp=datetime.datetime(2026, 1, 1), exposure=exposure, data=data.tobytes()))
+
+def test_reprocess_subtracts_dark_and_keeps_headers(tmp_path):
+    source = write_raw_frames(str(tmp_path / 'in'), 1)[0]
+    write_sidecar(source, 2.0)
+    write_master_dark(str(tmp_path / 'darks'), 2.0, 100)
+
+    config = DEVICE_CONFIG._replace(dark=True)
+    darks = DarkSettings(directory=str(tmp_path / 'darks'), max_scale=2.0, bias=None)
+    tasks = list(plan_tasks(str(tmp_path / 'in'), str(tmp_path / 'out'), ['.fits'], {'night': config},
+                            fits_headers=[('SITEID', 'tst', 'ID code of the Observatory site')], darks=darks))
+    reprocess_frame(tasks[0])
+
+    data, header = fitsio.read(tasks[0].filenames[0], header=True)
+    raw = numpy.fromfile(source, dtype=numpy.uint16).reshape((FRAME_HEIGHT, FRAME_WIDTH))
+    assert numpy.array_equal(numpy.flipud(data), raw - numpy.minimum(raw, 100))
+
+    # the sidecar headers are carried over, unless they are set again
+    assert header['SERIALNO'] == str(SERIALNO)
+    assert header['FWVERS'] == str(b'\x01\x02')
+    assert header['SITEID'] == 'tst'
+    assert header['EXPTIME'] == '2.000000'
+    assert [record['name'] for record in header.records()].count('DATAMODE') == 1
+
+def test_reprocess_without_darks(tmp_path):
+    source = write_raw_frames(str(tmp_path / 'in'), 1)[0]
+    write_sidecar(source, 2.0)
+    write_master_dark(str(tmp_path / 'darks'), 2.0, 100)
+
+    # the configuration does not take darks
+    darks = DarkSettings(directory=str(tmp_path / 'darks'), max_scale=2.0, bias=None)
+    task = plan(tmp_path / 'in', tmp_path / 'out', darks=darks)[0]
+    assert task.darks is None
+    reprocess_frame(task)
+
+    raw = numpy.fromfile(source, dtype=numpy.uint16).reshape((FRAME_HEIGHT, FRAME_WIDTH))
+    assert numpy.array_equal(numpy.flipud(fitsio.read(task.filenames[0])), raw)
+
+def test_is_within(tmp_path):
+    assert is_within(str(tmp_path), str(tmp_path))
+    assert is_within(str(tmp_path / 'a' / 'b'), str(tmp_path))
+    assert not is_within(str(tmp_path / 'ab'), str(tmp_path / 'a'))
+    assert not is_within(str(tmp_path), str(tmp_path / 'a'))
+
+def run_allsky_reprocess(tmp_path, *args):
+    config = tmp_path / 'allsky_scheduler.conf'
+    config.write_text(
+        '[general]\nsiteid = tst\nlatitude = 34.4\nlongitude = -119.8\nelevation = 10\n'
+        'directory = %s\nextensions = .fits\n' % (tmp_path / 'in') +
+        ''.join('[%s]\ndevice = /dev/null\nexposure = 1.0\ndark = false\ndebayer = false\n'
+                'grayscale = false\npostprocess = false\nrotate180 = false\noverlay = false\n'
+                'heating = false\n' % section for section in ('day', 'night'))
+    )
+
+    root = os.path.join(os.path.dirname(__file__), '..')
+    env = dict(os.environ, PYTHONPATH=root)
+    command = [sys.executable, os.path.join(root, 'bin', 'allsky_reprocess'), '-c', str(config)]
+    return subprocess.run(command + list(args), env=env, capture_output=True, text=True)
+
+def test_refuses_to_write_into_input_tree(tmp_path):
+    source = write_raw_frames(str(tmp_path / 'in'), 1)[0]
+    fits = source[:-len('.raw')] + '.fits'
+
+    for args in ([], ['-o', str(tmp_path / 'in' / 'sub')]):
+        result = run_allsky_reprocess(tmp_path, *(args + ['-j', '1', str(tmp_path / 'in')]))
+        assert result.returncode == 1
+        assert '--in-place' in result.stdout + result.stderr
+        assert not os.path.exists(fits)
+
+    result = run_allsky_reprocess(tmp_path, '--in-place', '-j', '1', str(tmp_path / 'in'))
+    assert result.returncode == 0, result.stderr
+    assert os.path.exists(fits)
+
+    result = run_allsky_reprocess(tmp_path, '-o', str(tmp_path / 'out'), '-j', '1', str(tmp_path / 'in'))
+    assert result.returncode == 0, result.stderr
+    assert os.path.exists(str(tmp_path / 'out' / os.path.basename(fits)))
@@ -0,0 +1,422 @@
+'''
+The main loop stages of bin/allsky_scheduler
+'''
+
+import configparser
+import datetime
+import importlib.machinery
+import importlib.util
+import os
+import threading
+import time
+
+import numpy
+import pytest
+
+from pyallsky.abstract_camera import FRAME_BYTES
+from pyallsky.darklibrary import BIAS_EXPOSURE, DarkLibrary, exposure_key
+from pyallsky.emulator import EmulatorSettings, TcpEmulator
+from pyallsky.imagecapture import AllSkyImage, raw_filename_base
+from pyallsky.session import CameraSession
+
+def load_scheduler():
+    '''Import the scheduler script, which has no .py extension, as a module'''
+    filename = os.path.join(os.path.dirname(__file__), '..', 'bin', 'allsky_scheduler')
+    loader = importlib.machinery.SourceFileLoader('allsky_scheduler', filename)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+scheduler = load_scheduler()
+
+def make_config(tmp_path, **general):
+    '''Write a configuration file for two emulated cameras and read it back'''
+    config = configparser.ConfigParser()
+    config['general'] = {
+        'siteid': 'tst',
+        'latitude': '34.43',
+        'longitude': '-119.86',
+        'elevation': '10',
+        'interval': '120.0',
+        'dark_interval': '900.0',
+        'directory': str(tmp_path / 'images'),
+        'extensions': '.raw .fits .jpg',
+    }
+    config['general'].update(general)
+
+    for section, device in (('day', 'localhost:1'), ('night', 'localhost:2')):
+        config[section] = {
+            'device': device,
+            'exposure': '0.001' if section == 'day' else '30.0',
+            'dark': 'true',
+            'debayer': 'false',
+            'grayscale': 'false',
+            'postprocess': 'true',
+            'rotate180': 'false',
+            'overlay': 'false',
+            'heating': 'false',
+        }
+
+    filename = str(tmp_path / 'allsky_scheduler.conf')
+    with open(filename, 'w') as f:
+        config.write(f)
+
+    return scheduler.get_configuration(filename)
+
+def make_image(timestamp, exposure=30.0):
+    rng = numpy.random.default_rng(int(timestamp.timestamp()))
+    data = rng.integers(1000, 3000, size=(480, 640), dtype=numpy.uint16)
+    return AllSkyImage(timestamp=timestamp, exposure=exposure, data=data.tobytes())
+
+class SunEphemeris(object):
+    '''The part of the sun ephemeris which the processing stage uses'''
+    def __init__(self, state):
+        self.state = state
+
+class CameraInfo(object):
+    '''The part of AllSkyCameraInfo which the processing stage uses'''
+    serialno = 'A1234'
+    fwvers = '1.0'
+
+def make_metrics():
+    metrics = scheduler.Metrics()
+    scheduler.declare_metrics(metrics)
+    return metrics
+
+def metric_labels(metrics, name):
+    return [entry['labels'] for entry in metrics.snapshot()[name]['series']]
+
+################################################################################
+# Saving files and symlinks
+################################################################################
+
+def make_processor(config, timestamp):
+    return scheduler.AllSkyImageProcessor(config.siteid, make_image(timestamp), config.night)
+
+def output_filenames(config, timestamp):
+    directory = os.path.join(config.directory, timestamp.strftime('%Y-%m-%d'))
+    base = os.path.join(directory, raw_filename_base(config.siteid, timestamp, 'night'))
+    return [base + ext for ext in config.extensions]
+
+def current_image(config, ext):
+    return os.path.join(config.directory, 'AllSkyCurrentImage' + ext)
+
+def test_update_symlink(tmp_path):
+    link_name = str(tmp_path / 'current')
+    scheduler.update_symlink('first', link_name)
+    assert os.readlink(link_name) == 'first'
+
+    # the previous link is replaced, and the temporary link renamed away
+    scheduler.update_symlink('second', link_name)
+    assert os.readlink(link_name) == 'second'
+    assert sorted(os.listdir(str(tmp_path))) == ['current']
+
+def test_update_symlink_stale_temporary(tmp_path):
+    # a temporary link left behind by an interrupted update is replaced
+    link_name = str(tmp_path / 'current')
+    os.symlink('stale', link_name + '.tmp')
+    scheduler.update_symlink('new', link_name)
+    assert os.readlink(link_name) == 'new'
+    assert sorted(os.listdir(str(tmp_path))) == ['current']
+
+def test_save_images(tmp_path):
+    config = make_config(tmp_path)
+    timestamp = datetime.datetime(2026, 3, 1, 4, 0, 0)
+    timings = scheduler.save_images(config, SunEphemeris('night'), make_processor(config, timestamp))
+    assert sorted(timings) == sorted(config.extensions)
+
+    for filename, ext in zip(output_filenames(config, timestamp), config.extensions):
+        assert os.path.getsize(filename) > 0
+        assert os.readlink(current_image(config, ext)) == filename
+
+def test_save_images_keeps_symlinks(tmp_path):
+    config = make_config(tmp_path)
+    first = datetime.datetime(2026, 3, 1, 4, 0, 0)
+    second = first + datetime.timedelta(minutes=2)
+    scheduler.save_images(config, SunEphemeris('night'), make_processor(config, first))
+    scheduler.save_images(config, SunEphemeris('night'), make_processor(config, second), update_symlinks=False)
+
+    for filename, ext in zip(output_filenames(config, first), config.extensions):
+        assert os.readlink(current_image(config, ext)) == filename
+    for filename in output_filenames(config, second):
+        assert os.path.exists(filename)
+
+def test_save_images_skips_existing(tmp_path):
+    config = make_config(tmp_path)
+    timestamp = datetime.datetime(2026, 3, 1, 4, 0, 0)
+    filenames = output_filenames(config, timestamp)
+    os.makedirs(os.path.dirname(filenames[1]))
+    with open(filenames[1], 'w') as f:
+        f.write('existing')
+
+    timings = scheduler.save_images(config, SunEphemeris('night'), make_processor(config, timestamp))
+    assert sorted(timings) == ['.jpg', '.raw']
+    with open(filenames[1]) as f:
+        assert f.read() == 'existing'
+
+################################################################################
+# Processing pipeline
+################################################################################
+
+def make_job(config, timestamp):
+    return scheduler.FrameJob(
+        sun_ephem=SunEphemeris('night'),
+        device_config=config.night,
+        camera_info=CameraInfo(),
+        image=make_image(timestamp),
+        dark_image=None,
+        timings={'exposure': 30.0},
+        queued=time.monotonic(),
+    )
+
+def test_process_frame(tmp_path):
+    config = make_config(tmp_path)
+    timestamp = datetime.datetime(2026, 3, 1, 4, 0, 0)
+    job = make_job(config, timestamp)
+    metrics = make_metrics()
+    scheduler.process_frame(config, job, metrics)
+
+    for filename, ext in zip(output_filenames(config, timestamp), config.extensions):
+        assert os.readlink(current_image(config, ext)) == filename
+
+    # the stage timings are added to those of the capture
+    assert sorted(job.timings) == ['exposure', 'processing', 'queue', 'save']
+    stages = [labels['stage'] for labels in metric_labels(metrics, 'allsky_stage_duration_seconds')]
+    assert sorted(stages) == ['processing', 'queue', 'save']
+    formats = [labels['format'] for labels in metric_labels(metrics, 'allsky_save_duration_seconds')]
+    assert sorted(formats) == sorted(config.extensions)
+
+@pytest.fixture
+def processed(monkeypatch):
+    '''Replace process_frame, recording the jobs and whether they update the symlinks'''
+    processed = []
+
+    def process_frame(config, job, metrics, update_symlinks=True):
+        processed.append((job.image.timestamp, update_symlinks))
+
+    monkeypatch.setattr(scheduler, 'process_frame', process_frame)
+    return processed
+
+def test_pipeline_processes_frames(tmp_path, processed):
+    config = make_config(tmp_path)
+    pipeline = scheduler.FramePipeline(config, make_metrics(), workers=2, queue_size=2)
+
+    start = datetime.datetime(2026, 3, 1, 4, 0, 0)
+    timestamps = [start + datetime.timedelta(minutes=2 * i) for i in range(5)]
+    for timestamp in timestamps:
+        pipeline.submit(make_job(config, timestamp))
+
+    pipeline.queue.join()
+    assert sorted(timestamp for timestamp, _ in processed) == timestamps
+
+def test_pipeline_symlinks_only_move_forward(tmp_path):
+    config = make_config(tmp_path)
+    pipeline = scheduler.FramePipeline(config, make_metrics(), workers=0, queue_size=2)
+
+    # a slow worker finishing an older frame must not point the symlinks back at it
+    first = datetime.datetime(2026, 3, 1, 4, 0, 0)
+    second = first + datetime.timedelta(minutes=2)
+    assert pipeline.is_latest(make_job(config, second))
+    assert not pipeline.is_latest(make_job(config, first))
+    assert pipeline.is_latest(make_job(config, second))
+
+def test_pipeline_survives_errors(tmp_path, monkeypatch):
+    processed = []
+
+    def process_frame(config, job, metrics, update_symlinks=True):
+        if not processed:
+            processed.append(None)
+            raise OSError('disk full')
+
+        processed.append(job.image.timestamp)
+
+    monkeypatch.setattr(scheduler, 'process_frame', process_frame)
+    config = make_config(tmp_path)
+    pipeline = scheduler.FramePipeline(config, make_metrics(), workers=1, queue_size=2)
+
+    first = datetime.datetime(2026, 3, 1, 4, 0, 0)
+    second = first + datetime.timedelta(minutes=2)
+    pipeline.submit(make_job(config, first))
+    pipeline.submit(make_job(config, second))
+    pipeline.queue.join()
+    assert processed == [None, second]
+
+def test_pipeline_holds_back_capture(tmp_path, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(scheduler, 'process_frame', lambda *args, **kwargs: release.wait())
+    config = make_config(tmp_path)
+    pipeline = scheduler.FramePipeline(config, make_metrics(), workers=1, queue_size=1)
+
+    # one frame in the worker and one queued, a third has to wait
+    start = datetime.datetime(2026, 3, 1, 4, 0, 0)
+    jobs = [make_job(config, start + datetime.timedelta(minutes=2 * i)) for i in range(3)]
+    submitter = threading.Thread(target=lambda: [pipeline.submit(job) for job in jobs])
+    submitter.start()
+    submitter.join(0.5)
+    assert submitter.is_alive()
+
+    release.set()
+    submitter.join(5.0)
+    assert not submitter.is_alive()
+    pipeline.queue.join()
+
+class LoopState(object):
+    '''The part of MainLoopState used by main_loop_step, with a recording pipeline'''
+    def __init__(self, config):
+        self.metrics = make_metrics()
+        self.pending_darks = {}
+        self.submitted = []
+        self.pipeline = self
+
+    def submit(self, job):
+        self.submitted.append(job)
+
+def test_main_loop_step_pipeline(tmp_path, monkeypatch, processed):
+    config = make_config(tmp_path, pipeline_workers='1')
+    loopstate = LoopState(config)
+    job = make_job(config, datetime.datetime(2026, 3, 1, 4, 0, 0))
+
+    # the frame goes to the pipeline, in a buffer of its own
+    captures = []
+    def capture_frame(config, suntable, loopstate, reuse_buffer=True):
+        captures.append(reuse_buffer)
+        return job
+
+    monkeypatch.setattr(scheduler, 'capture_frame', capture_frame)
+    timings = scheduler.main_loop_step(config, None, loopstate)
+    assert captures == [False]
+    assert loopstate.submitted == [job]
+    assert processed == []
+    assert timings == {'exposure': 30.0, 'dark': 0.0}
+
+    # without a pipeline, the frame is processed in place before the next one
+    loopstate.pipeline = None
+    scheduler.main_loop_step(config, None, loopstate)
+    assert captures == [False, True]
+    assert processed == [(job.image.timestamp, True)]
+
+################################################################################
+# Darks in the slack time between frames
+################################################################################
+
+@pytest.fixture
+def emulator():
+    emulator = TcpEmulator(EmulatorSettings(readout_time=0.0, seed=1)).start()
+    yield emulator
+    emulator.stop()
+
+class DarkLoopState(object):
+    '''The part of MainLoopState used for darks, with the day camera on the emulator'''
+    def __init__(self, config, device):
+        self.darks = DarkLibrary(config.dark_directory, config.dark_frames, config.dark_max_scale,
+                                 config.dark_bias_level)
+        self.pending_darks = {}
+        self.metrics = make_metrics()
+
+        session = CameraSession(device)
+        session.connect()
+        self.camera_info = {'day': scheduler.AllSkyCameraInfo(session)}
+
+    def close(self):
+        self.camera_info['day'].session.close()
+
+@pytest.fixture
+def loopstate(tmp_path, emulator):
+    loopstate = DarkLoopState(make_config(tmp_path), emulator.device)
+    yield loopstate
+    loopstate.close()
+
+def darks_total(metrics):
+    return sum(entry['value'] for entry in metrics.snapshot()['allsky_darks_total']['series'])
+
+def test_schedule_dark(tmp_path, loopstate):
+    config = make_config(tmp_path)
+    utctime = datetime.datetime.utcnow()
+
+    # without masters, a bias frame and the dark are due
+    scheduler.schedule_dark(config, loopstate, 'day', 0.001, utctime)
+    assert sorted(loopstate.pending_darks) == [('day', exposure_key(BIAS_EXPOSURE)), ('day', exposure_key(0.001))]
+
+    # a dark which is already due keeps the time it became due
+    later = utctime + datetime.timedelta(minutes=2)
+    scheduler.schedule_dark(config, loopstate, 'day', 0.001, later)
+    assert all(pending.since == utctime for pending in loopstate.pending_darks.values())
+
+def test_schedule_sub_millisecond_dark(tmp_path, loopstate):
+    # the bias frame and a dark of less than half a millisecond are both due
+    config = make_config(tmp_path)
+    scheduler.schedule_dark(config, loopstate, 'day', 0.0003, datetime.datetime.utcnow())
+    exposures = sorted(pending.exposure for pending in loopstate.pending_darks.values())
+    assert exposures == [BIAS_EXPOSURE, 0.0003]
+
+def test_schedule_dark_configured_bias(tmp_path, loopstate):
+    config = make_config(tmp_path, dark_bias_level='1000.0')
+    scheduler.schedule_dark(config, loopstate, 'day', 0.001, datetime.datetime.utcnow())
+    assert list(loopstate.pending_darks) == [('day', exposure_key(0.001))]
+
+def test_schedule_dark_fresh_master(tmp_path, loopstate):
+    config = make_config(tmp_path, dark_bias_level='1000.0')
+    utctime = datetime.datetime.utcnow()
+    serialno = loopstate.camera_info['day'].serialno
+    loopstate.darks.add(serialno, make_image(utctime, exposure=0.001))
+
+    scheduler.schedule_dark(config, loopstate, 'day', 0.001, utctime + datetime.timedelta(seconds=60))
+    assert loopstate.pending_darks == {}
+
+    # the master is renewed once it is older than dark_interval
+    scheduler.schedule_dark(config, loopstate, 'day', 0.001, utctime + datetime.timedelta(seconds=901))
+    assert list(loopstate.pending_darks) == [('day', exposure_key(0.001))]
+
+def test_estimate_capture_duration(loopstate):
+    camera_info = loopstate.camera_info['day']
+
+    # before the first transfer, from the baud rate
+    expected = 0.001 + FRAME_BYTES * 10.0 / camera_info.baudrate + scheduler.DARK_SLACK_MARGIN
+    assert scheduler.estimate_capture_duration(camera_info, 0.001) == pytest.approx(expected)
+
+    # afterwards, from the duration of the last transfer
+    camera_info.session.run(lambda camera: scheduler.capture_image_camera(camera, 0.001, dark=True))
+    expected = 2.0 + camera_info.cam.xfer_stats.duration + scheduler.DARK_SLACK_MARGIN
+    assert scheduler.estimate_capture_duration(camera_info, 2.0) == pytest.approx(expected)
+
+def test_capture_pending_darks(tmp_path, loopstate):
+    config = make_config(tmp_path)
+    scheduler.schedule_dark(config, loopstate, 'day', 0.001, datetime.datetime.utcnow())
+
+    # without a deadline, everything which is due is captured
+    assert scheduler.capture_pending_darks(config, loopstate, None) > 0.0
+    assert loopstate.pending_darks == {}
+    assert darks_total(loopstate.metrics) == 2
+
+    serialno = loopstate.camera_info['day'].serialno
+    assert loopstate.darks.master(serialno, BIAS_EXPOSURE) is not None
+    assert loopstate.darks.master(serialno, 0.001) is not None
+
+def test_capture_pending_darks_deferred(tmp_path, loopstate):
+    config = make_config(tmp_path)
+    scheduler.schedule_dark(config, loopstate, 'day', 0.001, datetime.datetime.utcnow())
+    pending = dict(loopstate.pending_darks)
+
+    # no slack before the next frame, so the darks wait for a later step
+    assert scheduler.capture_pending_darks(config, loopstate, time.monotonic()) == 0.0
+    assert loopstate.pending_darks == pending
+    assert darks_total(loopstate.metrics) == 0
+
+    # until they are overdue, then the next frame is delayed for them
+    overdue = datetime.datetime.utcnow() - datetime.timedelta(seconds=config.dark_interval + 1)
+    for key, dark in pending.items():
+        loopstate.pending_darks[key] = dark._replace(since=overdue)
+
+    assert scheduler.capture_pending_darks(config, loopstate, time.monotonic()) > 0.0
+    assert loopstate.pending_darks == {}
+    assert darks_total(loopstate.metrics) == 2
+
+def test_capture_pending_darks_with_slack(tmp_path, loopstate):
+    config = make_config(tmp_path)
+    scheduler.schedule_dark(config, loopstate, 'day', 0.001, datetime.datetime.utcnow())
+
+    # enough time left for the darks before the next frame
+    camera_info = loopstate.camera_info['day']
+    slack = 2 * scheduler.estimate_capture_duration(camera_info, 0.001) + 60.0
+    scheduler.capture_pending_darks(config, loopstate, time.monotonic() + slack)
+    assert loopstate.pending_darks == {}
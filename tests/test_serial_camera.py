@@ -0,0 +1,119 @@
+'''
+Serial cameras on an emulated serial port: baud rate detection, changes and the cache
+'''
+
+import json
+import time
+
+import pytest
+
+from pyallsky.emulator import EmulatorSettings, PtyEmulator
+from pyallsky.serial_camera import BaudRateCache, SerialCamera, SerialCameraException
+
+@pytest.fixture
+def impatient(monkeypatch):
+    '''Wait only briefly for the reply to a command, which speeds up the baud rate detection'''
+    monkeypatch.setattr(SerialCamera, 'default_timeout', 0.1)
+
+def start_emulator(baudrate):
+    return PtyEmulator(EmulatorSettings(baudrate=baudrate, readout_time=0.0, seed=1)).start()
+
+@pytest.fixture
+def emulator():
+    emulator = start_emulator(9600)
+    yield emulator
+    emulator.stop()
+
+def test_set_baudrate_handshake(emulator, tmp_path):
+    cache = BaudRateCache(str(tmp_path / 'baudrates.json'))
+    camera = SerialCamera(emulator.device, baud_cache=cache)
+    assert camera.get_baudrate() == 9600
+
+    camera.set_baudrate(115200)
+    assert camera.get_baudrate() == 115200
+    assert emulator.camera.baudrate == 115200
+    assert camera.check_communications()
+    assert cache.get(emulator.device) == 115200
+    camera.close()
+
+def test_set_baudrate_handshake_timeout(emulator):
+    # the camera never answers "TestOk", so it reverts to its old rate
+    write = emulator.camera.write
+    emulator.camera.write = lambda data: None if data == b'TestOk' else write(data)
+
+    cache = BaudRateCache()
+    camera = SerialCamera(emulator.device, baud_cache=cache)
+    with pytest.raises(SerialCameraException, match='still at 9600'):
+        camera.set_baudrate(115200)
+
+    assert camera.get_baudrate() == 9600
+    assert emulator.camera.baudrate == 9600
+    assert camera.check_communications()
+    assert cache.get(emulator.device) == 9600
+    camera.close()
+
+def test_set_baudrate_unsupported(emulator):
+    camera = SerialCamera(emulator.device, baud_cache=BaudRateCache())
+    with pytest.raises(SerialCameraException, match='Unsupported'):
+        camera.set_baudrate(12345)
+    camera.close()
+
+def test_upgrade_baudrate(emulator):
+    camera = SerialCamera(emulator.device, baud_cache=BaudRateCache())
+    assert camera.upgrade_baudrate(max_rate=115200, verify_blocks=2) == 115200
+    assert emulator.camera.baudrate == 115200
+    camera.close()
+
+def test_cache_persists(tmp_path):
+    filename = str(tmp_path / 'baudrates.json')
+    cache = BaudRateCache(filename)
+    cache.set('/dev/ttyS0', 115200)
+    cache.set('/dev/ttyS1', 460800)
+
+    with open(filename, 'r') as f:
+        assert json.load(f) == {'/dev/ttyS0': 115200, '/dev/ttyS1': 460800}
+
+    cache = BaudRateCache(filename)
+    assert cache.get('/dev/ttyS0') == 115200
+    assert cache.get('/dev/ttyS1') == 460800
+    assert cache.get('/dev/ttyS2') is None
+
+def test_cache_unreadable(tmp_path):
+    filename = tmp_path / 'baudrates.json'
+    filename.write_text('not json')
+    assert BaudRateCache(str(filename)).get('/dev/ttyS0') is None
+
+def test_autobaud_tries_cached_rate_first(impatient, tmp_path):
+    emulator = start_emulator(460800)
+    try:
+        # without the cache, every slower rate is tried before the camera is
+        # found at the rate it was upgraded to
+        filename = str(tmp_path / 'baudrates.json')
+        tstart = time.monotonic()
+        camera = SerialCamera(emulator.device, baud_cache=BaudRateCache(filename))
+        detect = time.monotonic() - tstart
+        camera.close()
+        assert camera.get_baudrate() == 460800
+
+        # the reloaded cache finds it straight away
+        tstart = time.monotonic()
+        camera = SerialCamera(emulator.device, baud_cache=BaudRateCache(filename))
+        cached = time.monotonic() - tstart
+        camera.close()
+        assert camera.get_baudrate() == 460800
+        assert cached < detect / 3
+    finally:
+        emulator.stop()
+
+def test_read_honours_timeout(emulator):
+    camera = SerialCamera(emulator.device, baud_cache=BaudRateCache())
+    buf = memoryview(bytearray(16))
+
+    tstart = time.monotonic()
+    assert camera.transport_read_into(buf, 0.01) == 0
+    assert time.monotonic() - tstart < 0.05
+
+    tstart = time.monotonic()
+    assert camera.transport_read_into(buf, 0.3) == 0
+    assert time.monotonic() - tstart >= 0.3
+    camera.close()
@@ -0,0 +1,97 @@
+'''
+Camera sessions against the emulated camera: probing, backoff and reconnection
+'''
+
+import pytest
+
+from pyallsky import session as session_module
+from pyallsky.emulator import EmulatorSettings, TcpEmulator
+from pyallsky.session import CameraSession, CameraUnavailable, open_camera
+
+class FakeClock(object):
+    '''Replacement for the time module of pyallsky.session, with a clock which only moves in sleep()'''
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def emulator():
+    emulator = TcpEmulator(EmulatorSettings(readout_time=0.0, seed=1)).start()
+    yield emulator
+    emulator.stop()
+
+def open_impatient_camera(device):
+    '''Open a camera which waits only briefly for the reply to a command'''
+    camera = open_camera(device)
+    camera.default_timeout = 0.2
+    return camera
+
+def recording_session(device, **kwargs):
+    '''A CameraSession which records its events in the events attribute'''
+    events = []
+    session = CameraSession(device, listener=lambda event, session: events.append(event), **kwargs)
+    session.events = events
+    return session
+
+def test_probe_failure(emulator):
+    session = recording_session(emulator.device, probe_interval=0.0, min_backoff=5.0,
+                                opener=open_impatient_camera)
+    camera = session.acquire()
+    assert session.probe()
+
+    # the camera stops answering commands
+    emulator.camera.handle_command = lambda command: None
+    assert not session.probe()
+    assert session.events == ['connect', 'probe_failure']
+
+    # the idle connection is probed before use, and dropped
+    with pytest.raises(CameraUnavailable):
+        session.acquire()
+
+    assert not session.connected
+    assert session.events == ['connect', 'probe_failure', 'probe_failure', 'failure']
+    assert session.failures == 1
+    camera.close()
+
+def test_backoff_schedule(emulator, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(session_module, 'time', clock)
+
+    # nothing listens on the device any more
+    device = emulator.device
+    emulator.stop()
+
+    session = CameraSession(device, min_backoff=1.0, max_backoff=8.0)
+    delays = []
+    for _ in range(6):
+        with pytest.raises(CameraUnavailable):
+            session.acquire()
+        delays.append(session.retry_at - clock.now)
+
+        # no connection attempt before the delay has passed
+        with pytest.raises(CameraUnavailable, match='next attempt'):
+            session.acquire()
+
+        clock.sleep(delays[-1])
+
+    assert delays == [1.0, 2.0, 4.0, 8.0, 8.0, 8.0]
+    assert session.connects == 0
+
+def test_reconnect_after_dropped_connection(emulator):
+    session = recording_session(emulator.device, min_backoff=0.01)
+    assert session.run(lambda camera: camera.check_communications())
+
+    # the convertor drops the connection, the next command fails and is
+    # retried on a new connection
+    emulator.disconnect()
+    assert session.run(lambda camera: camera.check_communications())
+
+    assert session.connects == 2
+    assert session.failures == 0
+    assert session.events == ['connect', 'failure', 'connect']
+    session.close()
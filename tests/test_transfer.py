@@ -0,0 +1,171 @@
+'''
+Image transfers from the emulated camera, with injected link errors
+'''
+
+import asyncio
+import time
+
+import pytest
+
+from pyallsky.abstract_camera import BLOCK_PIXELS, BLOCKS_PER_FRAME, ImageTransferError, PIXEL_SIZE
+from pyallsky.async_camera import AsyncTcpCamera
+from pyallsky.emulator import EmulatorSettings, TcpEmulator
+from pyallsky.tcp_camera import TcpCamera
+
+BLOCK_BYTES = BLOCK_PIXELS * PIXEL_SIZE
+
+def stall_block(emulator, block, seconds):
+    '''
+    Make the emulated camera pause for seconds in the middle of sending an
+    image block, the first time it sends it
+    '''
+    camera = emulator.camera
+    write = camera.write
+
+    def stalling_write(data):
+        if len(data) == BLOCK_BYTES + 1 and camera.blocks_sent == block:
+            write(data[:len(data) // 2])
+            time.sleep(seconds)
+            data = data[len(data) // 2:]
+
+        write(data)
+
+    camera.write = stalling_write
+
+def corrupt_block(emulator, block, count):
+    '''
+    Make the emulated camera send a bad checksum for an image block, the
+    first count times it sends it
+    '''
+    camera = emulator.camera
+    write = camera.write
+    remaining = [count]
+
+    def corrupting_write(data):
+        start = block * BLOCK_BYTES
+        if (len(data) == BLOCK_BYTES + 1 and remaining[0] > 0 and
+                data[:-1] == camera.frame[start:start + BLOCK_BYTES]):
+            remaining[0] -= 1
+            data = data[:-1] + bytes([data[-1] ^ 0x01])
+
+        write(data)
+
+    camera.write = corrupting_write
+
+class CallbackError(Exception):
+    pass
+
+def failing_callback(block):
+    if block.index == 5:
+        raise CallbackError()
+
+@pytest.fixture
+def emulator():
+    emulator = TcpEmulator(EmulatorSettings(readout_time=0.0, seed=1)).start()
+    yield emulator
+    emulator.stop()
+
+def connect(emulator):
+    host, port = emulator.device.split(':')
+    return TcpCamera(host, int(port))
+
+def test_transfer(emulator):
+    camera = connect(emulator)
+    camera.take_image(exposure=0.001)
+    image = camera.xfer_image()
+    camera.close()
+
+    assert bytes(image) == emulator.camera.frame
+    assert camera.xfer_stats.checksum_errors == 0
+    assert camera.xfer_stats.short_reads == 0
+
+def test_transfer_stalled_block(emulator):
+    # by block 30 the deadlines are learned from the fast link, so the stall
+    # outlasts the deadline and the rest of the block arrives late
+    stall_block(emulator, 30, 1.0)
+
+    camera = connect(emulator)
+    camera.take_image(exposure=0.001)
+    image = camera.xfer_image()
+    camera.close()
+
+    assert bytes(image) == emulator.camera.frame
+    assert camera.xfer_stats.short_reads >= 1
+    assert max(camera.xfer_stats.retries) <= 3
+
+def test_async_transfer_stalled_block(emulator):
+    stall_block(emulator, 30, 1.0)
+
+    async def transfer():
+        camera = await AsyncTcpCamera.create(*emulator.device.split(':'))
+        try:
+            await camera.take_image(exposure=0.001)
+            return await camera.xfer_image(), camera.xfer_stats
+        finally:
+            await camera.close()
+
+    image, stats = asyncio.run(transfer())
+
+    assert bytes(image) == emulator.camera.frame
+    assert stats.short_reads >= 1
+    assert max(stats.retries) <= 3
+
+def test_resume(emulator):
+    corrupt_block(emulator, 20, 10)
+
+    camera = connect(emulator)
+    camera.take_image(exposure=0.001)
+    with pytest.raises(ImageTransferError) as error:
+        camera.xfer_image()
+
+    assert error.value.blocks == 20
+    assert bytes(error.value.data[:20 * BLOCK_BYTES]) == emulator.camera.frame[:20 * BLOCK_BYTES]
+
+    corrupt_block(emulator, 40, 10)
+    camera.take_image(exposure=0.001)
+    image = camera.xfer_image(resumes=1)
+    camera.close()
+
+    assert bytes(image) == emulator.camera.frame
+    assert camera.xfer_stats.blocks == BLOCKS_PER_FRAME
+
+def test_async_resume(emulator):
+    corrupt_block(emulator, 40, 10)
+
+    async def transfer():
+        camera = await AsyncTcpCamera.create(*emulator.device.split(':'))
+        try:
+            await camera.take_image(exposure=0.001)
+            return await camera.xfer_image(resumes=1), camera.xfer_stats
+        finally:
+            await camera.close()
+
+    image, stats = asyncio.run(transfer())
+
+    assert bytes(image) == emulator.camera.frame
+    assert stats.blocks == BLOCKS_PER_FRAME
+    assert len(stats.retries) == BLOCKS_PER_FRAME
+
+def test_callback_error_stops_transfer(emulator):
+    camera = connect(emulator)
+    camera.take_image(exposure=0.001)
+    with pytest.raises(CallbackError):
+        camera.xfer_image(block_callback=failing_callback)
+
+    # the camera is ready for the next command straight away
+    assert camera.check_communications()
+    camera.close()
+
+def test_async_callback_error_stops_transfer(emulator):
+    async def transfer():
+        camera = await AsyncTcpCamera.create(*emulator.device.split(':'))
+        try:
+            await camera.take_image(exposure=0.001)
+            with pytest.raises(CallbackError):
+                await camera.xfer_image(block_callback=failing_callback)
+
+            return await camera.check_communications()
+        finally:
+            await camera.close()
+
+    assert asyncio.run(transfer())
@@ -0,0 +1,66 @@
+'''
+The image block deadlines of TransferTimingModel
+'''
+
+import pytest
+
+from pyallsky.metrics import Metrics
+from pyallsky.transfer_timing import (DEFAULT_LATENCY, MAX_BACKOFF, MIN_SAMPLES, MIN_TIMEOUT,
+                                      NOMINAL_MARGIN, TransferTimingModel, serial_byte_rate)
+
+BLOCK = 8193
+
+def test_nominal_timeout():
+    model = TransferTimingModel(serial_byte_rate(9600))
+    expected = (DEFAULT_LATENCY + BLOCK / 960.0) * NOMINAL_MARGIN
+
+    assert not model.measured()
+    assert model.timeout(BLOCK) == pytest.approx(expected)
+    assert model.estimate(BLOCK).samples == 0
+
+def test_measured_timeout():
+    model = TransferTimingModel(serial_byte_rate(9600), margin=2.0)
+    for _ in range(MIN_SAMPLES):
+        model.add(0.2, BLOCK - 1, 1.0)
+
+    assert model.measured()
+    assert model.timeout(BLOCK) == pytest.approx((0.2 + BLOCK / (BLOCK - 1.0)) * 2.0)
+    assert model.estimate(BLOCK).samples == MIN_SAMPLES
+
+def test_minimum_timeout():
+    model = TransferTimingModel(serial_byte_rate(460800))
+    for _ in range(MIN_SAMPLES):
+        model.add(0.0001, BLOCK - 1, 0.0001)
+
+    assert model.timeout(BLOCK) == MIN_TIMEOUT
+
+def test_backoff():
+    model = TransferTimingModel(serial_byte_rate(9600))
+    timeout = model.timeout(BLOCK)
+
+    assert model.timeout(BLOCK, retry=1) == pytest.approx(2 * timeout)
+    assert model.timeout(BLOCK, retry=MAX_BACKOFF + 5) == pytest.approx(2 ** MAX_BACKOFF * timeout)
+
+def test_reset():
+    model = TransferTimingModel(serial_byte_rate(9600))
+    for _ in range(MIN_SAMPLES):
+        model.add(0.2, BLOCK - 1, 1.0)
+
+    model.reset(serial_byte_rate(115200))
+    assert not model.measured()
+    assert model.timeout(BLOCK) == pytest.approx((DEFAULT_LATENCY + BLOCK / 11520.0) * NOMINAL_MARGIN)
+
+def test_estimate_without_measured_throughput():
+    # blocks received within the clock resolution, without a latency
+    model = TransferTimingModel(serial_byte_rate(115200))
+    for _ in range(MIN_SAMPLES):
+        model.add(None, BLOCK - 1, 0.0)
+
+    estimate = model.estimate(BLOCK)
+    assert estimate.samples == MIN_SAMPLES
+    assert estimate.throughput == serial_byte_rate(115200)
+
+    metrics = Metrics()
+    metrics.gauge('allsky_transfer_estimated_rate_bytes_per_second', 'Estimated transfer rate')
+    metrics.set('allsky_transfer_estimated_rate_bytes_per_second', estimate.throughput, camera='day')
+    assert 'allsky_transfer_estimated_rate_bytes_per_second{camera="day"} 11520.0' in metrics.prometheus()